@@ -0,0 +1,288 @@
+"""
+Native async serving of the device endpoints for ASGI deployments, see iz_fota.asgi.
+
+Device connections are often slow, with a thread per request a few hundred of them occupy every
+thread of a worker. Here only the database work and file reads run in worker threads, waiting
+for the network happens on the event loop, so one worker can hold thousands of devices.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import DisallowedHost, RequestDataTooBig
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import FileResponse
+from api.authentication import CachedJWTTokenUserAuthentication
+from api.ingest import ingest_results, validate_result
+from api.resultqueue import QueueFull, get_result_queue
+from api.responsecache import latest_version
+from api.views import DownloadLatestFirmwareViewSet, etag_matches
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+import asyncio
+import io
+import json
+import threading
+
+# Marks the end of a response iterator read in a worker thread
+_END = object()
+
+
+class RequestAborted(Exception):
+    pass
+
+
+def _closing_connections(func):
+    # Like a sync request, don't keep the connection of the worker thread past CONN_MAX_AGE
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return wrapper
+
+
+async def run_sync(func, *args, **kwargs):
+    """
+    Run blocking code, like queries, in a thread of the default executor. Unlike Django's sync
+    views these don't share one thread, so a slow query doesn't hold up the other devices.
+    """
+    return await sync_to_async(_closing_connections(func), thread_sensitive=False)(*args, **kwargs)
+
+
+async def read_body(receive):
+    body = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise RequestAborted()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if settings.DATA_UPLOAD_MAX_MEMORY_SIZE is not None and size > settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+            raise RequestDataTooBig()
+        body.append(chunk)
+        if not message.get('more_body', False):
+            return b"".join(body)
+
+
+async def send_response(send, status, headers=(), body=b""):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(name.encode('latin1'), str(value).encode('latin1')) for name, value in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def send_json(send, status, data, headers=()):
+    body = json.dumps(data, separators=(',', ':')).encode()
+    await send_response(send, status, [('Content-Type', 'application/json')] + list(headers), body)
+
+
+def request_headers(scope):
+    return {name.decode('latin1').lower(): value.decode('latin1') for name, value in scope['headers']}
+
+
+def authenticate(headers):
+    """
+    The verified device token of the request, raises AuthenticationFailed like the DRF views.
+    """
+    parts = headers.get('authorization', '').split()
+    if len(parts) != 2 or parts[0] not in api_settings.AUTH_HEADER_TYPES:
+        raise AuthenticationFailed("Authentication credentials were not provided.")
+    authentication = CachedJWTTokenUserAuthentication()
+    token = authentication.get_validated_token(parts[1].encode())
+    authentication.get_user(token)
+    return token
+
+
+async def send_unauthorized(send, exc):
+    detail = exc.detail if isinstance(exc.detail, dict) else {'detail': exc.detail}
+    await send_json(send, 401, detail, [('WWW-Authenticate', '{} realm="api"'.format(api_settings.AUTH_HEADER_TYPES[0]))])
+
+
+async def latest_fw_version(scope, receive, send):
+    headers = request_headers(scope)
+    try:
+        token = authenticate(headers)
+    except (AuthenticationFailed, InvalidToken) as e:
+        await send_unauthorized(send, e)
+        return
+
+    hw_rev = token.get("hw_rev") or None
+    entry = await run_sync(latest_version, hw_rev) if hw_rev is not None else None
+    if entry is None or entry['etag'] is None:
+        await send_response(send, 204)
+        return
+
+    etag = entry['etag']
+    if etag_matches(headers.get('if-none-match'), etag, weak=True):
+        await send_response(send, 304, [('ETag', etag)])
+    elif scope['method'] == 'HEAD':
+        await send_response(send, 200, [('ETag', etag)])
+    else:
+        await send_response(send, 200, [('Content-Type', 'application/json'), ('ETag', etag)], entry['body'])
+
+
+async def post_results(scope, receive, send):
+    headers = request_headers(scope)
+    try:
+        token = authenticate(headers)
+    except (AuthenticationFailed, InvalidToken) as e:
+        await send_unauthorized(send, e)
+        return
+    try:
+        data = json.loads(await read_body(receive))
+    except RequestDataTooBig:
+        await send_json(send, 413, {'detail': "Request body too large."})
+        return
+    except ValueError as e:
+        await send_json(send, 400, {'detail': "JSON parse error - {}".format(e)})
+        return
+
+    _, errors = validate_result(data)
+    if errors is not None:
+        await send_json(send, 400, errors)
+        return
+
+    result_queue = get_result_queue()
+    if result_queue is not None:
+        try:
+            await run_sync(result_queue.put, [data])
+        except QueueFull:
+            await send_json(send, 503, "Too many results pending, try again later",
+                [('Retry-After', getattr(settings, 'POST_RESULTS_QUEUE_RETRY_AFTER', 30))])
+            return
+        await send_response(send, 202)
+        return
+
+    result = (await run_sync(ingest_results, [data]))[0]
+    if "errors" in result:
+        await send_json(send, result["status"], result["errors"])
+    else:
+        await send_response(send, result["status"])
+
+
+def valid_host(scope):
+    """
+    Whether the Host header is in ALLOWED_HOSTS, like HttpRequest.get_host() checks it for the Django application.
+    """
+    try:
+        ASGIRequest(scope, io.BytesIO()).get_host()
+    except DisallowedHost:
+        return False
+    return True
+
+
+_download_view = DownloadLatestFirmwareViewSet.as_view({'get': 'list', 'head': 'list'})
+
+def _render_download(request):
+    response = _download_view(request)
+    if hasattr(response, 'render'):
+        response.render()
+    return response
+
+
+def _produce_chunks(response, loop, chunks, stop):
+    # The whole response is read in this one worker thread, with one database connection, and only
+    # a chunk ahead of the device, putting the next one waits until the previous one was taken
+    try:
+        for chunk in response:
+            if stop.is_set():
+                break
+            asyncio.run_coroutine_threadsafe(chunks.put(bytes(chunk)), loop).result()
+    finally:
+        try:
+            response.close()
+        finally:
+            asyncio.run_coroutine_threadsafe(chunks.put(_END), loop).result()
+
+
+async def dl_latest_fw(scope, receive, send):
+    """
+    The download view runs in a worker thread, its response is sent from the event loop. A streamed
+    response is read in one more worker thread, a chunk ahead of what the device has taken.
+    """
+    try:
+        body = await read_body(receive)
+    except RequestDataTooBig:
+        await send_response(send, 413)
+        return
+    request = ASGIRequest(scope, io.BytesIO(body))
+    response = await run_sync(_render_download, request)
+    if isinstance(response, FileResponse):
+        response.block_size = getattr(settings, 'FIRMWARE_CHUNK_SIZE', 256 * 1024)
+
+    disconnected = asyncio.Event()
+    async def watch_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        disconnected.set()
+    watcher = asyncio.ensure_future(watch_disconnect())
+    producer = None
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': response.status_code,
+            'headers': [(name.encode('latin1'), str(value).encode('latin1')) for name, value in response.items()],
+        })
+        if response.streaming:
+            chunks = asyncio.Queue(maxsize=1)
+            stop = threading.Event()
+            producer = asyncio.ensure_future(run_sync(_produce_chunks, response, asyncio.get_running_loop(), chunks, stop))
+            chunk = None
+            try:
+                while True:
+                    chunk = await chunks.get()
+                    if chunk is _END or disconnected.is_set():
+                        break
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            finally:
+                # Let the producer finish, it may wait to put a chunk
+                stop.set()
+                while chunk is not _END:
+                    chunk = await chunks.get()
+            await producer
+            await send({'type': 'http.response.body'})
+        else:
+            await send({'type': 'http.response.body', 'body': response.content})
+    finally:
+        watcher.cancel()
+        if producer is None:
+            await run_sync(response.close)
+
+
+class DeviceAPIApplication:
+    """
+    ASGI application serving the device endpoints natively, everything else, like the batch
+    endpoint and the admin site, goes to the Django application.
+    """
+    routes = {
+        'latest_fw_version/': (latest_fw_version, ('GET', 'HEAD')),
+        'dl_latest_fw/': (dl_latest_fw, ('GET', 'HEAD')),
+        'post_results/': (post_results, ('POST',)),
+    }
+
+    def __init__(self, fallback, prefix):
+        self.fallback = fallback
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get('path', '')
+        if scope['type'] != 'http' or not path.startswith(self.prefix) or path[len(self.prefix):] not in self.routes:
+            await self.fallback(scope, receive, send)
+            return
+
+        # Middleware doesn't run here, check the host like CommonMiddleware does
+        if not valid_host(scope):
+            await send_json(send, 400, {'detail': "Invalid HTTP_HOST header."})
+            return
+        endpoint, methods = self.routes[path[len(self.prefix):]]
+        if scope['method'] not in methods:
+            await send_json(send, 405, {'detail': 'Method "{}" not allowed.'.format(scope['method'])}, [('Allow', ', '.join(methods))])
+            return
+        try:
+            await endpoint(scope, receive, send)
+        except RequestAborted:
+            pass
@@ -0,0 +1,101 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
+import hashlib
+import threading
+import time
+
+
+class VerifiedTokenCache:
+    """
+    LRU of tokens that passed verification, keyed by a digest of the raw token. An entry is
+    used until the token expires, devices polling with the same token skip the verification.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, raw_token):
+        return hashlib.sha256(raw_token).digest()
+
+    def get(self, raw_token):
+        key = self.key(raw_token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                token, exp = entry
+                if time.time() < exp:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return token
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, raw_token, token):
+        exp = token.get('exp')
+        if exp is None:
+            return
+        with self._lock:
+            self._entries[self.key(raw_token)] = (token, exp)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+        }
+
+
+class CachedJWTTokenUserAuthentication(JWTTokenUserAuthentication):
+    """
+    JWTTokenUserAuthentication that verifies a token once and then serves it from
+    the process wide cache of verified tokens until it expires.
+    """
+
+    def get_validated_token(self, raw_token):
+        cache = get_token_cache()
+        if cache is None:
+            return super().get_validated_token(raw_token)
+        token = cache.get(raw_token)
+        if token is None:
+            token = super().get_validated_token(raw_token)
+            cache.put(raw_token, token)
+        return token
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+def get_token_cache():
+    """
+    The cache of verified tokens holding up to JWT_TOKEN_CACHE_SIZE tokens, or None when disabled.
+    """
+    global _token_cache
+    size = getattr(settings, 'JWT_TOKEN_CACHE_SIZE', 10000)
+    if not size:
+        return None
+    with _token_cache_lock:
+        if _token_cache is None:
+            _token_cache = VerifiedTokenCache(size)
+        return _token_cache
+
+
+@receiver(setting_changed)
+def reset_token_cache(setting, **kwargs):
+    global _token_cache
+    # A new signing key must not accept tokens verified with the old one
+    if setting in ('JWT_TOKEN_CACHE_SIZE', 'SIMPLE_JWT'):
+        _token_cache = None
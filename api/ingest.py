@@ -0,0 +1,138 @@
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from app.models import Device, Firmware, FleetCounter, History, RolloutStats, hardware_revision_key, normalize_hw_rev
+from api.serializers import HistoryBatchSerializer
+from rest_framework import status
+
+REQUIRED_FIELDS = {"device", "device_firmware", "manufacturer_name", "model_number", "hardware_revision", "software_revision"}
+DEVICE_FIELDS = ["manufacturer_name", "model_number", "hardware_revision", "software_revision"]
+
+
+def resolve_firmware_ids(keys):
+    """
+    Map of (fw_version, hw revision) to firmware id for the given keys, in one query. Hardware
+    revisions match like the firmware lookups of the devices, whatever their case and spacing.
+    """
+    keys = {key for key in keys if key[0] is not None and key[1] is not None}
+    if not keys:
+        return {}
+    firmwares = Firmware.objects.filter(
+        fw_version__in={fw_version for fw_version, _ in keys},
+        hw_revision_key__in={normalize_hw_rev(hw_rev) for _, hw_rev in keys},
+    ).values_list('fw_version', 'hw_revision_key', 'pk')
+    found = {(fw_version, hw_rev): pk for fw_version, hw_rev, pk in firmwares}
+    return {key: found[key[0], normalize_hw_rev(key[1])] for key in keys if (key[0], normalize_hw_rev(key[1])) in found}
+
+
+def create_devices(devices):
+    """
+    Insert new devices, returns the serial numbers of the ones inserted. Devices another request
+    inserted meanwhile are skipped. Not with ignore_conflicts, MSSQL doesn't support it.
+    """
+    try:
+        with transaction.atomic():
+            Device.objects.bulk_create(devices)
+        return {device.serial_number for device in devices}
+    except IntegrityError:
+        pass
+    # One by one like PostResultsViewSet.create, keeping whichever came first
+    inserted = set()
+    for device in devices:
+        try:
+            with transaction.atomic():
+                Device.objects.bulk_create([device])
+            inserted.add(device.serial_number)
+        except IntegrityError:
+            pass
+    return inserted
+
+
+def validate_result(item):
+    """
+    Validate one result without touching the database, returns (validated data, None) or (None, errors).
+    """
+    if not isinstance(item, dict) or not REQUIRED_FIELDS <= item.keys():
+        return None, "You need to provide all attributes!"
+    serializer = HistoryBatchSerializer(data=item)
+    if not serializer.is_valid():
+        return None, serializer.errors
+    return serializer.validated_data, None
+
+
+def ingest_results(items):
+    """
+    Store a batch of FOTA results the way PostResultsViewSet.create stores a single one, with a
+    fixed number of queries for the whole batch. Returns one {"status": ..., "errors": ...} per item.
+    """
+    results = [None] * len(items)
+    accepted = []
+    for i, item in enumerate(items):
+        data, errors = validate_result(item)
+        if errors is not None:
+            results[i] = {"status": status.HTTP_400_BAD_REQUEST, "errors": errors}
+            continue
+        accepted.append((i, item, data))
+    if not accepted:
+        return results
+
+    firmware_ids = resolve_firmware_ids(
+        [(item.get("firmware"), item["hardware_revision"]) for _, item, _ in accepted] +
+        [(item["device_firmware"], item["hardware_revision"]) for _, item, _ in accepted]
+    )
+
+    with transaction.atomic():
+        serials = {str(item["device"]) for _, item, _ in accepted}
+        # Locked, so the fleet counters move the devices from what they are until the batch commits
+        fleet_keys = {}
+        devices = {}
+        for serial, pk, *fleet_key in Device.objects.select_for_update().filter(serial_number__in=serials).values_list(
+                'serial_number', 'pk', 'firmware_id', 'hardware_revision_key'):
+            devices[serial] = pk
+            fleet_keys[pk] = tuple(fleet_key)
+
+        # Unknown devices are created from the first result that names them
+        new_devices = {}
+        moves = []
+        now = timezone.now()
+        for _, item, data in accepted:
+            serial = str(item["device"])
+            if serial not in devices and serial not in new_devices:
+                new_devices[serial] = Device(serial_number=serial, created=now, last_update=None,
+                    firmware_id=firmware_ids.get((item["device_firmware"], item["hardware_revision"])),
+                    hardware_revision_key=hardware_revision_key(data.get("hardware_revision")),
+                    **{field: data.get(field) for field in DEVICE_FIELDS})
+        if new_devices:
+            # Another request may create the same device meanwhile, it counts that one
+            inserted = create_devices(list(new_devices.values()))
+            moves += [(None, new_devices[serial].fleet_key()) for serial in inserted]
+            for serial, pk, *fleet_key in Device.objects.select_for_update().filter(serial_number__in=new_devices).values_list(
+                    'serial_number', 'pk', 'firmware_id', 'hardware_revision_key'):
+                devices[serial] = pk
+                fleet_keys[pk] = tuple(fleet_key)
+
+        histories = []
+        updates = {}
+        for i, item, data in accepted:
+            history = History(device_id=devices[str(item["device"])], firmware_id=firmware_ids.get((item.get("firmware"), item["hardware_revision"])), **data)
+            histories.append(history)
+            results[i] = {"status": status.HTTP_201_CREATED}
+            if history.fw_update_success:
+                # The most recent successful update of a device decides its state
+                current = updates.get(history.device_id)
+                if current is None or history.fw_update_started >= current.fw_update_started:
+                    updates[history.device_id] = history
+        History.objects.bulk_create(histories)
+        RolloutStats.record(histories)
+
+        # One UPDATE for all devices that end up in the same state
+        groups = {}
+        for device_id, history in updates.items():
+            moves.append((fleet_keys[device_id], (history.firmware_id, hardware_revision_key(history.hardware_revision))))
+            values = (history.firmware_id, history.fw_update_started) + tuple(getattr(history, field) for field in DEVICE_FIELDS)
+            groups.setdefault(values, []).append(device_id)
+        for values, device_ids in groups.items():
+            device_values = dict(zip(DEVICE_FIELDS, values[2:]))
+            Device.objects.filter(pk__in=device_ids).update(firmware_id=values[0], last_update=values[1],
+                hardware_revision_key=hardware_revision_key(device_values["hardware_revision"]), **device_values)
+        FleetCounter.move_many(moves)
+    return results
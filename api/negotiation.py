@@ -0,0 +1,34 @@
+def parse_accept_encoding(header):
+    """
+    Map of content coding to its quality value from an Accept-Encoding header.
+    """
+    accepted = {}
+    for part in (header or '').split(','):
+        params = [p.strip() for p in part.split(';')]
+        coding = params[0].lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    return accepted
+
+
+def preferred_encoding(header, available):
+    """
+    The content coding to send, out of available in order of preference, or None for the
+    unencoded representation.
+    """
+    accepted = parse_accept_encoding(header)
+    best, best_quality = None, 0.0
+    for coding in available:
+        quality = accepted.get(coding, accepted.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
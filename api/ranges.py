@@ -0,0 +1,42 @@
+import re
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(header, size):
+    """
+    Parse a Range header against a representation of size bytes.
+
+    Returns an inclusive (start, end) tuple, or None when the whole representation
+    should be sent: no header, a header we can't parse or a multi range request.
+    Raises RangeNotSatisfiable when the range lies outside the representation.
+    """
+    if not header:
+        return None
+
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        # Multiple ranges or another unit, serving the full representation is always allowed
+        return None
+
+    first, last = match.groups()
+    if first == '' and last == '':
+        return None
+    if first == '':
+        # Suffix range, the last N bytes
+        suffix_length = int(last)
+        if suffix_length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return (max(size - suffix_length, 0), size - 1)
+
+    start = int(first)
+    if last != '' and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    end = int(last) if last != '' else size - 1
+    return (start, min(end, size - 1))
@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+from app.models import Firmware, normalize_hw_rev
+from rest_framework.renderers import JSONRenderer
+from .serializers import FirmwareVersionSerializer
+import hashlib
+import threading
+import time
+
+
+def build_latest_version(hw_rev):
+    """
+    The latest_fw_version response of a hardware revision, with the JSON body already rendered.
+    etag is None when there is no firmware for it.
+    """
+    latest_fw = Firmware.get_latest_fw_object(Firmware, hw_rev)
+    if latest_fw is None:
+        return {'created': time.time(), 'etag': None, 'data': None, 'body': b""}
+    data = FirmwareVersionSerializer(instance=latest_fw).data
+    return {'created': time.time(), 'etag': latest_fw.version_etag, 'data': dict(data), 'body': JSONRenderer().render(data)}
+
+
+def _revalidate_in_thread(func, *args):
+    def run():
+        try:
+            func(*args)
+        finally:
+            # The thread ends here, its connections would be left open otherwise
+            connections.close_all()
+    threading.Thread(target=run, daemon=True).start()
+
+
+class LatestVersionCache:
+    """
+    latest_fw_version responses per hardware revision in a Django cache, shared by the workers
+    unless it is a local memory cache. Entries are fresh for timeout seconds, for stale seconds
+    more they are still served while one worker builds the entry again in the background.
+    The Firmware signal handlers in app/signals.py remove the entries of changed revisions.
+    """
+    prefix = 'latest_fw_version:'
+
+    def __init__(self, cache, timeout, stale=0, revalidate=_revalidate_in_thread):
+        self.cache = cache
+        self.timeout = timeout
+        self.stale = stale
+        self.revalidate_later = revalidate
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def key(self, hw_rev):
+        # Hardware revisions may contain characters cache keys can't
+        return self.prefix + hashlib.sha256(normalize_hw_rev(hw_rev).encode()).hexdigest()
+
+    def get(self, hw_rev):
+        key = self.key(hw_rev)
+        entry = self.cache.get(key)
+        if entry is not None:
+            age = time.time() - entry['created']
+            if age < self.timeout:
+                self._count('hits')
+                return entry
+            if age < self.timeout + self.stale:
+                self._count('stale_hits')
+                # Only one worker rebuilds the entry, the lock expires in case it dies meanwhile
+                if self.cache.add(key + ':revalidating', True, max(self.timeout, 1)):
+                    self.revalidate_later(self.revalidate, hw_rev)
+                return entry
+        self._count('misses')
+        entry = build_latest_version(hw_rev)
+        self.cache.set(key, entry, self.timeout + self.stale)
+        return entry
+
+    def revalidate(self, hw_rev):
+        key = self.key(hw_rev)
+        try:
+            self.cache.set(key, build_latest_version(hw_rev), self.timeout + self.stale)
+            self._count('revalidations')
+        finally:
+            self.cache.delete(key + ':revalidating')
+
+    def invalidate(self, hw_rev):
+        self.cache.delete(self.key(hw_rev))
+        self._count('invalidations')
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        requests = self.hits + self.stale_hits + self.misses
+        return {
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'hit_ratio': (self.hits + self.stale_hits) / requests if requests else None,
+            'revalidations': self.revalidations,
+            'invalidations': self.invalidations,
+        }
+
+
+_version_cache = None
+_version_cache_lock = threading.Lock()
+
+def get_latest_version_cache():
+    """
+    The cache of latest_fw_version responses, or None when LATEST_FW_CACHE_TIMEOUT is 0.
+    """
+    global _version_cache
+    timeout = getattr(settings, 'LATEST_FW_CACHE_TIMEOUT', 0)
+    if not timeout:
+        return None
+    with _version_cache_lock:
+        if _version_cache is None:
+            _version_cache = LatestVersionCache(caches[getattr(settings, 'LATEST_FW_CACHE_ALIAS', 'default')], timeout,
+                getattr(settings, 'LATEST_FW_CACHE_STALE', 0))
+        return _version_cache
+
+
+@receiver(setting_changed)
+def reset_latest_version_cache(setting, **kwargs):
+    global _version_cache
+    if setting.startswith('LATEST_FW_CACHE') or setting == 'CACHES':
+        _version_cache = None
+
+
+def latest_version(hw_rev):
+    """
+    The latest_fw_version response of a hardware revision, from the cache when it is enabled.
+    """
+    version_cache = get_latest_version_cache()
+    if version_cache is None:
+        return build_latest_version(hw_rev)
+    return version_cache.get(hw_rev)
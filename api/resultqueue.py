@@ -0,0 +1,157 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class QueueFull(Exception):
+    pass
+
+
+class ResultQueue:
+    """
+    Durable write-behind queue of FOTA results in a local SQLite file. The API appends validated
+    results and answers right away, a worker (manage.py results_queue drain) stores them in
+    History and Device in batches.
+
+    Results are removed only after their batch has been committed, so they are stored at least
+    once. Results the worker can't store are kept as failed until they are replayed.
+    """
+
+    def __init__(self, path, max_items):
+        self.path = str(path)
+        self.max_items = max_items
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, enqueued REAL NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, errors TEXT)"
+            )
+
+    def connect(self):
+        # A connection per call, SQLite connections can't be shared between threads
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        # Don't lose accepted results on power loss
+        db.execute("PRAGMA synchronous=FULL")
+        return _Connection(db)
+
+    def put(self, items):
+        """
+        Append results to the queue, raises QueueFull when they don't fit.
+        """
+        now = time.time()
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                pending = db.execute("SELECT COUNT(*) FROM results WHERE failed = 0").fetchone()[0]
+                if pending + len(items) > self.max_items:
+                    raise QueueFull("{} results pending".format(pending))
+                db.executemany("INSERT INTO results (payload, enqueued) VALUES (?, ?)",
+                    [(json.dumps(item, default=str), now) for item in items])
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def pending(self, limit):
+        with self.connect() as db:
+            rows = db.execute("SELECT id, payload FROM results WHERE failed = 0 ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(pk, json.loads(payload)) for pk, payload in rows]
+
+    def drain_batch(self, ingest, batch_size):
+        """
+        Store the oldest pending results with ingest, see api.ingest.ingest_results. Returns the
+        number of results taken off the queue.
+        """
+        batch = self.pending(batch_size)
+        if not batch:
+            return 0
+        ids = [pk for pk, _ in batch]
+        try:
+            results = ingest([item for _, item in batch])
+        except Exception:
+            # The database is unavailable or similar, try again with the next drain
+            with self.connect() as db:
+                db.executemany("UPDATE results SET attempts = attempts + 1 WHERE id = ?", [(pk,) for pk in ids])
+            raise
+
+        failed = [(json.dumps(result.get("errors"), default=str), pk) for pk, result in zip(ids, results) if result["status"] >= 400]
+        with self.connect() as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany("UPDATE results SET failed = 1, errors = ?, attempts = attempts + 1 WHERE id = ?", failed)
+            db.execute("DELETE FROM results WHERE failed = 0 AND id IN ({})".format(",".join("?" * len(ids))), ids)
+            db.execute("COMMIT")
+        return len(batch)
+
+    def failed(self, limit=100):
+        with self.connect() as db:
+            rows = db.execute("SELECT id, payload, errors, attempts FROM results WHERE failed = 1 ORDER BY id LIMIT ?", (limit,)).fetchall()
+        return [(pk, json.loads(payload), json.loads(errors), attempts) for pk, payload, errors, attempts in rows]
+
+    def replay(self, ids=None):
+        """
+        Put failed results, all of them or the given ids, back in line for the worker.
+        """
+        with self.connect() as db:
+            if ids is None:
+                return db.execute("UPDATE results SET failed = 0, errors = NULL WHERE failed = 1").rowcount
+            return sum(db.execute("UPDATE results SET failed = 0, errors = NULL WHERE failed = 1 AND id = ?", (pk,)).rowcount for pk in ids)
+
+    def discard_failed(self):
+        with self.connect() as db:
+            return db.execute("DELETE FROM results WHERE failed = 1").rowcount
+
+    def stats(self):
+        with self.connect() as db:
+            pending, oldest = db.execute("SELECT COUNT(*), MIN(enqueued) FROM results WHERE failed = 0").fetchone()
+            failed = db.execute("SELECT COUNT(*) FROM results WHERE failed = 1").fetchone()[0]
+        return {
+            'pending': pending,
+            'failed': failed,
+            'max_items': self.max_items,
+            'oldest_age': time.time() - oldest if oldest is not None else 0,
+        }
+
+
+class _Connection:
+    # sqlite3 connections used as context managers commit but don't close
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self.db
+
+    def __exit__(self, *exc_info):
+        self.db.close()
+
+
+_result_queue = None
+_result_queue_lock = threading.Lock()
+
+def get_result_queue():
+    """
+    The queue in POST_RESULTS_QUEUE_PATH, or None when results are stored synchronously.
+    """
+    global _result_queue
+    path = getattr(settings, 'POST_RESULTS_QUEUE_PATH', '')
+    if not path:
+        return None
+    with _result_queue_lock:
+        if _result_queue is None:
+            _result_queue = ResultQueue(path, getattr(settings, 'POST_RESULTS_QUEUE_MAX', 100000))
+        return _result_queue
+
+
+@receiver(setting_changed)
+def reset_result_queue(setting, **kwargs):
+    global _result_queue
+    if setting in ('POST_RESULTS_QUEUE_PATH', 'POST_RESULTS_QUEUE_MAX'):
+        _result_queue = None
@@ -1,4 +1,5 @@
-from app.models import Firmware, History, Device
+from django.db import transaction
+from app.models import Firmware, FleetCounter, History, Device, RolloutStats, hardware_revision_key
 from rest_framework import serializers
 import logging
 
@@ -26,13 +27,37 @@ class HistorySerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         instance = History.objects.create(**validated_data)
+        RolloutStats.record([instance])
         if instance.fw_update_success:
-            try:
-                Device.objects.filter(serial_number=instance.device.serial_number).update(
-                    firmware=instance.firmware, last_update=instance.fw_update_started, manufacturer_name=instance.manufacturer_name,
-                    model_number=instance.model_number, hardware_revision=instance.hardware_revision, software_revision=instance.software_revision)
-            except:
-                logger.warning("Device with serial number {} does not exist! Creating device in Views must have failed.".format(instance.device.serial_number))
+            # By primary key, and by id so the firmware is not fetched
+            devices = Device.objects.filter(pk=instance.device_id)
+            after = (instance.firmware_id, hardware_revision_key(instance.hardware_revision))
+            values = dict(firmware_id=after[0], last_update=instance.fw_update_started, manufacturer_name=instance.manufacturer_name,
+                model_number=instance.model_number, hardware_revision=instance.hardware_revision, software_revision=instance.software_revision,
+                hardware_revision_key=after[1])
+            # Only if the device is still what it was loaded as, so the fleet counters move it from the right firmware
+            before = getattr(instance.device, '_counted_as', None)
+            updated = before is not None and devices.filter(firmware_id=before[0], hardware_revision_key=before[1]).update(**values)
+            if not updated:
+                # Changed by another request meanwhile
+                with transaction.atomic():
+                    before = devices.select_for_update().values_list('firmware_id', 'hardware_revision_key').first()
+                    updated = before is not None and devices.update(**values)
+            if updated:
+                FleetCounter.move(tuple(before), after)
+                instance.device._counted_as = after
+            else:
+                logger.warning("Device {} does not exist! Creating device in Views must have failed.".format(instance.device_id))
 
         return instance
 
+
+class HistoryBatchSerializer(serializers.ModelSerializer):
+    """
+    One result of a batch, the device and firmware are resolved for the whole batch at once.
+    """
+
+    class Meta:
+        model = History
+        fields = ['fw_update_started', 'fw_update_success', 'device_firmware', 'reason', 'manufacturer_name',
+        'model_number', 'hardware_revision', 'software_revision']
@@ -0,0 +1,17 @@
+from django.db import transaction
+from django.dispatch import receiver
+from app.signals import latest_firmware_changed
+from .responsecache import get_latest_version_cache
+
+
+@receiver(latest_firmware_changed)
+def invalidate_latest_version(sender, hw_revisions, **kwargs):
+    version_cache = get_latest_version_cache()
+    if version_cache is None:
+        return
+    def invalidate():
+        for hw_rev in hw_revisions:
+            version_cache.invalidate(hw_rev)
+    # Once more after the commit, a request may have cached the old version meanwhile
+    invalidate()
+    transaction.on_commit(invalidate)
@@ -0,0 +1,121 @@
+from asgiref.sync import async_to_sync
+from django.test import TransactionTestCase
+from django.core.cache import caches
+from django.utils import timezone
+from datetime import timedelta
+from app.models import Device, Firmware, History
+from .asgi import DeviceAPIApplication
+from unittest import mock
+import asyncio
+import json
+import jwt
+import os
+
+
+class DeviceAPIApplicationTestCase(TransactionTestCase):
+    def setUp(self):
+        # Cached versions outlive the rolled back firmware of earlier tests
+        caches['default'].clear()
+        now = timezone.now()
+        self.data = b"some dummy bcode data: \x00\x01\x02" * 10
+        self.fw = Firmware.objects.create(fw_version="2.1.0", hw_compability="v5", date_added=now, file_name="fw_file.cyacd2", file=self.data)
+        self.token = jwt.encode({"jti": 1122, "token_type": "access", "exp": now + timedelta(minutes=10), "user_id": 54321, "hw_rev": "v5"}, os.environ['SIGNING_KEY'], algorithm="HS256", headers={"typ": "JWT"})
+        self.fallback_calls = []
+        async def fallback(scope, receive, send):
+            self.fallback_calls.append(scope['path'])
+        self.application = DeviceAPIApplication(fallback, '/api/')
+
+    def call(self, method, path, body=b"", headers=None, authorized=True, disconnect=False):
+        headers = dict({'host': 'testserver'}, **(headers or {}))
+        if authorized:
+            headers['authorization'] = 'Bearer ' + self.token
+        scope = {
+            'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'root_path': '',
+            'headers': [(name.encode(), value.encode()) for name, value in headers.items()],
+        }
+        messages = [{'type': 'http.request', 'body': body}]
+        sent = []
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            if disconnect:
+                return {'type': 'http.disconnect'}
+            # The client stays connected
+            await asyncio.Event().wait()
+        async def send(message):
+            sent.append(message)
+        async_to_sync(self.application)(scope, receive, send)
+        if not sent:
+            return None, {}, b""
+        response_headers = {name.decode(): value.decode() for name, value in sent[0]['headers']}
+        return sent[0]['status'], response_headers, b"".join(message.get('body', b"") for message in sent[1:])
+
+    def test_latest_fw_version(self):
+        status, headers, body = self.call('GET', '/api/latest_fw_version/')
+        self.assertEqual(200, status)
+        self.assertEqual({"fw_version": "2.1.0"}, json.loads(body))
+        status, _, _ = self.call('GET', '/api/latest_fw_version/', headers={'if-none-match': headers['ETag']})
+        self.assertEqual(304, status)
+        status, _, _ = self.call('GET', '/api/latest_fw_version/', authorized=False)
+        self.assertEqual(401, status)
+        status, _, _ = self.call('POST', '/api/latest_fw_version/')
+        self.assertEqual(405, status)
+
+    def test_download(self):
+        with self.settings(FIRMWARE_CHUNK_SIZE=16):
+            status, headers, body = self.call('GET', '/api/dl_latest_fw/')
+        self.assertEqual(200, status)
+        self.assertEqual(self.data, body)
+        self.assertEqual(str(len(self.data)), headers['Content-Length'])
+
+        # Reading stops when the device goes away
+        with self.settings(FIRMWARE_CHUNK_SIZE=16):
+            status, _, body = self.call('GET', '/api/dl_latest_fw/', disconnect=True)
+        self.assertEqual(200, status)
+        self.assertLess(len(body), len(self.data))
+
+        status, _, body = self.call('GET', '/api/dl_latest_fw/', headers={'range': 'bytes=0-9'})
+        self.assertEqual(206, status)
+        self.assertEqual(self.data[:10], body)
+
+    def test_post_results(self):
+        result = {
+            "fw_update_started": str(timezone.now()),
+            "device": "12345",
+            "fw_update_success": True,
+            "firmware": "2.1.0",
+            "device_firmware": "1.1.0",
+            "reason": "",
+            "manufacturer_name": "ManufacturerName",
+            "model_number": "ModelNumber",
+            "hardware_revision": "v5",
+            "software_revision": "SWRev",
+        }
+        status, _, _ = self.call('POST', '/api/post_results/', json.dumps(result).encode())
+        self.assertEqual(201, status)
+        self.assertEqual(self.fw, Device.objects.get(serial_number="12345").firmware)
+        self.assertEqual(1, History.objects.count())
+
+        status, _, body = self.call('POST', '/api/post_results/', b'{"device": "12345"}')
+        self.assertEqual(400, status)
+        self.assertEqual("You need to provide all attributes!", json.loads(body))
+
+    def test_download_reads_in_one_thread(self):
+        # One worker thread, and so one database connection, for all chunks, not one per chunk
+        with self.settings(FIRMWARE_CHUNK_SIZE=16), mock.patch('api.asgi.close_old_connections') as close_old_connections:
+            status, _, body = self.call('GET', '/api/dl_latest_fw/', headers={'range': 'bytes=0-{}'.format(len(self.data) - 1)})
+        self.assertEqual(206, status)
+        self.assertEqual(self.data, body)
+        # The view and the reading of the chunks
+        self.assertEqual(2, close_old_connections.call_count)
+
+    def test_invalid_host(self):
+        status, _, _ = self.call('GET', '/api/latest_fw_version/', headers={'host': 'evil.example.com'})
+        self.assertEqual(400, status)
+        status, _, _ = self.call('GET', '/api/dl_latest_fw/', headers={'host': 'evil.example.com'})
+        self.assertEqual(400, status)
+
+    def test_other_paths_go_to_django(self):
+        self.call('POST', '/api/post_results/batch/')
+        self.call('GET', '/login/')
+        self.assertEqual(['/api/post_results/batch/', '/login/'], self.fallback_calls)
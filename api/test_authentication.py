@@ -0,0 +1,84 @@
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from unittest import mock
+from rest_framework import status
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from .authentication import CachedJWTTokenUserAuthentication, VerifiedTokenCache, get_token_cache
+import jwt
+import os
+import time
+
+
+def make_token(exp=None, **claims):
+    exp = exp or timezone.now() + timedelta(minutes=10)
+    return jwt.encode({"jti": 1122, "token_type": "access", "exp": exp, "user_id": 54321, **claims}, os.environ['SIGNING_KEY'], algorithm="HS256", headers={"typ": "JWT"})
+
+
+class VerifiedTokenCacheTestCase(TestCase):
+    def test_lru(self):
+        cache = VerifiedTokenCache(2)
+        exp = time.time() + 60
+        cache.put(b"a", {"exp": exp})
+        cache.put(b"b", {"exp": exp})
+        self.assertIsNotNone(cache.get(b"a"))
+        cache.put(b"c", {"exp": exp})
+        self.assertIsNone(cache.get(b"b"))
+        self.assertIsNotNone(cache.get(b"a"))
+        self.assertIsNotNone(cache.get(b"c"))
+
+    def test_expired_tokens_are_dropped(self):
+        cache = VerifiedTokenCache(2)
+        cache.put(b"a", {"exp": time.time() - 1})
+        self.assertIsNone(cache.get(b"a"))
+        self.assertEqual(0, cache.stats()['entries'])
+
+
+class CachedJWTTokenUserAuthenticationTestCase(TestCase):
+    def setUp(self):
+        get_token_cache().clear()
+
+    def test_token_verified_once(self):
+        raw_token = make_token(hw_rev="v5").encode()
+        authentication = CachedJWTTokenUserAuthentication()
+        calls = []
+        original = JWTTokenUserAuthentication.get_validated_token
+        def counting(self, raw):
+            calls.append(raw)
+            return original(self, raw)
+        with mock.patch.object(JWTTokenUserAuthentication, 'get_validated_token', counting):
+            first = authentication.get_validated_token(raw_token)
+            second = authentication.get_validated_token(raw_token)
+        self.assertEqual(1, len(calls))
+        self.assertIs(first, second)
+        self.assertEqual("v5", second["hw_rev"])
+
+    def test_invalid_token_not_cached(self):
+        authentication = CachedJWTTokenUserAuthentication()
+        for _ in range(2):
+            with self.assertRaises(InvalidToken):
+                authentication.get_validated_token(b"not a token")
+        self.assertEqual(0, get_token_cache().stats()['entries'])
+
+    def test_disabled(self):
+        with self.settings(JWT_TOKEN_CACHE_SIZE=0):
+            self.assertIsNone(get_token_cache())
+            token = CachedJWTTokenUserAuthentication().get_validated_token(make_token(hw_rev="v5").encode())
+        self.assertEqual("v5", token["hw_rev"])
+
+    def test_expired_token_rejected(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + make_token(exp=timezone.now() - timedelta(seconds=1), hw_rev="v5"))
+        response = client.get(reverse('latest_fw_version-list'))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_repeated_polls_hit_cache(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION='Bearer ' + make_token(hw_rev="v5"))
+        hits = get_token_cache().stats()['hits']
+        for _ in range(3):
+            client.get(reverse('latest_fw_version-list'))
+        self.assertEqual(hits + 2, get_token_cache().stats()['hits'])
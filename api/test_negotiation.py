@@ -0,0 +1,20 @@
+from django.test import SimpleTestCase
+from .negotiation import parse_accept_encoding, preferred_encoding
+
+
+class AcceptEncodingTest(SimpleTestCase):
+
+    def test_parse(self):
+        self.assertEqual({}, parse_accept_encoding(None))
+        self.assertEqual({'gzip': 1.0, 'br': 0.5, 'xz': 0.0}, parse_accept_encoding("gzip, br;q=0.5, XZ;q=0"))
+        self.assertEqual({'gzip': 0.0}, parse_accept_encoding("gzip;q=bad"))
+
+    def test_preferred(self):
+        self.assertEqual('xz', preferred_encoding("gzip, xz", ['xz', 'gzip']))
+        self.assertEqual('gzip', preferred_encoding("gzip, xz;q=0.5", ['xz', 'gzip']))
+        self.assertEqual('gzip', preferred_encoding("gzip", ['xz', 'gzip']))
+        self.assertEqual('xz', preferred_encoding("*", ['xz', 'gzip']))
+        self.assertIsNone(preferred_encoding("br", ['xz', 'gzip']))
+        self.assertIsNone(preferred_encoding("gzip;q=0", ['xz', 'gzip']))
+        self.assertIsNone(preferred_encoding(None, ['xz', 'gzip']))
+        self.assertIsNone(preferred_encoding("gzip", []))
@@ -0,0 +1,28 @@
+from django.test import SimpleTestCase
+from .ranges import RangeNotSatisfiable, parse_range_header
+
+
+class ParseRangeHeaderTest(SimpleTestCase):
+
+    def test_no_range(self):
+        self.assertIsNone(parse_range_header(None, 100))
+        self.assertIsNone(parse_range_header("", 100))
+
+    def test_single_range(self):
+        self.assertEqual((0, 9), parse_range_header("bytes=0-9", 100))
+        self.assertEqual((90, 99), parse_range_header("bytes=90-", 100))
+        self.assertEqual((90, 99), parse_range_header("bytes=90-200", 100))
+        self.assertEqual((95, 99), parse_range_header("bytes=-5", 100))
+        self.assertEqual((0, 99), parse_range_header("bytes=-500", 100))
+
+    def test_ignored_ranges(self):
+        self.assertIsNone(parse_range_header("bytes=0-9,20-29", 100))
+        self.assertIsNone(parse_range_header("items=0-9", 100))
+        self.assertIsNone(parse_range_header("bytes=9-0", 100))
+        self.assertIsNone(parse_range_header("bytes=-", 100))
+
+    def test_unsatisfiable(self):
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header("bytes=100-", 100)
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range_header("bytes=-0", 100)
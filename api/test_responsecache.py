@@ -0,0 +1,108 @@
+from django.core.cache import caches
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from app.models import Firmware
+from iz_fota.test_cache import RESPStandIn
+from rest_framework.test import APIClient
+from .responsecache import LatestVersionCache, get_latest_version_cache
+from datetime import timedelta
+from django.utils import timezone
+from unittest import mock
+import jwt
+import os
+
+
+class LatestVersionCacheTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.firmware = Firmware.objects.create(fw_version="1.0.0", hw_compability="v1", date_added=timezone.now() - timedelta(days=1), file_name="fw.cyacd2", file=b"image")
+        self.revalidations = []
+        self.cache = LatestVersionCache(caches['default'], 30, 300, revalidate=lambda func, *args: self.revalidations.append((func, args)))
+
+    def test_miss_then_hit(self):
+        entry = self.cache.get("v1")
+        self.assertEqual(b'{"fw_version":"1.0.0"}', entry['body'])
+        self.assertEqual(self.firmware.version_etag, entry['etag'])
+        with self.assertNumQueries(0):
+            self.assertEqual(entry, self.cache.get("V1 "))
+        self.assertEqual({'hits': 1, 'stale_hits': 0, 'misses': 1, 'hit_ratio': 0.5, 'revalidations': 0, 'invalidations': 0}, self.cache.stats())
+
+    def test_missing_firmware_is_cached_too(self):
+        self.assertIsNone(self.cache.get("v2")['etag'])
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.cache.get("v2")['etag'])
+
+    def test_stale_entry_is_served_while_revalidating(self):
+        entry = self.cache.get("v1")
+        Firmware.objects.filter(pk=self.firmware.pk).update(fw_version="1.0.1")
+        with mock.patch('api.responsecache.time.time', return_value=entry['created'] + 60):
+            self.assertEqual(entry, self.cache.get("v1"))
+            # A single revalidation until it is done
+            self.cache.get("v1")
+        self.assertEqual(1, len(self.revalidations))
+        func, args = self.revalidations[0]
+        func(*args)
+        self.assertEqual(b'{"fw_version":"1.0.1"}', self.cache.get("v1")['body'])
+        stats = self.cache.stats()
+        self.assertEqual(2, stats['stale_hits'])
+        self.assertEqual(1, stats['revalidations'])
+
+    def test_expired_entry_is_rebuilt(self):
+        entry = self.cache.get("v1")
+        with mock.patch('api.responsecache.time.time', return_value=entry['created'] + 400):
+            self.cache.get("v1")
+        self.assertEqual(2, self.cache.stats()['misses'])
+        self.assertEqual([], self.revalidations)
+
+
+@override_settings(LATEST_FW_CACHE_TIMEOUT=30, LATEST_FW_CACHE_STALE=300)
+class LatestVersionInvalidationTestCase(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.firmware = Firmware.objects.create(fw_version="1.0.0", hw_compability="v1", date_added=timezone.now() - timedelta(days=1), file_name="fw.cyacd2", file=b"image")
+        self.client = APIClient()
+        exp_time = timezone.now() + timedelta(minutes=10)
+        token = jwt.encode({"jti": 1, "token_type": "access", "exp": exp_time, "user_id": 1, "hw_rev": "v1"}, os.environ['SIGNING_KEY'], algorithm="HS256", headers={"typ": "JWT"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+
+    def test_response_is_served_from_the_cache(self):
+        response = self.client.get(reverse('latest_fw_version-list'))
+        self.assertEqual(b'{"fw_version":"1.0.0"}', response.content)
+        self.assertEqual('application/json', response['Content-Type'])
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('latest_fw_version-list'))
+        self.assertEqual({"fw_version": "1.0.0"}, response.data)
+        self.assertEqual(self.firmware.version_etag, response['ETag'])
+        self.assertEqual(1, get_latest_version_cache().stats()['hits'])
+
+    def test_new_firmware_invalidates(self):
+        self.client.get(reverse('latest_fw_version-list'))
+        Firmware.objects.create(fw_version="2.0.0", hw_compability="V1", date_added=timezone.now(), file_name="fw2.cyacd2", file=b"image 2")
+        self.assertEqual({"fw_version": "2.0.0"}, self.client.get(reverse('latest_fw_version-list')).data)
+
+    def test_edited_hw_revision_invalidates_both(self):
+        self.client.get(reverse('latest_fw_version-list'))
+        self.firmware.hw_compability = "v2"
+        self.firmware.save()
+        self.assertEqual(204, self.client.get(reverse('latest_fw_version-list')).status_code)
+
+    def test_deleted_firmware_invalidates(self):
+        self.client.get(reverse('latest_fw_version-list'))
+        self.firmware.delete()
+        self.assertEqual(204, self.client.get(reverse('latest_fw_version-list')).status_code)
+
+    def test_shared_cache_server(self):
+        server = RESPStandIn()
+        self.addCleanup(server.stop)
+        with self.settings(CACHES={'default': {'BACKEND': 'iz_fota.cache.resp.RESPCache', 'LOCATION': server.location}}):
+            self.assertEqual({"fw_version": "1.0.0"}, self.client.get(reverse('latest_fw_version-list')).data)
+            self.assertEqual(1, len(server.data))
+            with self.assertNumQueries(0):
+                self.assertEqual(b'{"fw_version":"1.0.0"}', self.client.get(reverse('latest_fw_version-list')).content)
+            self.firmware.delete()
+            self.assertEqual(204, self.client.get(reverse('latest_fw_version-list')).status_code)
+
+    @override_settings(LATEST_FW_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        self.assertIsNone(get_latest_version_cache())
+        self.assertEqual({"fw_version": "1.0.0"}, self.client.get(reverse('latest_fw_version-list')).data)
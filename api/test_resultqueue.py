@@ -0,0 +1,126 @@
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from datetime import timedelta
+from app.models import Device, Firmware, History
+from rest_framework import status
+from rest_framework.test import APIClient
+from .resultqueue import QueueFull, ResultQueue, get_result_queue
+from io import StringIO
+from unittest import mock
+import jwt
+import os
+import shutil
+import tempfile
+
+
+class ResultQueueTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.queue = ResultQueue(os.path.join(self.tmp, 'results.sqlite3'), max_items=3)
+
+    def test_put_and_drain(self):
+        self.queue.put([{"device": "1"}, {"device": "2"}])
+        self.assertEqual(2, self.queue.stats()['pending'])
+        batches = []
+        def ingest(items):
+            batches.append(items)
+            return [{"status": 201}, {"status": 400, "errors": "bad"}]
+        self.assertEqual(2, self.queue.drain_batch(ingest, 10))
+        self.assertEqual([[{"device": "1"}, {"device": "2"}]], batches)
+        self.assertEqual(0, self.queue.stats()['pending'])
+        failed = self.queue.failed()
+        self.assertEqual([({"device": "2"}, "bad", 1)], [row[1:] for row in failed])
+
+        self.assertEqual(1, self.queue.replay())
+        self.assertEqual(1, self.queue.stats()['pending'])
+        self.assertEqual(0, self.queue.stats()['failed'])
+
+    def test_ingest_failure_keeps_results(self):
+        self.queue.put([{"device": "1"}])
+        def ingest(items):
+            raise RuntimeError("database is down")
+        with self.assertRaises(RuntimeError):
+            self.queue.drain_batch(ingest, 10)
+        self.assertEqual([(1, {"device": "1"})], self.queue.pending(10))
+
+    def test_backpressure(self):
+        self.queue.put([{"device": "1"}, {"device": "2"}])
+        with self.assertRaises(QueueFull):
+            self.queue.put([{"device": "3"}, {"device": "4"}])
+        # Nothing of the rejected batch is queued
+        self.assertEqual(2, self.queue.stats()['pending'])
+        self.queue.put([{"device": "3"}])
+        self.assertEqual(3, self.queue.stats()['pending'])
+
+
+class QueuedPostResultsTestCase(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+        settings = override_settings(POST_RESULTS_QUEUE_PATH=os.path.join(self.tmp, 'results.sqlite3'), POST_RESULTS_QUEUE_MAX=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        now = timezone.now()
+        self.fw = Firmware.objects.create(fw_version="2.1.0", hw_compability="v5", date_added=now, file_name="fw_file.cyacd2", file=b"data")
+        self.client = APIClient()
+        token = jwt.encode({"jti": 1122, "token_type": "access", "exp": now + timedelta(minutes=10), "user_id": 54321, "hw_rev": "v5"}, os.environ['SIGNING_KEY'], algorithm="HS256", headers={"typ": "JWT"})
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + token)
+
+    def result(self, serial):
+        return {
+            "fw_update_started": str(timezone.now()),
+            "device": serial,
+            "fw_update_success": "true",
+            "firmware": "2.1.0",
+            "device_firmware": "1.1.0",
+            "reason": "",
+            "manufacturer_name": "ManufacturerName",
+            "model_number": "ModelNumber",
+            "hardware_revision": "v5",
+            "software_revision": "SWRev",
+        }
+
+    def test_post_results_queued(self):
+        response = self.client.post(reverse('post_results-list'), self.result("12345"), format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(0, History.objects.count())
+
+        response = self.client.post(reverse('post_results-list'), {"device": "12345"}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        out = StringIO()
+        call_command('results_queue', 'drain', stdout=out)
+        self.assertIn("Drained 1 result(s)", out.getvalue())
+        self.assertEqual(1, History.objects.count())
+        self.assertEqual(self.fw, Device.objects.get(serial_number="12345").firmware)
+
+        out = StringIO()
+        call_command('results_queue', 'status', stdout=out)
+        self.assertIn("0 pending", out.getvalue())
+
+    def test_post_results_batch_queued(self):
+        response = self.client.post(reverse('post_results-batch'), [self.result("1"), {"device": "2"}], format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([202, 400], [result["status"] for result in response.data])
+        self.assertEqual(1, get_result_queue().stats()['pending'])
+
+    def test_post_results_queue_full(self):
+        response = self.client.post(reverse('post_results-batch'), [self.result("1"), self.result("2")], format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        response = self.client.post(reverse('post_results-list'), self.result("3"), format='json')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.get('Retry-After'), '30')
+
+    def test_drain_follow_drops_dead_connections(self):
+        with mock.patch.object(ResultQueue, 'drain_batch', side_effect=[OperationalError("server closed the connection"), 1, KeyboardInterrupt]), \
+                mock.patch('app.management.commands.results_queue.close_old_connections') as close_old_connections, \
+                mock.patch('app.management.commands.results_queue.time.sleep'):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('results_queue', 'drain', '--follow', stdout=StringIO(), stderr=StringIO())
+        # Before every batch and after the failed one
+        self.assertEqual(4, close_old_connections.call_count)
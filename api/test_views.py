@@ -1,20 +1,41 @@
 from api.views import DownloadLatestFirmwareViewSet, LatestFirmwareViewSet
 from rest_framework import status
 from django.urls import reverse
-from app.models import Firmware, Device, History
-from .serializers import FirmwareVersionSerializer
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from app.delta import apply_delta
+from app.models import Firmware, FirmwareDelta, FirmwareEncoding, Device, FleetCounter, History
+from .ingest import create_devices
+from .serializers import FirmwareVersionSerializer, HistorySerializer
 from datetime import timedelta
+from django.core.cache import caches
 from django.utils import timezone
 from rest_framework.test import APIClient, APITestCase
-from io import BytesIO
+from io import BytesIO, StringIO
+from unittest import mock
+import base64
+import gzip
+import hashlib
 import jwt
+import lzma
 import os
+import shutil
+import tempfile
+
+
+def firmware_file_column():
+    # Fully qualified and quoted column name of the firmware image, as it appears in selects
+    return "{}.{}".format(connection.ops.quote_name(Firmware._meta.db_table), connection.ops.quote_name('file'))
 
 
 class LatestFirmwareViewSetTest(APITestCase):
     """ Test module for GET latest firmware API """
 
     def setUp(self):
+        # Cached versions outlive the rolled back firmware of earlier tests
+        caches['default'].clear()
         now = timezone.now()
         self.hw_rev = "v5"
         self.fw1 = Firmware.objects.create(fw_version="1.1.0", hw_compability=self.hw_rev, date_added=(now - timedelta(days=10)), file_name="fw_file_v1.1.0.cyacd2", file=bytes("file_1.1.0_hw_v5_data",'utf-8'))
@@ -45,6 +66,38 @@ class LatestFirmwareViewSetTest(APITestCase):
         self.assertEqual(response.data, serializer.data)
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_get_latest_firmware_version_does_not_select_file(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('latest_fw_version-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for query in queries.captured_queries:
+            self.assertNotIn(firmware_file_column(), query['sql'])
+
+    def test_get_latest_firmware_version_etag(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.get(reverse('latest_fw_version-list'))
+        etag = response.get('ETag')
+        self.assertEqual(etag, Firmware.objects.get(pk=self.fw3.pk).version_etag)
+
+        response = self.client.get(reverse('latest_fw_version-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.get('ETag'), etag)
+
+        # A new release changes the ETag
+        Firmware.objects.create(fw_version="4.0.0", hw_compability=self.hw_rev, date_added=timezone.now(), file_name="fw_file_v4.0.0.cyacd2", file=bytes("file_4.0.0_hw_v5_data",'utf-8'))
+        response = self.client.get(reverse('latest_fw_version-list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"fw_version": "4.0.0"})
+        self.assertNotEqual(response.get('ETag'), etag)
+
+    def test_head_latest_firmware_version(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.head(reverse('latest_fw_version-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response.get('ETag'), Firmware.objects.get(pk=self.fw3.pk).version_etag)
+
     def test_get_latest_firmware_version_unauthorized_SE02(self):
         ''' Requirement SE-02: Test that unauthorized client cannot access endpoint'''
         response = self.client.get(reverse('latest_fw_version-list'))
@@ -131,12 +184,247 @@ class DownloadLatestFirmwareViewSetTest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEquals(response.get('Content-Disposition'),"attachment; filename=" + self.fw2.fw_version + ".cyacd2")
         try:
-            f = BytesIO(response.content)
+            f = BytesIO(b"".join(response.streaming_content))
             self.assertEqual(f.getbuffer().nbytes, self.testfilelen2)
             self.assertEqual(f.getbuffer(), self.testfile2.getbuffer())
         finally:
             f.close()
 
+    def test_download_latest_firmware_in_chunks(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with self.settings(FIRMWARE_CHUNK_SIZE=4):
+            response = self.client.get(reverse('dl_latest_fw-list'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.streaming)
+            self.assertEqual(response.get('Content-Length'), str(self.testfilelen2))
+            chunks = list(response.streaming_content)
+        self.assertTrue(all(len(chunk) <= 4 for chunk in chunks))
+        self.assertEqual(b"".join(chunks), self.testfile2.getvalue())
+
+    def test_download_latest_firmware_range(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        data = self.testfile2.getvalue()
+
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-9')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response.get('Content-Range'), "bytes 5-9/{}".format(self.testfilelen2))
+        self.assertEqual(response.get('Content-Length'), "5")
+        self.assertEqual(b"".join(response.streaming_content), data[5:10])
+
+        # Open ended and suffix ranges
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), data[20:])
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=-3')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b"".join(response.streaming_content), data[-3:])
+
+        # Range past the end of the image
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response.get('Content-Range'), "bytes */{}".format(self.testfilelen2))
+
+        # Multiple ranges are answered with the full image
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=0-1,3-4')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get('Accept-Ranges'), "bytes")
+        self.assertEqual(b"".join(response.streaming_content), data)
+
+    def test_download_latest_firmware_if_range(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.get(reverse('dl_latest_fw-list'))
+        last_modified = response.get('Last-Modified')
+
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-', HTTP_IF_RANGE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+
+        # Firmware changed since the first part was downloaded, start over
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-', HTTP_IF_RANGE='Thu, 01 Jan 1970 00:00:00 GMT')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b"".join(response.streaming_content), self.testfile2.getvalue())
+
+    def test_download_latest_firmware_etag(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        digest = hashlib.sha256(self.testfile2.getvalue()).hexdigest()
+        response = self.client.get(reverse('dl_latest_fw-list'))
+        self.assertEqual(response.get('ETag'), '"{}"'.format(digest))
+        self.assertEqual(response.get('Digest'), 'sha-256=' + base64.b64encode(bytes.fromhex(digest)).decode())
+
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_IF_NONE_MATCH='"other", W/"{}"'.format(digest))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b"")
+
+        # If-Range with the ETag resumes the download
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-', HTTP_IF_RANGE='"{}"'.format(digest))
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_head_download_latest_firmware(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.head(reverse('dl_latest_fw-list'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(response.get('Content-Length'), str(self.testfilelen2))
+        self.assertEqual(response.get('ETag'), '"{}"'.format(hashlib.sha256(self.testfile2.getvalue()).hexdigest()))
+        for query in queries.captured_queries:
+            self.assertNotIn(firmware_file_column(), query['sql'])
+
+    def test_download_latest_firmware_from_filesystem(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with self.settings(FIRMWARE_STORAGE_ROOT=root):
+            self.fw2.set_file(self.fw2.file_name, self.testfile2.getvalue(), storage='fs')
+            self.fw2.save()
+            self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+
+            response = self.client.get(reverse('dl_latest_fw-list'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.get('Content-Length'), str(self.testfilelen2))
+            self.assertEqual(response.get('Content-Type'), 'application/octet-stream')
+            self.assertEqual(response.get('Content-Disposition'), "attachment; filename=" + self.fw2.fw_version + ".cyacd2")
+            self.assertEqual(b"".join(response.streaming_content), self.testfile2.getvalue())
+            response.close()
+
+            response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-9')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b"".join(response.streaming_content), self.testfile2.getvalue()[5:10])
+
+            with self.settings(FIRMWARE_SENDFILE='x-accel-redirect', FIRMWARE_ACCEL_REDIRECT_PREFIX='/internal/fw/'):
+                response = self.client.get(reverse('dl_latest_fw-list'))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.get('X-Accel-Redirect').startswith('/internal/fw/'))
+            self.assertEqual(response.content, b"")
+
+    def test_download_latest_firmware_from_shared_cache(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with self.settings(FIRMWARE_SHARED_CACHE_PATH=path):
+            response = self.client.get(reverse('dl_latest_fw-list'))
+            self.assertEqual(b"".join(response.streaming_content), self.testfile2.getvalue())
+            response = self.client.get(reverse('dl_latest_fw-list'), HTTP_RANGE='bytes=5-9')
+            self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+            self.assertEqual(b"".join(response.streaming_content), self.testfile2.getvalue()[5:10])
+
+    @override_settings(FIRMWARE_DELTA_MAX_SOURCES=5)
+    def test_download_latest_firmware_delta(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        source = b"".join(":{:08X}00\n".format(i).encode() for i in range(200))
+        target = source.replace(b":0000000A00", b":0000000AFF")
+        Firmware.objects.filter(pk=self.fw2.pk).delete()
+        self.fw1.set_file(self.fw1.file_name, source)
+        self.fw1.save()
+        fw3 = Firmware.objects.create(fw_version="3.0.0", hw_compability=self.hw_rev, date_added=timezone.now(), file_name="fw_file3.cyacd2", file=target)
+
+        # Full image until the delta has been built ahead
+        response = self.client.get(reverse('dl_latest_fw-list'), {'from_version': '1.1.0', 'delta': '1'})
+        self.assertIsNone(response.get('X-Delta-Source'))
+        self.assertEqual(b"".join(response.streaming_content), target)
+        self.assertFalse(FirmwareDelta.objects.exists())
+        call_command('build_firmware_deltas', stdout=StringIO())
+
+        response = self.client.get(reverse('dl_latest_fw-list'), {'from_version': '1.1.0', 'delta': '1'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get('X-Delta-Source'), '1.1.0')
+        self.assertEqual(response.get('X-Firmware-SHA256'), hashlib.sha256(target).hexdigest())
+        self.assertEqual(response.get('Content-Disposition'), "attachment; filename=1.1.0-3.0.0.delta")
+        self.assertEqual(apply_delta(source, response.content), target)
+        self.assertLess(len(response.content), len(target) // 10)
+        delta_etag = response.get('ETag')
+
+        response = self.client.get(reverse('dl_latest_fw-list'), {'from_version': '1.1.0', 'delta': '1'}, HTTP_IF_NONE_MATCH=delta_etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Resuming the delta needs an If-Range naming it, a Range without one continues the full image
+        response = self.client.get(reverse('dl_latest_fw-list'), {'from_version': '1.1.0', 'delta': '1'}, HTTP_RANGE='bytes=5-9', HTTP_IF_RANGE=delta_etag)
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response.get('X-Delta-Source'), '1.1.0')
+        response = self.client.get(reverse('dl_latest_fw-list'), {'from_version': '1.1.0', 'delta': '1'}, HTTP_RANGE='bytes=5-9')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertIsNone(response.get('X-Delta-Source'))
+        self.assertEqual(b"".join(response.streaming_content), target[5:10])
+
+        # Devices that don't ask for a delta, or run an unknown version, get the full image
+        for params in [{'from_version': '1.1.0'}, {'from_version': '0.0.1', 'delta': '1'}]:
+            response = self.client.get(reverse('dl_latest_fw-list'), params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertIsNone(response.get('X-Delta-Source'))
+            self.assertEqual(b"".join(response.streaming_content), target)
+
+    def test_download_latest_firmware_compressed(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        data = b"".join(":{:08X}00\n".format(i % 16).encode() for i in range(500))
+        self.fw2.set_file(self.fw2.file_name, data)
+        self.fw2.save()
+        with self.settings(FIRMWARE_SERVE_ENCODINGS=True):
+            self.check_compressed_responses(data)
+
+    def check_compressed_responses(self, data):
+
+        # The smallest encoding wins when the client accepts several equally
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip, xz')
+        smallest = min(FirmwareEncoding.objects.filter(firmware=self.fw2), key=lambda encoding: encoding.size)
+        self.assertEqual(response.get('Content-Encoding'), smallest.encoding)
+
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='xz')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.get('Content-Encoding'), 'xz')
+        self.assertIn('Accept-Encoding', response.get('Vary'))
+        self.assertEqual(response.get('X-Firmware-SHA256'), hashlib.sha256(data).hexdigest())
+        self.assertEqual(response.get('Content-Disposition'), "attachment; filename=" + self.fw2.fw_version + ".cyacd2")
+        self.assertEqual(lzma.decompress(response.content), data)
+
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip, xz;q=0')
+        self.assertEqual(response.get('Content-Encoding'), 'gzip')
+        self.assertEqual(gzip.decompress(response.content), data)
+        etag = response.get('ETag')
+
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Ranges apply to the compressed bytes
+        response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip', HTTP_RANGE='bytes=0-9')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response.content, gzip.compress(data, compresslevel=9, mtime=0)[:10])
+
+        # Identity for clients that don't ask for a coding
+        response = self.client.get(reverse('dl_latest_fw-list'))
+        self.assertIsNone(response.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', response.get('Vary'))
+        self.assertEqual(b"".join(response.streaming_content), data)
+
+    def test_download_latest_firmware_compressed_opt_in(self):
+        # Almost every HTTP client accepts gzip, by default they still get the streamed or offloaded image
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        data = b"".join(":{:08X}00\n".format(i % 16).encode() for i in range(500))
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        with self.settings(FIRMWARE_STORAGE_ROOT=root):
+            self.fw2.set_file(self.fw2.file_name, data)
+            self.fw2.save()
+            self.assertTrue(FirmwareEncoding.objects.filter(firmware=self.fw2).exists())
+            response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip, deflate, br')
+            self.assertIsNone(response.get('Content-Encoding'))
+            self.assertTrue(response.streaming)
+            self.assertEqual(b"".join(response.streaming_content), data)
+
+            self.fw2.set_file(self.fw2.file_name, data, storage='fs')
+            self.fw2.save()
+            with self.settings(FIRMWARE_SENDFILE='x-accel-redirect', FIRMWARE_ACCEL_REDIRECT_PREFIX='/internal/fw/'):
+                response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip')
+            self.assertIsNone(response.get('Content-Encoding'))
+            self.assertTrue(response.get('X-Accel-Redirect').startswith('/internal/fw/'))
+
+    def test_download_latest_firmware_not_compressed_when_larger(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with self.settings(FIRMWARE_SERVE_ENCODINGS=True):
+            response = self.client.get(reverse('dl_latest_fw-list'), HTTP_ACCEPT_ENCODING='gzip, xz')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIsNone(response.get('Content-Encoding'))
+        self.assertEqual(b"".join(response.streaming_content), self.testfile2.getvalue())
+
     def test_download_latest_firmware_unauthorized_SE02(self):
         ''' Requirement SE-02: Test that unauthorized client cannot access endpoint'''
         response = self.client.get(reverse('dl_latest_fw-list'))
@@ -479,6 +767,80 @@ class PostResultsViewSetTest(APITestCase):
         self.assertEqual(history.software_revision, "sw rev")
 
 
+    def test_post_results_does_not_select_file(self):
+        data = {
+            "fw_update_started": str(self.exp_time),
+            "device": "NewDevice",
+            "fw_update_success": "true",
+            "firmware": "2.1.0",
+            "device_firmware": "1.1.0",
+            "reason": "OK",
+            "manufacturer_name": "man name",
+            "model_number": "mod numb",
+            "hardware_revision": self.hw_rev,
+            "software_revision": "sw rev"}
+
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        for query in queries.captured_queries:
+            self.assertNotIn(firmware_file_column(), query['sql'])
+
+
+    def test_post_results_hw_rev_spelling(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        data = self.batch_item("12345")
+        data["hardware_revision"] = " {} ".format(self.hw_rev.upper())
+        response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        history = History.objects.get(device__serial_number="12345")
+        self.assertEqual("2.1.0", history.firmware.fw_version)
+        self.assertEqual(self.hw_rev.lower(), Device.objects.get(serial_number="12345").hardware_revision_key)
+
+        item = self.batch_item("NewBatchDevice")
+        item["hardware_revision"] = self.hw_rev.upper()
+        response = self.client.post(reverse('post_results-batch'), [item], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        device = Device.objects.get(serial_number="NewBatchDevice")
+        self.assertEqual(self.hw_rev.lower(), device.hardware_revision_key)
+        self.assertEqual("2.1.0", device.firmware.fw_version)
+
+    def test_post_results_query_budget(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        data = self.batch_item("12345")
+
+        # Firmware lookup, device lookup, History insert, device update, rollout stats update and one update
+        # of the fleet counters the device leaves and joins. The first result of a rollout stats bucket and
+        # the first device on a firmware or hw revision insert the rows in a savepoint.
+        with self.assertNumQueries(13):
+            response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # No device update for failed updates
+        data["fw_update_success"] = False
+        with self.assertNumQueries(4):
+            response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # New devices are inserted in a savepoint, so a concurrent insert can be picked up, and counted
+        data["device"] = "NewDevice"
+        with self.assertNumQueries(8):
+            response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Once the rows exist
+        data["fw_update_success"] = True
+        with self.assertNumQueries(6):
+            response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        # Nothing is looked up for invalid results
+        data["fw_update_started"] = "not a date"
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse('post_results-list'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_post_results_unauthorized_SE02(self):
         ''' Requirement SE-02: Test that unauthorized client cannot access endpoint'''
         data = {
@@ -597,3 +959,130 @@ class PostResultsViewSetTest(APITestCase):
         self.assertEqual(history.model_number, "mod numb")
         self.assertEqual(history.hardware_revision, self.hw_rev)
         self.assertEqual(history.software_revision, "sw rev")
+
+    def batch_item(self, serial, firmware="2.1.0", success=True, started=None):
+        return {
+            "fw_update_started": str(started or self.exp_time),
+            "device": serial,
+            "fw_update_success": success,
+            "firmware": firmware,
+            "device_firmware": "1.1.0",
+            "reason": "",
+            "manufacturer_name": "NewManufacturerName",
+            "model_number": "NewModelNumber",
+            "hardware_revision": self.hw_rev,
+            "software_revision": "NewSWRev",
+        }
+
+    def test_post_results_batch(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        data = [
+            self.batch_item("12345"),
+            self.batch_item("67890", success=False),
+            self.batch_item("67890", firmware="9.9.9"),
+            {"device": "12345"},
+        ]
+        response = self.client.post(reverse('post_results-batch'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual([201, 201, 201, 400], [result["status"] for result in response.data])
+
+        self.assertEqual(3, History.objects.count())
+        self.assertEqual(2, Device.objects.count())
+        self.dv.refresh_from_db()
+        self.assertEqual(self.dv.firmware, self.fw2)
+        self.assertIsNotNone(self.dv.last_update)
+        self.assertEqual(self.dv.software_revision, "NewSWRev")
+        # New device starts on the firmware it reported, the unknown firmware leaves it unset
+        new_device = Device.objects.get(serial_number="67890")
+        self.assertIsNone(new_device.firmware)
+        self.assertEqual(new_device.model_number, "NewModelNumber")
+        self.assertEqual(2, History.objects.filter(device=new_device).count())
+        self.assertEqual(1, History.objects.filter(device=new_device, firmware__isnull=True).count())
+
+    def test_post_results_batch_latest_update_wins(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        later = self.exp_time + timedelta(minutes=5)
+        data = [self.batch_item("12345", started=later), self.batch_item("12345", firmware="1.1.0")]
+        response = self.client.post(reverse('post_results-batch'), data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.dv.refresh_from_db()
+        self.assertEqual(self.dv.firmware, self.fw2)
+        self.assertEqual(self.dv.last_update, later)
+
+    def test_post_results_batch_query_count(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        # The first result of the bucket creates its rollout stats row
+        self.client.post(reverse('post_results-batch'), [self.batch_item("warm-up")], format='json')
+        counts = []
+        for size in (2, 20):
+            data = [self.batch_item("{}-{}".format(size, i)) for i in range(size)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse('post_results-batch'), data, format='json')
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(23, Device.objects.filter(firmware=self.fw2).count())
+
+    def test_post_results_fleet_counters(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        self.client.post(reverse('post_results-list'), self.batch_item("12345"), format='json')
+        self.client.post(reverse('post_results-list'), self.batch_item("NewDevice", success=False), format='json')
+        data = [self.batch_item("NewDevice"), self.batch_item("67890", firmware="9.9.9"), self.batch_item("67891", success=False)]
+        self.client.post(reverse('post_results-batch'), data, format='json')
+        counters = dict(((kind, key), devices) for kind, key, devices in FleetCounter.objects.exclude(devices=0).values_list('kind', 'key', 'devices'))
+        # 67890 moved to an unknown firmware, 67891 still runs the one it reported
+        self.assertEqual({('firmware', str(self.fw1.pk)): 1, ('firmware', str(self.fw2.pk)): 2, ('hw_revision', self.hw_rev): 4}, counters)
+        self.assertEqual({}, FleetCounter.differences())
+
+    def test_post_results_batch_device_inserted_meanwhile(self):
+        # Another request inserts, and counts, the new device between the lookup and the insert of the batch
+        def create_devices(devices):
+            Device.objects.create(serial_number=devices[0].serial_number, created=timezone.now(), hardware_revision="V5")
+            return set()
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with mock.patch('api.ingest.create_devices', create_devices):
+            response = self.client.post(reverse('post_results-batch'), [self.batch_item("67890")], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.fw2, Device.objects.get(serial_number="67890").firmware)
+        self.assertEqual({}, FleetCounter.differences())
+
+    def test_post_results_fleet_counters_changed_device(self):
+        # The device was moved by another request since it was loaded
+        device = Device.objects.get(pk=self.dv.pk)
+        other = Device.objects.get(pk=self.dv.pk)
+        other.firmware = self.fw3
+        other.save()
+        serializer = HistorySerializer(data={"fw_update_started": str(self.exp_time), "fw_update_success": True, "device_firmware": "1.1.0",
+            "reason": "", "hardware_revision": self.hw_rev})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        serializer.save(device=device, firmware_id=self.fw2.pk)
+        self.assertEqual(self.fw2, Device.objects.get(pk=self.dv.pk).firmware)
+        self.assertEqual({}, FleetCounter.differences())
+
+    def test_post_results_batch_without_ignore_conflicts(self):
+        # Like MSSQL
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        with mock.patch.object(connection.features, 'supports_ignore_conflicts', False):
+            response = self.client.post(reverse('post_results-batch'), [self.batch_item("12345"), self.batch_item("67890")], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.fw2, Device.objects.get(serial_number="67890").firmware)
+
+    def test_create_devices_inserted_meanwhile(self):
+        now = timezone.now()
+        devices = [Device(serial_number=serial, created=now) for serial in ("12345", "67890")]
+        self.assertEqual({"67890"}, create_devices(devices))
+        self.assertEqual(2, Device.objects.count())
+        self.assertEqual("ManufacturerName", Device.objects.get(serial_number="12345").manufacturer_name)
+
+    def test_post_results_batch_invalid_request(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Bearer ' + self.token)
+        response = self.client.post(reverse('post_results-batch'), self.batch_item("12345"), format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.settings(POST_RESULTS_BATCH_MAX=1):
+            response = self.client.post(reverse('post_results-batch'), [self.batch_item("1"), self.batch_item("2")], format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(0, History.objects.count())
+
+    def test_post_results_batch_unauthorized(self):
+        response = self.client.post(reverse('post_results-batch'), [self.batch_item("12345")], format='json')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
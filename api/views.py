@@ -1,76 +1,252 @@
-from django.core.exceptions import ObjectDoesNotExist
+from django.conf import settings
 from django.utils import timezone
-from django.http import HttpResponse, request
-from app.models import Device, Firmware, History
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse, request
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags
+from app.models import Device, Firmware, FirmwareDelta, FirmwareEncoding, History
+from app.sharedcache import get_shared_firmware_cache
+from app.storage import get_storage
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework_simplejwt.authentication import JWTTokenUserAuthentication
 from api.serializers import FirmwareSerializer, FirmwareVersionSerializer, HistorySerializer
+from api.ingest import DEVICE_FIELDS, REQUIRED_FIELDS, ingest_results, resolve_firmware_ids, validate_result
+from api.negotiation import preferred_encoding
+from api.ranges import RangeNotSatisfiable, parse_range_header
+from api.resultqueue import QueueFull, get_result_queue
+from api.responsecache import latest_version
+import base64
 import os.path
 
 
-class LatestFirmwareViewSet(viewsets.ModelViewSet):
+def etag_matches(header, etag, weak=False):
     """
-    API endpoint that only reads the latest firmware version.
+    Check an If-None-Match (weak comparison) or If-Range (strong comparison) header against etag.
+    """
+    if not header:
+        return False
+    etags = parse_etags(header)
+    if '*' in etags:
+        return True
+    if weak:
+        etags = [e[2:] if e.startswith('W/') else e for e in etags]
+    return etag in etags
+
+
+def requested_range(request, size, etag, last_modified=None):
+    """
+    Inclusive (start, end) of the Range requested, or None for the whole representation.
+    An If-Range that matches neither validator means the client's partial copy is outdated.
+    """
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is not None and not (if_range.strip() == last_modified or etag_matches(if_range, etag)):
+        return None
+    return parse_range_header(request.META.get('HTTP_RANGE'), size)
+
+
+def may_resume_with(request, etag):
+    """
+    Whether a Range request may get the representation with etag, only when its If-Range names it.
+    A partial copy of another representation must not be continued with these bytes.
+    """
+    return 'HTTP_RANGE' not in request.META or etag_matches(request.META.get('HTTP_IF_RANGE'), etag)
+
+
+def range_not_satisfiable_response(size):
+    response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+    response['Content-Range'] = 'bytes */{}'.format(size)
+    return response
+
+
+def not_modified_response(etag):
+    response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+    response['ETag'] = etag
+    return response
+
+
+def in_memory_file_response(request, get_data, size, etag, sha256, file_name):
+    """
+    Response for a small stored representation, like a delta or a compressed image, that is sent
+    from memory. Handles conditional, Range and HEAD requests like the full image download.
+    """
+    if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag, weak=True):
+        return not_modified_response(etag)
+    try:
+        byte_range = requested_range(request, size, etag)
+    except RangeNotSatisfiable:
+        return range_not_satisfiable_response(size)
+
+    if request.method == 'HEAD':
+        response = HttpResponse()
+        response['Content-Length'] = size
+    elif byte_range is None:
+        response = HttpResponse(bytes(get_data()))
+    else:
+        start, end = byte_range
+        response = HttpResponse(bytes(get_data())[start:end + 1], status=status.HTTP_206_PARTIAL_CONTENT)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+    response['Content-Type'] = 'application/octet-stream'
+    response['Content-Disposition'] = 'attachment; filename={}'.format(file_name)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Digest'] = 'sha-256={}'.format(base64.b64encode(bytes.fromhex(sha256)).decode())
+    return response
+
+
+def iter_latest_firmware_chunks(latest_fw, start, end):
+    # Serve from the copy shared by all workers on this host when configured
+    shared_cache = get_shared_firmware_cache()
+    if shared_cache is not None:
+        return shared_cache.iter_chunks(latest_fw, start, end, settings.FIRMWARE_CHUNK_SIZE)
+    return latest_fw.iter_file_chunks(start, end)
+
+
+class DeviceTokenMixin:
+    """
+    Reads the claims of the device token that authenticated the request.
     """
-    queryset = Firmware.objects.all()
-    http_method_names = ['get']
-    serializer_class = FirmwareVersionSerializer
 
     def get_hw_rev_from_token(self, request):
-        try:
-            header = JWTTokenUserAuthentication.get_header(self, request)
-            raw_token = JWTTokenUserAuthentication.get_raw_token(self, header)
-            jwt_token = JWTTokenUserAuthentication.get_validated_token(self, raw_token)
-            hw_rev = jwt_token.get("hw_rev")
-            if hw_rev:
-                return hw_rev
-            else:
-                return None
-        except:
+        # The token was already verified by the authentication class, don't decode it again
+        token = getattr(request, 'auth', None)
+        if token is None:
             return None
+        hw_rev = token.get("hw_rev")
+        if hw_rev:
+            return hw_rev
+        else:
+            return None
+
+
+class LatestFirmwareViewSet(DeviceTokenMixin, viewsets.ModelViewSet):
+    """
+    API endpoint that only reads the latest firmware version.
+    """
+    queryset = Firmware.objects.all()
+    http_method_names = ['get', 'head']
+    serializer_class = FirmwareVersionSerializer
 
     def list(self, request, *args, **kwargs):
-        latest_fw = Firmware.get_latest_fw_object(Firmware, self.get_hw_rev_from_token(request))
-        if latest_fw is None:
+        hw_rev = self.get_hw_rev_from_token(request)
+        entry = latest_version(hw_rev) if hw_rev is not None else None
+        if entry is None or entry['etag'] is None:
             return Response(status=status.HTTP_204_NO_CONTENT)
 
-        response = Response(FirmwareVersionSerializer(instance=latest_fw).data)
+        etag = entry['etag']
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag, weak=True):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        elif request.method == 'HEAD':
+            response = Response()
+        else:
+            response = Response(entry['data'])
+            if request.accepted_renderer.format == 'json':
+                # Already rendered when it was cached
+                response.content = entry['body']
+                response['Content-Type'] = 'application/json'
+        response['ETag'] = etag
         return response
 
 
-class DownloadLatestFirmwareViewSet(viewsets.ModelViewSet):
+class DownloadLatestFirmwareViewSet(DeviceTokenMixin, viewsets.ModelViewSet):
     """
     API endpoint that dowloads latest firmware.
     """
     queryset = Firmware.objects.all()
-    http_method_names = ['get']
+    http_method_names = ['get', 'head']
     serializer_class = FirmwareSerializer
 
-    def get_hw_rev_from_token(self, request):
-        try:
-            header = JWTTokenUserAuthentication.get_header(self, request)
-            raw_token = JWTTokenUserAuthentication.get_raw_token(self, header)
-            jwt_token = JWTTokenUserAuthentication.get_validated_token(self, raw_token)
-            hw_rev = jwt_token.get("hw_rev")
-            if hw_rev:
-                return hw_rev
-            else:
-                return None
-        except:
-            return None
-
     def list(self, request, *args, **kwargs):
         latest_fw = Firmware.get_latest_fw_object(Firmware, self.get_hw_rev_from_token(request))
         if latest_fw is None:
             return Response(status=status.HTTP_204_NO_CONTENT)
+
+        # Devices asking for a delta and telling which version they run may get a much smaller delta
+        # instead of the full image, others always get the full image from this URL
+        if request.query_params.get('delta') == '1':
+            delta = FirmwareDelta.for_device_version(latest_fw, request.query_params.get('from_version'))
+            if delta is not None and delta.is_useful() and may_resume_with(request, delta.etag):
+                return self.delta_response(request, latest_fw, delta)
+
         file_extension = os.path.splitext(latest_fw.file_name)[-1]
         file_name = latest_fw.fw_version + file_extension
-        contents = latest_fw.file
-        response = HttpResponse(contents)
+
+        # Precompressed image for clients that accept it, smallest encoding first. Opt-in, see FIRMWARE_SERVE_ENCODINGS.
+        if getattr(settings, 'FIRMWARE_SERVE_ENCODINGS', False):
+            encodings = FirmwareEncoding.available_for(latest_fw)
+            available = sorted(encodings, key=lambda name: encodings[name].size)
+            encoding = preferred_encoding(request.META.get('HTTP_ACCEPT_ENCODING'), available)
+            if encoding is not None:
+                return self.encoded_response(request, latest_fw, encodings[encoding], file_name)
+
+        file_size = latest_fw.get_file_size()
+        last_modified = http_date(latest_fw.date_added.timestamp())
+        etag = latest_fw.etag
+
+        # The device, or a cache in between, already has this image
+        if etag_matches(request.META.get('HTTP_IF_NONE_MATCH'), etag, weak=True):
+            response = not_modified_response(etag)
+            patch_vary_headers(response, ['Accept-Encoding'])
+            return response
+
+        storage = get_storage(latest_fw.storage)
+        if request.method == 'GET':
+            # Hand the transfer, including any Range request, to the front web server if configured
+            response = storage.offload_response(latest_fw)
+            if response is not None:
+                response['Content-Type'] = 'application/octet-stream'
+                response['Content-Disposition'] = 'attachment; filename={}'.format(file_name)
+                response['ETag'] = etag
+                patch_vary_headers(response, ['Accept-Encoding'])
+                return response
+
+        # Resume an interrupted download, unless If-Range says the firmware has changed since
+        try:
+            byte_range = requested_range(request, file_size, etag, last_modified)
+        except RangeNotSatisfiable:
+            return range_not_satisfiable_response(file_size)
+
+        # Stream the image chunk by chunk instead of loading it into memory
+        if request.method == 'HEAD':
+            response = HttpResponse()
+            response['Content-Length'] = file_size
+        elif byte_range is None:
+            file = storage.open(latest_fw)
+            if file is not None:
+                # Lets the WSGI server's file wrapper send the file with os.sendfile
+                response = FileResponse(file)
+            else:
+                response = StreamingHttpResponse(iter_latest_firmware_chunks(latest_fw, 0, file_size))
+            response['Content-Length'] = file_size
+        else:
+            start, end = byte_range
+            response = StreamingHttpResponse(iter_latest_firmware_chunks(latest_fw, start, end + 1), status=status.HTTP_206_PARTIAL_CONTENT)
+            response['Content-Length'] = end - start + 1
+            response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, file_size)
         response['Content-Type'] = 'application/octet-stream'
         response['Content-Disposition'] = 'attachment; filename={}'.format(file_name)
+        response['Accept-Ranges'] = 'bytes'
+        response['Last-Modified'] = last_modified
+        response['ETag'] = etag
+        patch_vary_headers(response, ['Accept-Encoding'])
+        response['Digest'] = 'sha-256={}'.format(base64.b64encode(bytes.fromhex(latest_fw.file_sha256)).decode())
+
+        return response
 
+    def delta_response(self, request, latest_fw, delta):
+        file_name = '{}-{}.delta'.format(delta.source.fw_version, latest_fw.fw_version)
+        response = in_memory_file_response(request, lambda: delta.data, delta.size, delta.etag, delta.sha256, file_name)
+        if response.status_code != status.HTTP_304_NOT_MODIFIED:
+            response['X-Delta-Source'] = delta.source.fw_version
+            # Lets the device verify the image it rebuilds from the delta
+            response['X-Firmware-SHA256'] = latest_fw.file_sha256
+        return response
+
+    def encoded_response(self, request, latest_fw, encoding, file_name):
+        response = in_memory_file_response(request, lambda: encoding.data, encoding.size, encoding.etag, encoding.sha256, file_name)
+        if response.status_code != status.HTTP_304_NOT_MODIFIED:
+            response['Content-Encoding'] = encoding.encoding
+            response['X-Firmware-SHA256'] = latest_fw.file_sha256
+        patch_vary_headers(response, ['Accept-Encoding'])
         return response
 
 class PostResultsViewSet(viewsets.ModelViewSet):
@@ -82,38 +258,85 @@ class PostResultsViewSet(viewsets.ModelViewSet):
     serializer_class = HistorySerializer
 
     def create(self, request):
-        serializer = self.get_serializer(data=request.data)
+        result_queue = get_result_queue()
+        if result_queue is not None:
+            return self.enqueue(result_queue, [request.data])[0]
 
-        if not {"device", "device_firmware", "manufacturer_name", "model_number", "hardware_revision", "software_revision"} <= serializer.initial_data.keys():
+        if not isinstance(request.data, dict) or not REQUIRED_FIELDS <= request.data.keys():
             # The request does not contain the expected data
             return Response(data="You need to provide all attributes!", status=status.HTTP_400_BAD_REQUEST)
 
-        # Make sure device exists in DB, if not create it
-        try:
-            device = Device.objects.get(serial_number=serializer.initial_data["device"])
-        except ObjectDoesNotExist:
-            # Try to get device FW
+        # Device and firmware are resolved here, the serializer must not look them up again
+        serializer = self.get_serializer(data={key: value for key, value in request.data.items() if key not in ("device", "firmware")})
+        if not serializer.is_valid():
+            return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        # The flashed firmware and the one the device reports in one query, FW version and HW revision are unique together
+        hw_rev = request.data["hardware_revision"]
+        firmware_ids = resolve_firmware_ids([(request.data.get("firmware"), hw_rev), (request.data["device_firmware"], hw_rev)])
+
+        # Make sure device exists in DB, if not create it. Concurrent requests for a new device create it once.
+        device, _ = Device.objects.get_or_create(serial_number=str(request.data["device"]), defaults={
+            "created": timezone.now(),
+            # None when the device runs some unknown FW
+            "firmware_id": firmware_ids.get((request.data["device_firmware"], hw_rev)),
+            "last_update": None,
+            **{field: serializer.validated_data.get(field) for field in DEVICE_FIELDS},
+        })
+
+        # No such firmware leaves it empty
+        serializer.save(device=device, firmware_id=firmware_ids.get((request.data.get("firmware"), hw_rev)))
+        return Response(status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Store a list of results at once, e.g. replayed by a gateway that buffered them offline.
+        Responds 201 when every result was stored, otherwise 207 with the status of each result.
+        """
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return Response(data="You need to provide a list of results!", status=status.HTTP_400_BAD_REQUEST)
+        batch_max = getattr(settings, 'POST_RESULTS_BATCH_MAX', 500)
+        if len(items) > batch_max:
+            return Response(data="At most {} results per batch!".format(batch_max), status=status.HTTP_400_BAD_REQUEST)
+
+        result_queue = get_result_queue()
+        if result_queue is not None:
+            response, results = self.enqueue(result_queue, items)
+            if results is None:
+                return response
+            accepted = status.HTTP_202_ACCEPTED
+        else:
+            results = ingest_results(items)
+            accepted = status.HTTP_201_CREATED
+        if all(result["status"] == accepted for result in results):
+            return Response(data=results, status=accepted)
+        return Response(data=results, status=status.HTTP_207_MULTI_STATUS)
+
+    def enqueue(self, result_queue, items):
+        """
+        Validate results and append the valid ones to the write-behind queue. Returns the response
+        for a single result and the status of every result, which is None when the queue is full.
+        """
+        results = []
+        valid = []
+        for item in items:
+            _, errors = validate_result(item)
+            if errors is None:
+                valid.append(item)
+                results.append({"status": status.HTTP_202_ACCEPTED})
+            else:
+                results.append({"status": status.HTTP_400_BAD_REQUEST, "errors": errors})
+
+        if valid:
             try:
-                # FW version and HW revision are unique together, will return one or None firmwares
-                device_firmware = Firmware.objects.get(fw_version=serializer.initial_data["device_firmware"], hw_compability=serializer.initial_data["hardware_revision"])
-            except:
-                # Device running some unknow FW
-                device_firmware = None
-            device = Device.objects.create(serial_number=serializer.initial_data["device"], created=timezone.now(), firmware=device_firmware, last_update=None, manufacturer_name=serializer.initial_data["manufacturer_name"],
-            model_number=serializer.initial_data["model_number"], hardware_revision=serializer.initial_data["hardware_revision"], software_revision=serializer.initial_data["software_revision"])
-        serializer.initial_data["device"] = device.id
-
-        # Get firmware
-        try:
-            # FW version and HW revision are unique together, will return one or None firmwares
-            firmware = Firmware.objects.get(fw_version=serializer.initial_data["firmware"], hw_compability=serializer.initial_data["hardware_revision"])
-            serializer.initial_data["firmware"] = firmware.id
-        except:
-            # No such firmware
-            serializer.initial_data["firmware"] = None
-        
-
-        if serializer.is_valid():
-            serializer.save()
-            return Response(status=status.HTTP_201_CREATED)
-        return Response(data=serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                result_queue.put(valid)
+            except QueueFull:
+                # Back off until the worker has caught up
+                response = Response(data="Too many results pending, try again later", status=status.HTTP_503_SERVICE_UNAVAILABLE)
+                response['Retry-After'] = getattr(settings, 'POST_RESULTS_QUEUE_RETRY_AFTER', 30)
+                return response, None
+        if results[0]["status"] == status.HTTP_202_ACCEPTED:
+            return Response(status=status.HTTP_202_ACCEPTED), results
+        return Response(data=results[0]["errors"], status=status.HTTP_400_BAD_REQUEST), results
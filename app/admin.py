@@ -1,15 +1,38 @@
 from django.utils import timezone
 from django.contrib import admin
-from .models import Device, Firmware, History
+from .models import Device, Firmware, FleetCounter, History, RolloutStats
 from .forms import FirmwareFormAdmin
 
 # Register your models here.
 
+class FirmwareDevicesFilter(admin.SimpleListFilter):
+    """
+    Filter by firmware, with the number of devices on each firmware from the fleet counters.
+    """
+    title = 'firmware'
+    # Same parameter as the plain firmware filter, existing links keep working
+    parameter_name = 'firmware__id__exact'
+
+    def lookups(self, request, model_admin):
+        counts = dict(FleetCounter.objects.filter(kind=FleetCounter.FIRMWARE).values_list('key', 'devices'))
+        return [(str(pk), "FW: {}, HW: {} ({} devices)".format(fw_version, hw_rev, counts.get(str(pk), 0)))
+            for pk, fw_version, hw_rev in Firmware.objects.values_list('pk', 'fw_version', 'hw_compability')]
+
+    def queryset(self, request, queryset):
+        if self.value() and self.value().isdigit():
+            return queryset.filter(firmware_id=int(self.value()))
+        return queryset
+
+
 class DeviceAdmin(admin.ModelAdmin):
     list_display = ('serial_number', 'created', 'firmware', 'last_update',  'manufacturer_name', 'model_number', 'hardware_revision', 'software_revision')
-    list_filter = ('firmware', 'created', 'last_update')
+    list_filter = (FirmwareDevicesFilter, 'created', 'last_update')
     search_fields = ['serial_number']
 
+    def get_queryset(self, request):
+        # The changelist joins in firmware for display, leave out the firmware image
+        return super().get_queryset(request).select_related('firmware').defer('firmware__file')
+
     def get_form(self, request, obj=None, **kwargs):
         form = super(DeviceAdmin, self).get_form(request, obj, **kwargs)
         # Edit label for Firmware in the form, display both FW and HW version in the dropdown choise field.
@@ -28,7 +51,7 @@ class DeviceAdmin(admin.ModelAdmin):
 admin.site.register(Device, DeviceAdmin)
 
 class FirmwareAdmin(admin.ModelAdmin):
-    list_display = ('fw_version', 'hw_compability', 'date_added', 'file_name', )
+    list_display = ('fw_version', 'hw_compability', 'date_added', 'file_name', 'file_size', )
     list_filter = ('fw_version', 'hw_compability', 'date_added')
     search_fields = ['fw_version']
     form = FirmwareFormAdmin
@@ -40,17 +63,13 @@ class FirmwareAdmin(admin.ModelAdmin):
             obj.date_added = timezone.now()
             if change:
                 if request.FILES.get('file', False):
-                    obj.file_name = request.FILES['file'].name
-                    uploaded_file = request.FILES['file'].read()
-                    obj.file = uploaded_file
+                    # Size and digest are computed once here, on upload
+                    obj.set_file(request.FILES['file'].name, request.FILES['file'].read())
                 else:
                     # Do nothing, don't want fw image to be mandatory when editing instance
                     pass
             else:
-                file_name = request.FILES['file'].name
-                uploaded_file = request.FILES['file'].read()
-                obj.file_name = file_name
-                obj.file = uploaded_file
+                obj.set_file(request.FILES['file'].name, request.FILES['file'].read())
 
             super().save_model(request, obj, form, change)
 
@@ -61,4 +80,28 @@ class HistoryAdmin(admin.ModelAdmin):
     list_filter = ('fw_update_success', 'device', 'firmware', 'device_firmware')
     search_fields = ['device']
 
+    def get_queryset(self, request):
+        # The changelist joins in firmware for display, leave out the firmware image
+        return super().get_queryset(request).select_related('device', 'firmware').defer('firmware__file')
+
 admin.site.register(History, HistoryAdmin)
+
+class RolloutStatsAdmin(admin.ModelAdmin):
+    list_display = ('bucket', 'firmware', 'hw_revision', 'attempts', 'successes', 'failures', 'success_rate')
+    list_filter = ('firmware', 'hw_revision')
+    date_hierarchy = 'bucket'
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('firmware').defer('firmware__file')
+
+    def success_rate(self, obj):
+        return "{:.1%}".format(obj.successes / obj.attempts) if obj.attempts else "-"
+
+    # Counted from the results, not edited by hand
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+admin.site.register(RolloutStats, RolloutStatsAdmin)
@@ -0,0 +1,223 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.db.models import F
+from django.dispatch import receiver
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from .models import History
+import datetime
+import hashlib
+import itertools
+import json
+import lzma
+import os
+import threading
+
+# Columns copied into the segments, the serial number and firmware version are kept as well
+# since the device or firmware may be gone by the time the archive is read
+ARCHIVED_FIELDS = ['id', 'device_id', 'fw_update_started', 'fw_update_success', 'firmware_id', 'device_firmware', 'reason',
+    'manufacturer_name', 'model_number', 'hardware_revision', 'software_revision']
+# Rows deleted per statement, MSSQL takes at most 2100 parameters
+DELETE_CHUNK = 1000
+
+
+def parse_time(value):
+    """
+    An aware datetime from an ISO date or datetime, dates are midnight UTC. Raises ValueError.
+    """
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError("Not a date or datetime: {}".format(value))
+        parsed = datetime.datetime.combine(date, datetime.time())
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed, datetime.timezone.utc)
+    return parsed
+
+
+class HistoryArchive:
+    """
+    Old History rows in xz compressed JSON lines segments under path, one directory per month
+    (YYYY-MM/). manifest.json lists every segment with its time range, so reading a range only
+    opens the segments that overlap it.
+
+    A segment is written and listed as uncommitted before its rows are deleted from the
+    database, and marked committed after. If the archiver dies in between, the next run deletes
+    the rows of uncommitted segments first, so no row is lost or archived twice.
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.Lock()
+
+    def manifest_path(self):
+        return os.path.join(self.path, self.manifest_name)
+
+    def read_manifest(self):
+        try:
+            with open(self.manifest_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'segments': [], 'last_run': None}
+
+    def write_manifest(self, manifest):
+        tmp_path = self.manifest_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.manifest_path())
+
+    def exclusive(self):
+        """
+        File lock held while archiving, only one archiver per archive directory at a time.
+        """
+        # POSIX only, imported here so the app loads on any platform while archiving is off
+        import fcntl
+
+        os.makedirs(self.path, exist_ok=True)
+        lock = open(os.path.join(self.path, '.lock'), 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def archive(self, before, batch_size=5000, max_batches=None):
+        """
+        Move History rows that started before the given time into segments, batch_size rows
+        per transaction. Returns the number of rows archived.
+        """
+        archived = 0
+        with self._lock, self.exclusive():
+            manifest = self.read_manifest()
+            self.recover(manifest)
+            for _ in itertools.count() if max_batches is None else range(max_batches):
+                rows = list(History.objects.filter(fw_update_started__lt=before).order_by('fw_update_started', 'id')
+                    .values(*ARCHIVED_FIELDS, serial_number=F('device__serial_number'), fw_version=F('firmware__fw_version'))[:batch_size])
+                if not rows:
+                    break
+                # A segment only holds rows of one month
+                for month, month_rows in itertools.groupby(rows, key=lambda row: row['fw_update_started'].strftime('%Y-%m')):
+                    month_rows = list(month_rows)
+                    segment = self.write_segment(manifest, month, month_rows)
+                    self.commit_segment(manifest, segment, [row['id'] for row in month_rows])
+                archived += len(rows)
+            manifest['last_run'] = timezone.now().isoformat()
+            self.write_manifest(manifest)
+        return archived
+
+    def write_segment(self, manifest, month, rows):
+        directory = os.path.join(self.path, month)
+        os.makedirs(directory, exist_ok=True)
+        name = "{}/history-{}-{:06d}.jsonl.xz".format(month, month, len(manifest['segments']) + 1)
+        lines = (json.dumps(dict(row, fw_update_started=row['fw_update_started'].isoformat())) + "\n" for row in rows)
+        data = lzma.compress("".join(lines).encode(), preset=6)
+        tmp_path = os.path.join(self.path, name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.path, name))
+        segment = {
+            'name': name,
+            'start': rows[0]['fw_update_started'].isoformat(),
+            'end': rows[-1]['fw_update_started'].isoformat(),
+            'rows': len(rows),
+            'bytes': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'committed': False,
+        }
+        manifest['segments'].append(segment)
+        self.write_manifest(manifest)
+        return segment
+
+    def commit_segment(self, manifest, segment, ids):
+        with transaction.atomic():
+            for i in range(0, len(ids), DELETE_CHUNK):
+                History.objects.filter(pk__in=ids[i:i + DELETE_CHUNK]).delete()
+        segment['committed'] = True
+        self.write_manifest(manifest)
+
+    def recover(self, manifest):
+        """
+        Finish segments whose rows may not have been deleted, the archiver died after writing them.
+        """
+        for segment in manifest['segments']:
+            if not segment['committed']:
+                self.commit_segment(manifest, segment, [row['id'] for row in self.read_segment(segment)])
+
+    def read_segment(self, segment):
+        with lzma.open(os.path.join(self.path, segment['name']), 'rt') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def query(self, start=None, end=None, device=None, firmware_id=None):
+        """
+        Archived rows with start <= fw_update_started < end, optionally of one device (serial number)
+        or firmware, oldest first. Only segments overlapping the range are read.
+        """
+        for segment in self.read_manifest()['segments']:
+            if not segment['committed']:
+                continue
+            if end is not None and parse_datetime(segment['start']) >= end or start is not None and parse_datetime(segment['end']) < start:
+                continue
+            for row in self.read_segment(segment):
+                started = parse_datetime(row['fw_update_started'])
+                if start is not None and started < start or end is not None and started >= end:
+                    continue
+                if device is not None and row['serial_number'] != device or firmware_id is not None and row['firmware_id'] != firmware_id:
+                    continue
+                yield row
+
+    def verify(self):
+        """
+        Names of the segments that are missing or whose content doesn't match the manifest.
+        """
+        damaged = []
+        for segment in self.read_manifest()['segments']:
+            try:
+                with open(os.path.join(self.path, segment['name']), 'rb') as f:
+                    ok = hashlib.sha256(f.read()).hexdigest() == segment['sha256']
+            except FileNotFoundError:
+                ok = False
+            if not ok:
+                damaged.append(segment['name'])
+        return damaged
+
+    def stats(self):
+        segments = self.read_manifest()
+        committed = [segment for segment in segments['segments'] if segment['committed']]
+        return {
+            'segments': len(committed),
+            'rows': sum(segment['rows'] for segment in committed),
+            'bytes': sum(segment['bytes'] for segment in committed),
+            'oldest': min(segment['start'] for segment in committed) if committed else None,
+            'newest': max(segment['end'] for segment in committed) if committed else None,
+            'uncommitted': len(segments['segments']) - len(committed),
+            'last_run': segments['last_run'],
+        }
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+def get_history_archive():
+    """
+    The archive in HISTORY_ARCHIVE_PATH, or None when it is not configured.
+    """
+    global _archive
+    path = getattr(settings, 'HISTORY_ARCHIVE_PATH', '')
+    if not path:
+        return None
+    with _archive_lock:
+        if _archive is None:
+            _archive = HistoryArchive(path)
+        return _archive
+
+
+@receiver(setting_changed)
+def reset_history_archive(setting, **kwargs):
+    global _archive
+    if setting == 'HISTORY_ARCHIVE_PATH':
+        _archive = None
@@ -0,0 +1,212 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .storage import get_storage
+import mmap
+import os
+import tempfile
+import threading
+
+
+class MemoryTier:
+    """
+    In-process LRU of firmware images, bounded by the total number of bytes held.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, firmware_id):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == firmware_id]:
+                self.size -= len(self._entries.pop(key))
+
+
+class DiskTier:
+    """
+    Firmware images as files in a local directory, served through memory maps so the
+    bytes live in the OS page cache instead of the Python heap. Bounded by total bytes,
+    least recently used files are removed first.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def file_path(self, key):
+        return os.path.join(self.path, "{}-{}".format(*key))
+
+    def get(self, key):
+        try:
+            with open(self.file_path(key), 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b"")
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        # Touch the file so eviction sees it as recently used
+        os.utime(self.file_path(key))
+        return memoryview(mapped)
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.file_path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and not entry.name.startswith('.tmp-'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    @property
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def invalidate(self, firmware_id):
+        prefix = "{}-".format(firmware_id)
+        for entry in os.scandir(self.path):
+            if entry.name.startswith(prefix):
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class FirmwareBlobCache:
+    """
+    Tiered cache in front of firmware image reads, keyed by firmware id and content hash.
+    Images are looked up in memory, then on disk, and only then read from storage.
+    """
+
+    def __init__(self, memory_bytes=0, disk_path=None, disk_bytes=0):
+        self.memory = MemoryTier(memory_bytes) if memory_bytes else None
+        self.disk = DiskTier(disk_path, disk_bytes) if disk_path and disk_bytes else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, firmware):
+        """
+        The whole image of firmware as a buffer, from the fastest tier that has it.
+        """
+        key = (firmware.pk, firmware.file_sha256)
+        if self.memory is not None:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory_hits += 1
+                return memoryview(data)
+        if self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self.disk_hits += 1
+                return data
+
+        self.misses += 1
+        data = get_storage(firmware.storage).read(firmware)
+        if self.memory is not None:
+            self.memory.put(key, data)
+        if self.disk is not None:
+            self.disk.put(key, data)
+        return memoryview(data)
+
+    def iter_chunks(self, firmware, start, end, chunk_size):
+        data = self.get(firmware)
+        for offset in range(start, min(end, len(data)), chunk_size):
+            yield bytes(data[offset:min(offset + chunk_size, end)])
+
+    def invalidate(self, firmware_id):
+        self.invalidations += 1
+        if self.memory is not None:
+            self.memory.invalidate(firmware_id)
+        if self.disk is not None:
+            self.disk.invalidate(firmware_id)
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'memory_bytes': self.memory.size if self.memory is not None else 0,
+            'memory_evictions': self.memory.evictions if self.memory is not None else 0,
+            'disk_bytes': self.disk.size if self.disk is not None else 0,
+            'disk_evictions': self.disk.evictions if self.disk is not None else 0,
+        }
+
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+def get_blob_cache():
+    """
+    The process wide blob cache configured with FIRMWARE_BLOB_CACHE, or None when disabled.
+    """
+    global _blob_cache
+    config = getattr(settings, 'FIRMWARE_BLOB_CACHE', {})
+    if not config.get('MEMORY_BYTES') and not config.get('DISK_BYTES'):
+        return None
+    with _blob_cache_lock:
+        if _blob_cache is None:
+            _blob_cache = FirmwareBlobCache(memory_bytes=config.get('MEMORY_BYTES', 0),
+                disk_path=config.get('DISK_PATH'), disk_bytes=config.get('DISK_BYTES', 0))
+        return _blob_cache
+
+
+@receiver(setting_changed)
+def reset_blob_cache(setting, **kwargs):
+    global _blob_cache
+    if setting == 'FIRMWARE_BLOB_CACHE':
+        _blob_cache = None
@@ -0,0 +1,120 @@
+"""
+Binary delta format used to update a device from one firmware image to another.
+
+A delta starts with a header of the magic bytes, the source size and the target size,
+followed by a sequence of operations that rebuild the target:
+
+    COPY  0x01, offset (uint32), length (uint32)  copy length bytes of the source at offset
+    ADD   0x02, length (uint32), data             append data as is
+
+All integers are big endian.
+"""
+import struct
+
+MAGIC = b'IZD1'
+HEADER = struct.Struct('>4sII')
+COPY = 0x01
+ADD = 0x02
+COPY_OP = struct.Struct('>BII')
+ADD_OP = struct.Struct('>BI')
+
+# Size of the source blocks that are indexed for matching
+BLOCK_SIZE = 32
+# Matches are extended in steps of this many bytes before narrowing down byte by byte
+EXTEND_STEP = 4096
+
+
+class DeltaError(Exception):
+    pass
+
+
+def _forward_match(source, source_offset, target, target_offset):
+    # Length of the common run of bytes starting at the given offsets
+    length = 0
+    limit = min(len(source) - source_offset, len(target) - target_offset)
+    step = EXTEND_STEP
+    while length < limit:
+        n = min(step, limit - length)
+        if source[source_offset + length:source_offset + length + n] == target[target_offset + length:target_offset + length + n]:
+            length += n
+        elif n == 1:
+            break
+        else:
+            step = max(n // 2, 1)
+    return length
+
+
+def make_delta(source, target):
+    """
+    Delta that rebuilds target from source, see apply_delta.
+    """
+    source = bytes(source)
+    target = bytes(target)
+    index = {}
+    for offset in range(0, len(source) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(source[offset:offset + BLOCK_SIZE], offset)
+
+    out = [HEADER.pack(MAGIC, len(source), len(target))]
+    pending = 0
+    i = 0
+    end = len(target) - BLOCK_SIZE
+    while i <= end:
+        source_offset = index.get(target[i:i + BLOCK_SIZE])
+        if source_offset is None:
+            i += 1
+            continue
+
+        length = _forward_match(source, source_offset, target, i)
+        # Grow the match backwards into bytes that would otherwise be added literally
+        back = 0
+        while i - back > pending and source_offset - back > 0 and target[i - back - 1] == source[source_offset - back - 1]:
+            back += 1
+        if i - back > pending:
+            out.append(ADD_OP.pack(ADD, i - back - pending))
+            out.append(target[pending:i - back])
+        out.append(COPY_OP.pack(COPY, source_offset - back, length + back))
+        i += length
+        pending = i
+
+    if pending < len(target):
+        out.append(ADD_OP.pack(ADD, len(target) - pending))
+        out.append(target[pending:])
+    return b"".join(out)
+
+
+def apply_delta(source, delta):
+    """
+    Rebuild the target image from source and a delta made by make_delta.
+    """
+    source = bytes(source)
+    delta = memoryview(delta)
+    if len(delta) < HEADER.size:
+        raise DeltaError("Delta is too short")
+    magic, source_size, target_size = HEADER.unpack_from(delta, 0)
+    if magic != MAGIC:
+        raise DeltaError("Not a firmware delta")
+    if source_size != len(source):
+        raise DeltaError("Delta was made for another source image")
+
+    out = []
+    position = HEADER.size
+    while position < len(delta):
+        op = delta[position]
+        if op == COPY:
+            _, offset, length = COPY_OP.unpack_from(delta, position)
+            position += COPY_OP.size
+            if offset + length > len(source):
+                raise DeltaError("Copy outside the source image")
+            out.append(source[offset:offset + length])
+        elif op == ADD:
+            _, length = ADD_OP.unpack_from(delta, position)
+            position += ADD_OP.size
+            out.append(bytes(delta[position:position + length]))
+            position += length
+        else:
+            raise DeltaError("Unknown delta operation {}".format(op))
+
+    target = b"".join(out)
+    if len(target) != target_size:
+        raise DeltaError("Delta did not produce an image of the expected size")
+    return target
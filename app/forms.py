@@ -1,5 +1,6 @@
 from django import forms
-from .models import Firmware
+from pkg_resources import packaging
+from .models import Firmware, normalize_hw_rev
 from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
@@ -13,6 +14,16 @@ def validate_file_size(file):
         )
 
 
+def validate_fw_version(fw_version):
+    # The version sort key only has room for MAJOR.MINOR.PATCH, "1.0.0.1" would sort like "1.0.0"
+    try:
+        release = packaging.version.Version(fw_version).release
+    except packaging.version.InvalidVersion:
+        return
+    if len(release) > 3:
+        raise ValidationError(_("Firmware version can have at most three numbers, MAJOR.MINOR.PATCH!"))
+
+
 class FirmwareFormAdmin(forms.ModelForm):
     file = forms.FileField(label='Firmware file', validators=[validate_file_size])
 
@@ -20,4 +31,21 @@ class FirmwareFormAdmin(forms.ModelForm):
         model = Firmware
         fields = ['fw_version', 'hw_compability']
         help_texts = {"fw_version": "Semantic versioning MAJOR.MINOR.PATCH, for example 1.33.2",
-        "hw_compability": "Compatible hardware with this firmware. Need to match what can be read from the device!"}
\ No newline at end of file
+        "hw_compability": "Compatible hardware with this firmware. Need to match what can be read from the device!"}
+    def clean_fw_version(self):
+        fw_version = self.cleaned_data["fw_version"]
+        validate_fw_version(fw_version)
+        return fw_version
+
+    def clean(self):
+        cleaned_data = super().clean()
+        fw_version, hw_rev = cleaned_data.get("fw_version"), cleaned_data.get("hw_compability")
+        if fw_version and hw_rev:
+            # Devices look up firmware by the normalized hardware revision, "V1 " and "v1" are the same hardware
+            same = Firmware.objects.filter(fw_version=fw_version, hw_revision_key=normalize_hw_rev(hw_rev))
+            if self.instance.pk is not None:
+                same = same.exclude(pk=self.instance.pk)
+            if same.exists():
+                raise ValidationError(_("Firmware %(fw_version)s already exists for hardware %(hw_rev)s!"),
+                    params={'fw_version': fw_version, 'hw_rev': same.values_list('hw_compability', flat=True).first()})
+        return cleaned_data
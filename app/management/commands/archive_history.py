@@ -0,0 +1,63 @@
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from app.archive import get_history_archive, parse_time
+import csv
+import json
+
+
+class Command(BaseCommand):
+    help = "Move old FOTA results out of the History table into compressed segment files, and read them back."
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        run = subparsers.add_parser('run', help="Archive results older than HISTORY_ARCHIVE_AFTER_DAYS")
+        run.add_argument('--older-than-days', type=int, default=None)
+        run.add_argument('--batch-size', type=int, default=None, help="Results moved per transaction")
+        run.add_argument('--max-batches', type=int, default=None, help="Stop after this many batches, e.g. to spread the work")
+        subparsers.add_parser('status', help="Show the size and time range of the archive")
+        subparsers.add_parser('verify', help="Check every segment against the digest in the manifest")
+        query = subparsers.add_parser('query', help="Print archived results as CSV or JSON lines")
+        query.add_argument('--from', dest='start', type=parse_time, default=None, help="ISO date or datetime, inclusive")
+        query.add_argument('--to', dest='end', type=parse_time, default=None, help="ISO date or datetime, exclusive")
+        query.add_argument('--device', default=None, help="Serial number")
+        query.add_argument('--firmware-id', type=int, default=None)
+        query.add_argument('--format', choices=['csv', 'json'], default='csv')
+
+    def handle(self, *args, **options):
+        archive = get_history_archive()
+        if archive is None:
+            raise CommandError("HISTORY_ARCHIVE_PATH is not set")
+        getattr(self, 'handle_' + options['action'])(archive, options)
+
+    def handle_run(self, archive, options):
+        days = options['older_than_days'] if options['older_than_days'] is not None else settings.HISTORY_ARCHIVE_AFTER_DAYS
+        before = timezone.now() - timedelta(days=days)
+        archived = archive.archive(before, options['batch_size'] or settings.HISTORY_ARCHIVE_BATCH_SIZE, options['max_batches'])
+        self.stdout.write(self.style.SUCCESS("Archived {} result(s) from before {}".format(archived, before.isoformat())))
+
+    def handle_status(self, archive, options):
+        stats = archive.stats()
+        self.stdout.write("{segments} segment(s), {rows} result(s), {bytes} bytes, from {oldest} to {newest}, last run {last_run}".format(**stats))
+        if stats['uncommitted']:
+            self.stdout.write(self.style.WARNING("{} segment(s) not committed, the next run finishes them".format(stats['uncommitted'])))
+
+    def handle_verify(self, archive, options):
+        damaged = archive.verify()
+        if damaged:
+            raise CommandError("Damaged or missing segments:\n" + "\n".join(damaged))
+        self.stdout.write(self.style.SUCCESS("All segments are intact"))
+
+    def handle_query(self, archive, options):
+        rows = archive.query(options['start'], options['end'], options['device'], options['firmware_id'])
+        if options['format'] == 'json':
+            for row in rows:
+                self.stdout.write(json.dumps(row))
+            return
+        writer = None
+        for row in rows:
+            if writer is None:
+                writer = csv.DictWriter(self.stdout, fieldnames=list(row))
+                writer.writeheader()
+            writer.writerow(row)
@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from iz_fota.handlers import MiddlewareProfileWSGIHandler
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+import time
+
+
+class Command(BaseCommand):
+    help = "Measure the time per latest_fw_version request with the full middleware stack and with the device API stack."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=1000, help="Requests per handler and round")
+        parser.add_argument('--rounds', type=int, default=5)
+        parser.add_argument('--hw-rev', default='v1', help="Hardware revision claimed by the token")
+        parser.add_argument('--path', default='/api/latest_fw_version/')
+
+    def handle(self, *args, **options):
+        token = AccessToken()
+        token[api_settings.USER_ID_CLAIM] = 0
+        token['hw_rev'] = options['hw_rev']
+        host = next((host for host in settings.ALLOWED_HOSTS if '*' not in host and not host.startswith('.')), 'localhost')
+        environ = RequestFactory(HTTP_HOST=host).get(options['path'], HTTP_AUTHORIZATION='Bearer {}'.format(token)).environ
+
+        handlers = [
+            ('MIDDLEWARE', WSGIHandler()),
+            ('DEVICE_API_MIDDLEWARE', MiddlewareProfileWSGIHandler(settings.DEVICE_API_MIDDLEWARE)),
+        ]
+        timings = {}
+        for name, handler in handlers:
+            self.stdout.write("{}: {}".format(name, self.run(handler, environ, 50)))
+        # Interleaved rounds, the best round of each handler is the least disturbed one
+        for _ in range(options['rounds']):
+            for name, handler in handlers:
+                started = time.perf_counter()
+                self.run(handler, environ, options['requests'])
+                elapsed = (time.perf_counter() - started) / options['requests']
+                timings[name] = min(elapsed, timings.get(name, elapsed))
+        for name, _ in handlers:
+            self.stdout.write("{:<22} {:>8.1f} us/request".format(name, timings[name] * 1e6))
+
+        saved = timings['MIDDLEWARE'] - timings['DEVICE_API_MIDDLEWARE']
+        self.stdout.write(self.style.SUCCESS("Device API stack saves {:.1f} us/request ({:.0%})".format(saved * 1e6, saved / timings['MIDDLEWARE'])))
+
+    def run(self, handler, environ, count):
+        statuses = []
+        def start_response(status, headers, exc_info=None):
+            statuses.append(status)
+        for _ in range(count):
+            response = handler(dict(environ), start_response)
+            for _ in response:
+                pass
+            response.close()
+        return statuses[-1]
@@ -0,0 +1,152 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, NotSupportedError, connections, transaction
+from django.utils import timezone
+from app.models import Device, Firmware, History, LatestFirmware, VERSION_ORDERING, normalize_hw_rev
+import random
+import re
+import statistics
+import time
+
+# SQLite plan steps reading a whole table, e.g. "SCAN app_history" or "SCAN TABLE app_history", and
+# sorts of the result. Scanning an index, "SCAN ... USING INDEX", reads the rows in the order of the
+# index, that's only fine for a page of the first rows.
+SQLITE_SCAN = re.compile(r'\bSCAN (?:TABLE )?(\w+)( .*\bUSING\b.*\bINDEX\b)?')
+SQLITE_SORT = re.compile(r'USE TEMP B-TREE FOR (?:ORDER BY|RIGHT PART OF ORDER BY)')
+
+
+def hot_queries(sample):
+    """
+    (name, queryset) of the queries devices and the admin run most, with sample values from the seeded data.
+    """
+    since = timezone.now() - timedelta(days=7)
+    return [
+        ('latest firmware', LatestFirmware.objects.select_related('firmware').defer('firmware__file').filter(hw_revision=sample['hw_rev'])),
+        ('latest firmware refresh', Firmware.objects.filter(hw_revision_key=sample['hw_rev']).order_by(*VERSION_ORDERING).only('id', 'fw_version')[:1]),
+        ('firmware by version', Firmware.objects.filter(fw_version__in=[sample['fw_version']], hw_revision_key__in=[sample['hw_rev']]).values_list('fw_version', 'hw_revision_key', 'pk')),
+        ('history changelist', History.objects.select_related('device', 'firmware').defer('firmware__file')[:100]),
+        ('history of device', History.objects.filter(device_id=sample['device_id'])[:100]),
+        ('history of firmware', History.objects.filter(firmware_id=sample['firmware_id'])[:100]),
+        ('failed updates', History.objects.filter(fw_update_success=False)[:100]),
+        ('failed updates of firmware', History.objects.filter(firmware_id=sample['firmware_id'], fw_update_success=False)[:100]),
+        ('device changelist', Device.objects.select_related('firmware').defer('firmware__file')[:100]),
+        ('devices updated recently', Device.objects.filter(last_update__gte=since)[:100]),
+        ('devices of hw revision', Device.objects.filter(hardware_revision_key=sample['hw_rev']).order_by().values('firmware_id')),
+        ('device by serial number', Device.objects.filter(serial_number=sample['serial_number'])),
+    ]
+
+
+def problems(vendor, plan, tables, paged=False):
+    """
+    Steps of a query plan that read all rows of one of tables or sort them, only recognized for SQLite.
+    paged queries only read the first rows, scanning an index in the right order is fine for those.
+    """
+    if vendor != 'sqlite':
+        return []
+    found = []
+    for line in plan.splitlines():
+        match = SQLITE_SCAN.search(line)
+        if match and match.group(1) in tables and not (paged and match.group(2)):
+            found.append(line.strip())
+        elif SQLITE_SORT.search(line):
+            found.append(line.strip())
+    return found
+
+
+class Command(BaseCommand):
+    help = ("Seed a realistic number of devices and results, then show the query plan and timings of the hot queries. "
+            "The seeded data is rolled back at the end.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--devices', type=int, default=20000)
+        parser.add_argument('--results-per-device', type=int, default=10)
+        parser.add_argument('--hw-revisions', type=int, default=10)
+        parser.add_argument('--releases', type=int, default=20, help="Firmware releases per hardware revision")
+        parser.add_argument('--repeat', type=int, default=20, help="Runs of each query")
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+        parser.add_argument('--no-explain', action='store_true', help="Only show timings")
+        parser.add_argument('--fail-on-scan', action='store_true',
+            help="Fail when a query reads all of History or Device or sorts them, e.g. in CI (SQLite only)")
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        failures = []
+        with transaction.atomic(using=options['database']):
+            started = time.perf_counter()
+            sample = self.seed(options)
+            self.stdout.write("Seeded {} devices and {} results in {:.1f}s".format(
+                options['devices'], options['devices'] * options['results_per_device'], time.perf_counter() - started))
+
+            tables = {History._meta.db_table, Device._meta.db_table}
+            for name, queryset in hot_queries(sample):
+                timings = []
+                for _ in range(options['repeat']):
+                    started = time.perf_counter()
+                    list(queryset.all())
+                    timings.append(time.perf_counter() - started)
+                self.stdout.write(self.style.MIGRATE_HEADING("{}: best {:.2f} ms, median {:.2f} ms".format(
+                    name, min(timings) * 1000, statistics.median(timings) * 1000)))
+                if options['no_explain']:
+                    continue
+                try:
+                    plan = queryset.explain()
+                except (NotSupportedError, DatabaseError) as e:
+                    self.stdout.write("  EXPLAIN not available: {}".format(e))
+                    continue
+                for line in plan.splitlines():
+                    self.stdout.write("  " + line)
+                for problem in problems(connection.vendor, plan, tables, paged=queryset.query.high_mark is not None):
+                    self.stdout.write(self.style.WARNING("  no index used: " + problem))
+                    failures.append("{}: {}".format(name, problem))
+            transaction.set_rollback(True, using=options['database'])
+
+        if failures and options['fail_on_scan']:
+            raise CommandError("Queries without a suitable index:\n" + "\n".join(failures))
+
+    def seed(self, options):
+        now = timezone.now()
+        rng = random.Random(0)
+        using = options['database']
+        hw_revs = ["BENCH-HW-{}".format(i) for i in range(options['hw_revisions'])]
+        firmwares = {}
+        for hw_rev in hw_revs:
+            # Saved one by one, the version keys and the latest firmware index are maintained on save
+            firmwares[hw_rev] = [Firmware.objects.using(using).create(fw_version="1.{}.0".format(release), hw_compability=hw_rev,
+                date_added=now - timedelta(days=options['releases'] - release), file_name="bench.cyacd2")
+                for release in range(options['releases'])]
+
+        devices = []
+        for i in range(options['devices']):
+            hw_rev = rng.choice(hw_revs)
+            updated = rng.random() < 0.8
+            devices.append(Device(serial_number="BENCH{:08d}".format(i), created=now - timedelta(days=rng.randint(1, 700)),
+                firmware=rng.choice(firmwares[hw_rev]), last_update=now - timedelta(days=rng.randint(0, 60)) if updated else None,
+                hardware_revision=hw_rev, hardware_revision_key=normalize_hw_rev(hw_rev)))
+        Device.objects.using(using).bulk_create(devices, batch_size=1000)
+        devices = list(Device.objects.using(using).filter(serial_number__startswith="BENCH").values_list('pk', 'hardware_revision'))
+
+        histories = []
+        for device_id, hw_rev in devices:
+            for _ in range(options['results_per_device']):
+                histories.append(History(device_id=device_id, fw_update_started=now - timedelta(seconds=rng.randint(0, 365 * 86400)),
+                    fw_update_success=rng.random() < 0.9, firmware=rng.choice(firmwares[hw_rev]), device_firmware="1.0.0",
+                    hardware_revision=hw_rev))
+            if len(histories) >= 10000:
+                History.objects.using(using).bulk_create(histories, batch_size=1000)
+                histories = []
+        History.objects.using(using).bulk_create(histories, batch_size=1000)
+
+        # Fresh statistics, so the planner knows the tables are big
+        if connections[using].vendor in ('sqlite', 'postgresql'):
+            with connections[using].cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        hw_rev = hw_revs[0]
+        device_id = devices[0][0] if devices else 0
+        return {
+            'hw_rev': normalize_hw_rev(hw_rev),
+            'fw_version': firmwares[hw_rev][-1].fw_version,
+            'firmware_id': firmwares[hw_rev][-1].pk,
+            'device_id': device_id,
+            'serial_number': "BENCH00000000",
+        }
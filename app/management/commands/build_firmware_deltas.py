@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app.models import Firmware, FirmwareDelta, LatestFirmware, VERSION_ORDERING
+
+
+class Command(BaseCommand):
+    help = "Build the deltas to the latest firmware of every hardware revision from its recent releases, ahead of a rollout."
+
+    def handle(self, *args, **options):
+        built = 0
+        for latest in LatestFirmware.objects.select_related('firmware'):
+            target = latest.firmware
+            sources = Firmware.objects.filter(hw_revision_key=latest.hw_revision).exclude(pk=target.pk).order_by(*VERSION_ORDERING)
+            for source in sources[:settings.FIRMWARE_DELTA_MAX_SOURCES]:
+                delta = FirmwareDelta.for_device_version(target, source.fw_version, build=True)
+                if delta is None:
+                    continue
+                built += 1
+                self.stdout.write("{} (HW: {}): {} bytes{}".format(delta, latest.hw_revision, delta.size, "" if delta.is_useful() else ", too big to be used"))
+
+        self.stdout.write(self.style.SUCCESS("{} delta(s) ready".format(built)))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import FleetCounter
+
+
+class Command(BaseCommand):
+    help = ("Compare the per firmware and per hw revision device counters with the devices, and repair them. "
+            "Writes that bypass the counting, e.g. queryset updates or concurrent first results, make them drift.")
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        subparsers.add_parser('check', help="List the counters that are wrong, fails if there are any")
+        subparsers.add_parser('repair', help="Recount the counters that are wrong")
+
+    def handle(self, *args, **options):
+        getattr(self, 'handle_' + options['action'])(options)
+
+    def report(self, differences):
+        for (kind, key), (counted, actual) in sorted(differences.items()):
+            self.stdout.write("{} {!r}: counted {}, actual {}".format(kind, key, counted, actual))
+
+    def handle_check(self, options):
+        differences = FleetCounter.differences()
+        self.report(differences)
+        if differences:
+            raise CommandError("{} counter(s) are wrong, run fleet_counters repair".format(len(differences)))
+        self.stdout.write(self.style.SUCCESS("All counters are correct"))
+
+    def handle_repair(self, options):
+        differences = FleetCounter.repair()
+        self.report(differences)
+        self.stdout.write(self.style.SUCCESS("Repaired {} counter(s)".format(len(differences))))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Firmware
+from app.storage import DATABASE, FILESYSTEM, get_storage
+import hashlib
+
+
+class Command(BaseCommand):
+    help = "Move firmware images between storage backends, by default out of the database to the file system."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=[DATABASE, FILESYSTEM], default=FILESYSTEM, help="Storage to move the images to")
+        parser.add_argument('--dry-run', action='store_true', help="Only list the firmwares that would be moved")
+
+    def handle(self, *args, **options):
+        target = get_storage(options['to'])
+        moved = 0
+        # One image in memory at a time
+        for pk in Firmware.objects.exclude(storage=target.name).values_list('pk', flat=True):
+            firmware = Firmware.objects.get(pk=pk)
+            source = get_storage(firmware.storage)
+            if options['dry_run']:
+                self.stdout.write("Would move {} (HW: {}) from {} to {}".format(firmware.fw_version, firmware.hw_compability, source.name, target.name))
+                continue
+
+            data = source.read(firmware)
+            if firmware.file_sha256 and hashlib.sha256(data).hexdigest() != firmware.file_sha256:
+                raise CommandError("Digest mismatch for firmware {} (HW: {}), not moving it".format(firmware.fw_version, firmware.hw_compability))
+            firmware.set_file(firmware.file_name, data, storage=target.name)
+            # The file left behind is removed on save unless other firmwares share it, see app/signals.py
+            firmware.save(update_fields=['file', 'file_size', 'file_sha256', 'storage'])
+            moved += 1
+            self.stdout.write("Moved {} (HW: {}) to {}".format(firmware.fw_version, firmware.hw_compability, target.name))
+
+        self.stdout.write(self.style.SUCCESS("Moved {} firmware image(s)".format(moved)))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from app.archive import get_history_archive, parse_time
+from app.models import RolloutStats
+
+
+class Command(BaseCommand):
+    help = ("Recount the rollout stats from History, e.g. to backfill them. Buckets holding archived results "
+            "are kept, History no longer has their rows.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', type=parse_time, default=None, help="Only recount buckets from this ISO date or datetime on")
+
+    def handle(self, *args, **options):
+        since = options['since']
+        archive = get_history_archive()
+        newest = archive.stats()['newest'] if archive is not None else None
+        if newest is not None:
+            # The bucket of the newest archived result is partly archived, recount from the next one
+            first = RolloutStats.bucket_start(parse_time(newest)) + RolloutStats.bucket_size()
+            if since is None or since < first:
+                since = first
+        buckets = RolloutStats.rebuild(since)
+        self.stdout.write(self.style.SUCCESS("Recounted {} bucket(s){}".format(buckets, " from {}".format(since.isoformat()) if since else "")))
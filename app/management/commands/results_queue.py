@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from api.ingest import ingest_results
+from api.resultqueue import get_result_queue
+import time
+
+
+class Command(BaseCommand):
+    help = "Inspect the post_results write-behind queue, drain it into the database or replay failed results."
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest='action', required=True)
+        subparsers.add_parser('status', help="Show the number of pending and failed results")
+        drain = subparsers.add_parser('drain', help="Store pending results in the database")
+        drain.add_argument('--batch-size', type=int, default=500, help="Results stored per transaction")
+        drain.add_argument('--follow', action='store_true', help="Keep draining new results until interrupted")
+        drain.add_argument('--interval', type=float, default=1.0, help="Seconds to wait for new results when following")
+        failed = subparsers.add_parser('failed', help="List results that could not be stored")
+        failed.add_argument('--limit', type=int, default=100)
+        replay = subparsers.add_parser('replay', help="Queue failed results again")
+        replay.add_argument('ids', nargs='*', type=int, help="Only these results, all failed results by default")
+        subparsers.add_parser('discard', help="Delete all failed results")
+
+    def handle(self, *args, **options):
+        queue = get_result_queue()
+        if queue is None:
+            raise CommandError("POST_RESULTS_QUEUE_PATH is not set")
+        getattr(self, 'handle_' + options['action'])(queue, options)
+
+    def handle_status(self, queue, options):
+        stats = queue.stats()
+        self.stdout.write("{pending} pending (max {max_items}), {failed} failed, oldest {oldest_age:.0f}s old".format(**stats))
+
+    def handle_drain(self, queue, options):
+        stored = 0
+        while True:
+            # Runs outside the request cycle, drop connections the database closed, e.g. after a restart
+            close_old_connections()
+            try:
+                taken = queue.drain_batch(ingest_results, options['batch_size'])
+            except Exception as e:
+                if not options['follow']:
+                    raise CommandError("Could not store results: {}".format(e))
+                self.stderr.write("Could not store results, retrying: {}".format(e))
+                close_old_connections()
+                time.sleep(options['interval'])
+                continue
+            stored += taken
+            if taken == 0:
+                if not options['follow']:
+                    break
+                time.sleep(options['interval'])
+        self.stdout.write(self.style.SUCCESS("Drained {} result(s)".format(stored)))
+
+    def handle_failed(self, queue, options):
+        for pk, item, errors, attempts in queue.failed(options['limit']):
+            self.stdout.write("{} device {} after {} attempt(s): {}".format(pk, item.get("device") if isinstance(item, dict) else None, attempts, errors))
+
+    def handle_replay(self, queue, options):
+        replayed = queue.replay(options['ids'] or None)
+        self.stdout.write(self.style.SUCCESS("Queued {} failed result(s) again".format(replayed)))
+
+    def handle_discard(self, queue, options):
+        self.stdout.write(self.style.SUCCESS("Discarded {} failed result(s)".format(queue.discard_failed())))
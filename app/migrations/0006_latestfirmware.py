@@ -0,0 +1,37 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:21
+
+from django.db import migrations, models
+from pkg_resources import packaging
+import django.db.models.deletion
+
+
+def populate_latest_firmware(apps, schema_editor):
+    Firmware = apps.get_model('app', 'Firmware')
+    LatestFirmware = apps.get_model('app', 'LatestFirmware')
+    latest = {}
+    for obj in Firmware.objects.only('id', 'fw_version', 'hw_compability'):
+        key = obj.hw_compability.strip().lower()
+        if key not in latest or packaging.version.parse(obj.fw_version) > packaging.version.parse(latest[key].fw_version):
+            latest[key] = obj
+    for key, obj in latest.items():
+        LatestFirmware.objects.create(hw_revision=key, firmware=obj, fw_version=obj.fw_version)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_auto_20210520_1610'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LatestFirmware',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hw_revision', models.CharField(max_length=100, unique=True)),
+                ('fw_version', models.CharField(max_length=100)),
+                ('firmware', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.firmware')),
+            ],
+        ),
+        migrations.RunPython(populate_latest_firmware, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,77 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:22
+
+from django.db import migrations, models
+from pkg_resources import packaging
+
+PRE_RELEASE_RANKS = {'dev': 1, 'a': 2, 'b': 3, 'rc': 4}
+FINAL_RELEASE_RANK = 5
+POST_RELEASE_RANK = 6
+
+
+def version_sort_key(fw_version):
+    # As app.models.version_sort_key was when this migration was written
+    try:
+        version = packaging.version.Version(fw_version)
+    except packaging.version.InvalidVersion:
+        return (0, 0, 0, 0, 0)
+
+    major, minor, patch = (list(version.release) + [0, 0, 0])[:3]
+    if version.pre is not None:
+        return (major, minor, patch, PRE_RELEASE_RANKS[version.pre[0]], version.pre[1])
+    if version.dev is not None:
+        return (major, minor, patch, PRE_RELEASE_RANKS['dev'], version.dev)
+    if version.post is not None:
+        return (major, minor, patch, POST_RELEASE_RANK, version.post)
+    return (major, minor, patch, FINAL_RELEASE_RANK, 0)
+
+
+def populate_version_key(apps, schema_editor):
+    Firmware = apps.get_model('app', 'Firmware')
+    for obj in Firmware.objects.only('id', 'fw_version'):
+        (obj.version_major, obj.version_minor, obj.version_patch,
+            obj.version_pre_rank, obj.version_pre_number) = version_sort_key(obj.fw_version)
+        obj.save(update_fields=['version_major', 'version_minor', 'version_patch', 'version_pre_rank', 'version_pre_number'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_latestfirmware'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='firmware',
+            options={'ordering': ['-version_major', '-version_minor', '-version_patch', '-version_pre_rank', '-version_pre_number']},
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='version_major',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='version_minor',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='version_patch',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='version_pre_number',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='version_pre_rank',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='firmware',
+            index=models.Index(fields=['hw_compability', 'version_major', 'version_minor', 'version_patch', 'version_pre_rank', 'version_pre_number'], name='firmware_hw_version_idx'),
+        ),
+        migrations.RunPython(populate_version_key, migrations.RunPython.noop),
+    ]
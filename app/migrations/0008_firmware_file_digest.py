@@ -0,0 +1,37 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:25
+
+from django.db import migrations, models
+import hashlib
+
+
+def populate_file_digest(apps, schema_editor):
+    Firmware = apps.get_model('app', 'Firmware')
+    # Load one image at a time
+    for pk in Firmware.objects.values_list('pk', flat=True):
+        obj = Firmware.objects.get(pk=pk)
+        if obj.file is not None:
+            data = bytes(obj.file)
+            obj.file_size = len(data)
+            obj.file_sha256 = hashlib.sha256(data).hexdigest()
+            obj.save(update_fields=['file_size', 'file_sha256'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_firmware_version_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmware',
+            name='file_sha256',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='firmware',
+            name='file_size',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(populate_file_digest, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_firmware_file_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmware',
+            name='storage',
+            field=models.CharField(choices=[('db', 'Database'), ('fs', 'File system')], default='db', editable=False, max_length=10),
+        ),
+    ]
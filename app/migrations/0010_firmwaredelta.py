@@ -0,0 +1,31 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_firmware_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirmwareDelta',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_sha256', models.CharField(max_length=64)),
+                ('target_sha256', models.CharField(max_length=64)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('created', models.DateTimeField(auto_now=True)),
+                ('source', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='app.firmware')),
+                ('target', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deltas', to='app.firmware')),
+            ],
+            options={
+                'unique_together': {('source', 'target')},
+            },
+        ),
+    ]
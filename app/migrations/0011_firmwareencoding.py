@@ -0,0 +1,68 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:31
+
+from django.conf import settings
+from django.db import migrations, models
+import gzip
+import hashlib
+import lzma
+import os
+import django.db.models.deletion
+
+
+def compress_xz(data):
+    dict_size = min(max(1 << (len(data) - 1).bit_length(), 4096), 8 * 1024 * 1024)
+    return lzma.compress(data, format=lzma.FORMAT_XZ, filters=[{'id': lzma.FILTER_LZMA2, 'preset': 6, 'dict_size': dict_size}])
+
+
+# As FirmwareEncoding.COMPRESSORS was when this migration was written
+COMPRESSORS = {
+    'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+    'xz': compress_xz,
+}
+
+
+def compress_existing_images(apps, schema_editor):
+    Firmware = apps.get_model('app', 'Firmware')
+    FirmwareEncoding = apps.get_model('app', 'FirmwareEncoding')
+    # Images on the file system are stored under their digest
+    root = getattr(settings, 'FIRMWARE_STORAGE_ROOT', '')
+    for pk in Firmware.objects.values_list('pk', flat=True):
+        firmware = Firmware.objects.get(pk=pk)
+        if firmware.storage == 'fs':
+            with open(os.path.join(root, firmware.file_sha256[:2], firmware.file_sha256[2:4], firmware.file_sha256), 'rb') as f:
+                data = f.read()
+        elif firmware.file is not None:
+            data = bytes(firmware.file)
+        else:
+            continue
+        for encoding, compress in COMPRESSORS.items():
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                FirmwareEncoding.objects.create(firmware=firmware, encoding=encoding, source_sha256=firmware.file_sha256,
+                    data=compressed, size=len(compressed), sha256=hashlib.sha256(compressed).hexdigest())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_firmwaredelta'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FirmwareEncoding',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('encoding', models.CharField(choices=[('gzip', 'gzip'), ('xz', 'xz (LZMA)')], max_length=10)),
+                ('source_sha256', models.CharField(max_length=64)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('sha256', models.CharField(max_length=64)),
+                ('firmware', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='encodings', to='app.firmware')),
+            ],
+            options={
+                'unique_together': {('firmware', 'encoding')},
+            },
+        ),
+        migrations.RunPython(compress_existing_images, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 3.1.8 on 2026-10-17 19:05
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def normalize_hw_rev(hw_rev):
+    # As app.models.normalize_hw_rev was when this migration was written
+    return hw_rev.strip().lower()
+
+
+def populate_hw_revision_keys(apps, schema_editor):
+    Firmware = apps.get_model('app', 'Firmware')
+    Device = apps.get_model('app', 'Device')
+    # One update per distinct spelling, there are far fewer of those than rows
+    for hw_rev in Firmware.objects.values_list('hw_compability', flat=True).distinct():
+        Firmware.objects.filter(hw_compability=hw_rev).update(hw_revision_key=normalize_hw_rev(hw_rev))
+    for hw_rev in Device.objects.exclude(hardware_revision=None).values_list('hardware_revision', flat=True).distinct():
+        Device.objects.filter(hardware_revision=hw_rev).update(hardware_revision_key=normalize_hw_rev(hw_rev))
+    # Versions are unique per normalized hw revision from here on
+    duplicates = (Firmware.objects.values('fw_version', 'hw_revision_key').annotate(count=Count('id'))
+        .filter(count__gt=1).order_by().values_list('fw_version', 'hw_revision_key'))
+    if duplicates:
+        raise RuntimeError("Firmware versions uploaded more than once for the same hw revision in different spellings, "
+            "delete or rename one of each before migrating: {}".format(", ".join("{} ({})".format(*row) for row in duplicates)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_firmwareencoding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='firmware',
+            name='hw_revision_key',
+            field=models.CharField(default='', editable=False, max_length=100),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='hardware_revision_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=100, null=True),
+        ),
+        migrations.RunPython(populate_hw_revision_keys, migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='firmware',
+            unique_together={('fw_version', 'hw_revision_key')},
+        ),
+        migrations.RemoveIndex(
+            model_name='firmware',
+            name='firmware_hw_version_idx',
+        ),
+        migrations.AddIndex(
+            model_name='firmware',
+            index=models.Index(fields=['hw_revision_key', 'version_major', 'version_minor', 'version_patch', 'version_pre_rank', 'version_pre_number'], name='firmware_hw_version_idx'),
+        ),
+    ]
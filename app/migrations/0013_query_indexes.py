@@ -0,0 +1,49 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_hw_revision_key'),
+    ]
+
+    operations = [
+        # The composite indexes are in place before the single column foreign key indexes they replace are dropped
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['-created'], name='device_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='device',
+            index=models.Index(fields=['last_update'], name='device_last_update_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['-fw_update_started'], name='history_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['device', '-fw_update_started'], name='history_device_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['firmware', '-fw_update_started'], name='history_firmware_started_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='history',
+            index=models.Index(fields=['fw_update_success', '-fw_update_started'], name='history_success_idx'),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='device',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.device'),
+        ),
+        migrations.AlterField(
+            model_name='history',
+            name='firmware',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='app.firmware', verbose_name='Flashed Firmware'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.1.8 on 2026-10-17 18:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0013_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RolloutStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hw_revision', models.CharField(blank=True, max_length=100)),
+                ('bucket', models.DateTimeField()),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('successes', models.PositiveIntegerField(default=0)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('firmware', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='app.firmware')),
+            ],
+            options={
+                'verbose_name_plural': 'Rollout stats',
+                'ordering': ['-bucket'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='rolloutstats',
+            index=models.Index(fields=['bucket'], name='rolloutstats_bucket_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='rolloutstats',
+            unique_together={('firmware', 'hw_revision', 'bucket')},
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.1.8 on 2026-10-17 19:00
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_devices(apps, schema_editor):
+    Device = apps.get_model('app', 'Device')
+    FleetCounter = apps.get_model('app', 'FleetCounter')
+    devices = Device.objects.order_by()
+    counters = [FleetCounter(kind='firmware', key=str(firmware_id), devices=count)
+        for firmware_id, count in devices.exclude(firmware=None).values_list('firmware_id').annotate(Count('id'))]
+    hw_revisions = {}
+    for hw_revision, count in devices.values_list('hardware_revision_key').annotate(Count('id')):
+        hw_revisions[hw_revision or ''] = hw_revisions.get(hw_revision or '', 0) + count
+    counters += [FleetCounter(kind='hw_revision', key=key, devices=count) for key, count in hw_revisions.items()]
+    FleetCounter.objects.bulk_create(counters, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_rolloutstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('firmware', 'Firmware'), ('hw_revision', 'HW revision')], max_length=20)),
+                ('key', models.CharField(blank=True, max_length=100)),
+                ('devices', models.IntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('kind', 'key')},
+            },
+        ),
+        migrations.RunPython(count_devices, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 3.1.8 on 2026-10-17 19:13
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0015_fleetcounter'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='firmware',
+            options={'ordering': ['-version_major', '-version_minor', '-version_patch', '-version_pre_rank', '-version_pre_number', '-id']},
+        ),
+    ]
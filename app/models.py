@@ -1,32 +1,394 @@
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, models, router, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import Length, TruncDay, TruncHour
+from django.utils import timezone
 from pkg_resources import packaging
+from .blobcache import get_blob_cache
+from .delta import make_delta
+from .storage import DATABASE, STORAGE_CHOICES, get_storage
+from datetime import timedelta
+import gzip
+import hashlib
+import lzma
+
+
+def normalize_hw_rev(hw_rev):
+    # Canonical form used as key when looking up firmware by hardware revision
+    return hw_rev.strip().lower()
+
+def hardware_revision_key(hw_rev):
+    # Like normalize_hw_rev for the optional hardware revision devices report
+    return normalize_hw_rev(hw_rev) if hw_rev is not None else None
+
+# Rank of the release type in the version sort key, anything that is not a valid version sorts first
+PRE_RELEASE_RANKS = {'dev': 1, 'a': 2, 'b': 3, 'rc': 4}
+FINAL_RELEASE_RANK = 5
+POST_RELEASE_RANK = 6
+
+def version_sort_key(fw_version):
+    """
+    Split a version string into (major, minor, patch, pre_rank, pre_number) so that
+    comparing the tuples, and ordering on the stored columns, agrees with packaging.version.
+    """
+    try:
+        version = packaging.version.Version(fw_version)
+    except packaging.version.InvalidVersion:
+        return (0, 0, 0, 0, 0)
+
+    major, minor, patch = (list(version.release) + [0, 0, 0])[:3]
+    if version.pre is not None:
+        return (major, minor, patch, PRE_RELEASE_RANKS[version.pre[0]], version.pre[1])
+    if version.dev is not None:
+        return (major, minor, patch, PRE_RELEASE_RANKS['dev'], version.dev)
+    if version.post is not None:
+        return (major, minor, patch, POST_RELEASE_RANK, version.post)
+    return (major, minor, patch, FINAL_RELEASE_RANK, 0)
+
+VERSION_KEY_FIELDS = ['version_major', 'version_minor', 'version_patch', 'version_pre_rank', 'version_pre_number']
+# Newest version first. Versions the key doesn't tell apart, like "1.0" and "1.0.0", newest upload first.
+VERSION_ORDERING = ['-' + field for field in VERSION_KEY_FIELDS] + ['-id']
+
+
+class FirmwareQuerySet(models.QuerySet):
+
+    def newer_than(self, fw_version):
+        """
+        Firmwares with a version strictly newer than fw_version, as a range condition on the version key.
+        """
+        key = version_sort_key(fw_version)
+        condition = Q()
+        for i, field in enumerate(VERSION_KEY_FIELDS):
+            equal = {f: value for f, value in zip(VERSION_KEY_FIELDS[:i], key[:i])}
+            condition |= Q(**equal, **{field + '__gt': key[i]})
+        return self.filter(condition)
+
+    def with_file(self):
+        """
+        Also load the firmware image, which FirmwareManager leaves out by default.
+        """
+        return self.defer(None)
+
+
+class FirmwareManager(models.Manager.from_queryset(FirmwareQuerySet)):
+
+    def get_queryset(self):
+        # Firmware images are several MB, don't pull them over the wire when only metadata is needed
+        return super().get_queryset().defer('file')
 
 
 class Firmware(models.Model):
     fw_version = models.CharField(max_length=100)
     hw_compability = models.CharField(max_length=100)
+    # normalize_hw_rev of hw_compability, set on save, every lookup by hardware revision uses it
+    hw_revision_key = models.CharField(max_length=100, editable=False)
     date_added = models.DateTimeField()
     file_name = models.CharField(max_length=100)
     file = models.BinaryField(null=True, blank=True, editable=True)
+    # Sortable version key derived from fw_version on save, see version_sort_key
+    version_major = models.PositiveIntegerField(default=0, editable=False)
+    version_minor = models.PositiveIntegerField(default=0, editable=False)
+    version_patch = models.PositiveIntegerField(default=0, editable=False)
+    version_pre_rank = models.PositiveSmallIntegerField(default=0, editable=False)
+    version_pre_number = models.PositiveIntegerField(default=0, editable=False)
+    # Size and SHA-256 digest of the firmware image, computed once when the image is set
+    file_size = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    file_sha256 = models.CharField(max_length=64, blank=True, editable=False)
+    # Storage backend holding the image, see app/storage.py
+    storage = models.CharField(max_length=10, choices=STORAGE_CHOICES, default=DATABASE, editable=False)
+
+    objects = FirmwareManager()
 
     class Meta:
-        ordering = ['-fw_version']
-        unique_together = ['fw_version', 'hw_compability']
+        ordering = VERSION_ORDERING
+        unique_together = ['fw_version', 'hw_revision_key']
+        indexes = [
+            models.Index(fields=['hw_revision_key'] + VERSION_KEY_FIELDS, name='firmware_hw_version_idx'),
+        ]
 
     def __str__(self):
         return self.fw_version
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The image file_sha256 was computed from, save() recomputes it when file is replaced
+        instance._digested_file = instance.__dict__.get('file')
+        # Where the image was stored, see delete_replaced_firmware_file in app/signals.py
+        instance._stored_image = (instance.__dict__.get('storage'), instance.__dict__.get('file_sha256'))
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        # Loading the deferred image, or reloading the row, reads the image the stored digest belongs to
+        if fields is None or 'file' in fields:
+            self._digested_file = self.__dict__.get('file')
+
+    def file_changed(self):
+        """
+        Whether the loaded image has no digest yet or was replaced without set_file().
+        """
+        if 'file' in self.get_deferred_fields() or self.file is None:
+            return False
+        return not self.file_sha256 or self.file is not getattr(self, '_digested_file', self.file)
+
+    def save(self, *args, **kwargs):
+        (self.version_major, self.version_minor, self.version_patch,
+            self.version_pre_rank, self.version_pre_number) = version_sort_key(self.fw_version)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'fw_version' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | set(VERSION_KEY_FIELDS)
+        if 'hw_compability' not in self.get_deferred_fields():
+            self.hw_revision_key = normalize_hw_rev(self.hw_compability)
+        if update_fields is not None and 'hw_compability' in update_fields:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'hw_revision_key'}
+        # Firmwares created or given a new file through the ORM get their digest here, FirmwareAdmin uses set_file
+        if self.file_changed():
+            # A replaced image stays in the storage of the firmware, new ones go to FIRMWARE_STORAGE
+            self.set_file(self.file_name, self.file, storage=None if self._state.adding else self.storage)
+            if update_fields is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'file', 'file_size', 'file_sha256', 'storage'}
+        super().save(*args, **kwargs)
+        self._stored_image = (self.storage, self.file_sha256)
+        # Compress a new image once, right after it has been stored
+        new_file_data = getattr(self, '_new_file_data', None)
+        if new_file_data is not None:
+            FirmwareEncoding.update_for(self, new_file_data)
+            self._new_file_data = None
+
+    def set_file(self, file_name, data, storage=None):
+        """
+        Replace the firmware image, together with its size and digest. The image goes to
+        the named storage, or the one configured with FIRMWARE_STORAGE.
+        """
+        data = bytes(data)
+        self.file_name = file_name
+        self.file_size = len(data)
+        self.file_sha256 = hashlib.sha256(data).hexdigest()
+        get_storage(storage).save(self, data)
+        self._digested_file = self.file
+        # Compressed variants are made on save, when the firmware has a primary key
+        self._new_file_data = data
+
+    @property
+    def etag(self):
+        # Strong ETag of the firmware image
+        return '"{}"'.format(self.file_sha256)
+
+    @property
+    def version_etag(self):
+        # Strong ETag of the latest version response, changes with both the version string and the image
+        return '"{}"'.format(hashlib.sha256("{}:{}".format(self.fw_version, self.file_sha256).encode()).hexdigest())
+
+    def get_file_size(self):
+        """
+        Size of the firmware image in bytes. Falls back to letting the database compute it without
+        loading the image when the stored size is missing.
+        """
+        if self.file_size is not None:
+            return self.file_size
+        return Firmware._base_manager.filter(pk=self.pk).annotate(size=Length('file')).values_list('size', flat=True).get() or 0
+
+    def iter_file_chunks(self, start=0, end=None, chunk_size=None):
+        """
+        Read the firmware image in fixed size chunks from its storage, so the whole image
+        never has to be held in memory. end is exclusive.
+        """
+        if chunk_size is None:
+            chunk_size = getattr(settings, 'FIRMWARE_CHUNK_SIZE', 256 * 1024)
+        if end is None:
+            end = self.get_file_size()
+        cache = get_blob_cache()
+        if cache is not None:
+            return cache.iter_chunks(self, start, end, chunk_size)
+        return get_storage(self.storage).iter_chunks(self, start, end, chunk_size)
+
     def get_latest_fw_object(self, hw_rev):
-        if hw_rev == None or not self._meta.model.objects.filter(hw_compability__iexact=hw_rev).exists():
+        if hw_rev == None:
+            return None
+
+        # Single lookup in the maintained index, see LatestFirmware
+        try:
+            return LatestFirmware.objects.select_related('firmware').defer('firmware__file').get(hw_revision=normalize_hw_rev(hw_rev)).firmware
+        except LatestFirmware.DoesNotExist:
+            return None
+
+class LatestFirmware(models.Model):
+    """
+    Index of the latest firmware for every hardware revision. Kept up to date
+    by the Firmware post_save/post_delete signal handlers in app/signals.py.
+    """
+    hw_revision = models.CharField(max_length=100, unique=True)
+    firmware = models.ForeignKey(Firmware, on_delete=models.CASCADE)
+    fw_version = models.CharField(max_length=100)
+
+    def __str__(self):
+        return "{}: {}".format(self.hw_revision, self.fw_version)
+
+    @classmethod
+    def refresh(cls, hw_rev):
+        """
+        Recompute the index entry for one hardware revision.
+        """
+        key = normalize_hw_rev(hw_rev)
+        latest = Firmware.objects.filter(hw_revision_key=key).order_by(*VERSION_ORDERING).only('id', 'fw_version').first()
+
+        if latest is None:
+            cls.objects.filter(hw_revision=key).delete()
+        else:
+            cls.objects.update_or_create(hw_revision=key, defaults={'firmware': latest, 'fw_version': latest.fw_version})
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute the whole index, e.g. after bulk changes that bypass signals.
+        """
+        hw_revs = set(Firmware.objects.values_list('hw_revision_key', flat=True).distinct())
+        cls.objects.exclude(hw_revision__in=hw_revs).delete()
+        for hw_rev in hw_revs:
+            cls.refresh(hw_rev)
+
+def compress_xz(data):
+    # The dictionary doesn't need to be bigger than the image, keeps memory use low when decompressing
+    dict_size = min(max(1 << (len(data) - 1).bit_length(), 4096), 8 * 1024 * 1024)
+    return lzma.compress(data, format=lzma.FORMAT_XZ, filters=[{'id': lzma.FILTER_LZMA2, 'preset': 6, 'dict_size': dict_size}])
+
+class FirmwareEncoding(models.Model):
+    """
+    Compressed copy of a firmware image, made once at upload and sent as is to clients
+    that accept the content coding.
+    """
+    GZIP = 'gzip'
+    XZ = 'xz'
+    ENCODING_CHOICES = [(GZIP, 'gzip'), (XZ, 'xz (LZMA)')]
+    COMPRESSORS = {
+        GZIP: lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+        XZ: compress_xz,
+    }
+
+    firmware = models.ForeignKey(Firmware, on_delete=models.CASCADE, related_name='encodings')
+    encoding = models.CharField(max_length=10, choices=ENCODING_CHOICES)
+    # Digest of the image this was compressed from, a replaced image makes it stale
+    source_sha256 = models.CharField(max_length=64)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+
+    class Meta:
+        unique_together = ['firmware', 'encoding']
+
+    def __str__(self):
+        return "{} ({})".format(self.firmware, self.encoding)
+
+    @property
+    def etag(self):
+        return '"{}"'.format(self.sha256)
+
+    @classmethod
+    def update_for(cls, firmware, data):
+        """
+        Compress the image of firmware with every encoding, keeping only variants smaller than the image.
+        """
+        existing = cls.objects.filter(firmware=firmware)
+        if existing.exists() and not existing.exclude(source_sha256=firmware.file_sha256).exists():
+            # Same image, e.g. only moved to another storage
+            return
+        existing.delete()
+        for encoding, compress in cls.COMPRESSORS.items():
+            compressed = compress(data)
+            if len(compressed) < len(data):
+                cls.objects.create(firmware=firmware, encoding=encoding, source_sha256=firmware.file_sha256,
+                    data=compressed, size=len(compressed), sha256=hashlib.sha256(compressed).hexdigest())
+
+    @classmethod
+    def available_for(cls, firmware):
+        """
+        Current encodings of firmware by name, without loading the compressed data.
+        """
+        return {e.encoding: e for e in cls.objects.filter(firmware=firmware, source_sha256=firmware.file_sha256).defer('data')}
+
+class FirmwareDelta(models.Model):
+    """
+    Cached binary delta from an older firmware image to a newer one for the same hardware
+    revision, see app/delta.py for the format.
+    """
+    source = models.ForeignKey(Firmware, on_delete=models.CASCADE, related_name='+')
+    target = models.ForeignKey(Firmware, on_delete=models.CASCADE, related_name='deltas')
+    # Digests of the images the delta was made from, replacing either image makes the delta stale
+    source_sha256 = models.CharField(max_length=64)
+    target_sha256 = models.CharField(max_length=64)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField()
+    sha256 = models.CharField(max_length=64)
+    created = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ['source', 'target']
+
+    def __str__(self):
+        return "{} -> {}".format(self.source, self.target)
+
+    @property
+    def etag(self):
+        return '"{}"'.format(self.sha256)
+
+    def is_useful(self):
+        # Only worth sending when clearly smaller than the full image
+        return self.size < self.target.get_file_size() * getattr(settings, 'FIRMWARE_DELTA_MAX_RATIO', 0.5)
+
+    @classmethod
+    def stored(cls, source, target):
+        """
+        The stored delta from source to target, None when it wasn't built yet or the images changed since.
+        """
+        delta = cls.objects.filter(source=source, target=target).first()
+        if delta is None or delta.source_sha256 != source.file_sha256 or delta.target_sha256 != target.file_sha256:
             return None
+        delta.source, delta.target = source, target
+        return delta
+
+    @classmethod
+    def get_or_build(cls, source, target):
+        """
+        The delta from source to target, made and stored on first use.
+        """
+        delta = cls.stored(source, target)
+        if delta is not None:
+            return delta
+
+        data = make_delta(get_storage(source.storage).read(source), get_storage(target.storage).read(target))
+        defaults = {'source_sha256': source.file_sha256, 'target_sha256': target.file_sha256, 'data': data,
+            'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+        try:
+            with transaction.atomic():
+                delta, _ = cls.objects.update_or_create(source=source, target=target, defaults=defaults)
+        except IntegrityError:
+            # Built concurrently by another request, same inputs give the same delta. Replicas may not have it yet.
+            delta = cls.objects.using(router.db_for_write(cls)).get(source=source, target=target)
+        delta.source, delta.target = source, target
+        return delta
 
-        objects = self._meta.model.objects.filter(hw_compability__iexact=hw_rev)
-        latest = objects[0]
-        for obj in objects:
-            if packaging.version.parse(obj.fw_version) > packaging.version.parse(latest.fw_version):
-                latest = obj
+    @classmethod
+    def for_device_version(cls, target, fw_version, build=False):
+        """
+        Delta to target for a device running fw_version, or None when fw_version is unknown or not
+        one of the FIRMWARE_DELTA_MAX_SOURCES releases before target. Without build only a stored
+        delta is returned, devices never wait for one to be made, see build_firmware_deltas.
+        """
+        max_sources = getattr(settings, 'FIRMWARE_DELTA_MAX_SOURCES', 0)
+        if not max_sources or not fw_version:
+            return None
+        hw_firmwares = Firmware.objects.filter(hw_revision_key=normalize_hw_rev(target.hw_compability))
+        source = hw_firmwares.filter(fw_version=fw_version).exclude(pk=target.pk).first()
+        if source is None or not source.file_sha256 or version_sort_key(source.fw_version) >= version_sort_key(target.fw_version):
+            return None
+        # Releases newer than the source, the target included
+        if hw_firmwares.newer_than(source.fw_version).count() > max_sources:
+            return None
+        if build:
+            return cls.get_or_build(source, target)
+        return cls.stored(source, target)
 
-        return latest
 
 class Device(models.Model):
     serial_number = models.CharField(max_length=100, unique=True)
@@ -36,19 +398,61 @@ class Device(models.Model):
     manufacturer_name = models.CharField(max_length=100,null=True, blank=True)
     model_number = models.CharField(max_length=100,null=True, blank=True, verbose_name='Model#')
     hardware_revision = models.CharField(max_length=100,null=True, blank=True, verbose_name='HW rev.')
+    # normalize_hw_rev of hardware_revision, set on save and by the bulk writes in api/ingest.py
+    hardware_revision_key = models.CharField(max_length=100, null=True, blank=True, editable=False, db_index=True)
     software_revision = models.CharField(max_length=100,null=True, blank=True, verbose_name='SW rev.')
 
     class Meta:
         ordering = ['-created']
+        indexes = [
+            # The admin changelist, newest first and by its last_update filter
+            models.Index(fields=['-created'], name='device_created_idx'),
+            models.Index(fields=['last_update'], name='device_last_update_idx'),
+        ]
 
     def __str__(self):
         return self.serial_number
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What the fleet counters count the device as, save() moves it when that changes
+        instance._counted_as = instance.fleet_key()
+        return instance
+
+    def fleet_key(self):
+        """
+        (firmware_id, hardware_revision_key) of the device, None when either is not loaded.
+        """
+        if {'firmware_id', 'hardware_revision_key'} & self.get_deferred_fields():
+            return None
+        return (self.firmware_id, self.hardware_revision_key)
+
+    def save(self, *args, **kwargs):
+        if 'hardware_revision' not in self.get_deferred_fields():
+            self.hardware_revision_key = hardware_revision_key(self.hardware_revision)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'hardware_revision' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'hardware_revision_key'}
+        adding = self._state.adding
+        super().save(*args, **kwargs)
+
+        before = None if adding else getattr(self, '_counted_as', None)
+        after = self.fleet_key()
+        if before is not None and after is not None and update_fields is not None:
+            # Fields that weren't saved keep their value in the database
+            after = (after[0] if {'firmware', 'firmware_id'} & set(update_fields) else before[0],
+                after[1] if 'hardware_revision' in update_fields else before[1])
+        if adding or before is not None:
+            FleetCounter.move(before, after)
+        self._counted_as = after
+
 class History(models.Model):
-    device = models.ForeignKey(Device, on_delete=models.SET_NULL, null=True)
+    # The composite indexes below start with the foreign keys, they replace the single column ones
+    device = models.ForeignKey(Device, on_delete=models.SET_NULL, null=True, db_index=False)
     fw_update_started = models.DateTimeField(verbose_name='Timestamp')
     fw_update_success = models.BooleanField()
-    firmware = models.ForeignKey(Firmware, on_delete=models.SET_NULL, null=True, verbose_name='Flashed Firmware')
+    firmware = models.ForeignKey(Firmware, on_delete=models.SET_NULL, null=True, verbose_name='Flashed Firmware', db_index=False)
     device_firmware = models.CharField(max_length=50, null=True, blank=True)
     reason = models.CharField(max_length=500, null=True, blank=True)
     manufacturer_name = models.CharField(max_length=100,null=True, blank=True)
@@ -60,6 +464,243 @@ class History(models.Model):
         # Force plural name to be History, otherwise admin site will just append s in the end
         verbose_name_plural = "History"
         ordering = ['-fw_update_started']
+        # The admin changelist is ordered by fw_update_started, every filter gets an index that returns its
+        # rows in that order so a page is read without sorting the table. Check with manage.py benchmark_queries.
+        indexes = [
+            models.Index(fields=['-fw_update_started'], name='history_started_idx'),
+            models.Index(fields=['device', '-fw_update_started'], name='history_device_started_idx'),
+            models.Index(fields=['firmware', '-fw_update_started'], name='history_firmware_started_idx'),
+            models.Index(fields=['fw_update_success', '-fw_update_started'], name='history_success_idx'),
+        ]
 
     def __str__(self):
         return self.device.serial_number
+
+
+class RolloutStats(models.Model):
+    """
+    FOTA results per firmware, hardware revision and time bucket (ROLLOUT_STATS_BUCKET, 'hour' or
+    'day', in UTC), counted as results are stored so the progress of a rollout is read without
+    aggregating History. Results without a known firmware aren't counted.
+    """
+    firmware = models.ForeignKey(Firmware, on_delete=models.CASCADE)
+    # normalize_hw_rev of the hardware revision the devices reported, empty when they didn't
+    hw_revision = models.CharField(max_length=100, blank=True)
+    bucket = models.DateTimeField()
+    attempts = models.PositiveIntegerField(default=0)
+    successes = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = "Rollout stats"
+        ordering = ['-bucket']
+        unique_together = ['firmware', 'hw_revision', 'bucket']
+        indexes = [
+            models.Index(fields=['bucket'], name='rolloutstats_bucket_idx'),
+        ]
+
+    def __str__(self):
+        return "{} {}: {}/{}".format(self.hw_revision, self.bucket, self.successes, self.attempts)
+
+    @staticmethod
+    def bucket_size():
+        return timedelta(days=1) if getattr(settings, 'ROLLOUT_STATS_BUCKET', 'hour') == 'day' else timedelta(hours=1)
+
+    @staticmethod
+    def bucket_start(started):
+        started = started.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        if getattr(settings, 'ROLLOUT_STATS_BUCKET', 'hour') == 'day':
+            started = started.replace(hour=0)
+        return started
+
+    @classmethod
+    def record(cls, results):
+        """
+        Count stored History rows, one UPDATE per firmware, hardware revision and bucket among them.
+        """
+        counts = {}
+        for result in results:
+            if result.firmware_id is None:
+                continue
+            key = (result.firmware_id, hardware_revision_key(result.hardware_revision) or '', cls.bucket_start(result.fw_update_started))
+            attempts, successes = counts.get(key, (0, 0))
+            counts[key] = (attempts + 1, successes + bool(result.fw_update_success))
+
+        # Always in the same order, concurrent batches don't deadlock on each other's rows
+        for (firmware_id, hw_revision, bucket), (attempts, successes) in sorted(counts.items()):
+            rows = cls.objects.filter(firmware_id=firmware_id, hw_revision=hw_revision, bucket=bucket)
+            increments = {'attempts': F('attempts') + attempts, 'successes': F('successes') + successes, 'failures': F('failures') + (attempts - successes)}
+            if rows.update(**increments):
+                continue
+            try:
+                with transaction.atomic():
+                    cls.objects.create(firmware_id=firmware_id, hw_revision=hw_revision, bucket=bucket,
+                        attempts=attempts, successes=successes, failures=attempts - successes)
+            except IntegrityError:
+                # Another request created the bucket meanwhile
+                rows.update(**increments)
+
+    @classmethod
+    def rebuild(cls, since=None):
+        """
+        Recount the buckets from since on, or all of them, from History. Returns the number of buckets.
+        """
+        trunc = TruncDay if getattr(settings, 'ROLLOUT_STATS_BUCKET', 'hour') == 'day' else TruncHour
+        results = History.objects.exclude(firmware=None)
+        buckets = cls.objects.all()
+        if since is not None:
+            since = cls.bucket_start(since)
+            results = results.filter(fw_update_started__gte=since)
+            buckets = buckets.filter(bucket__gte=since)
+        rows = results.order_by().annotate(started_bucket=trunc('fw_update_started', tzinfo=timezone.utc)).values(
+            'firmware_id', 'hardware_revision', 'started_bucket').annotate(
+            total=Count('id'), succeeded=Count('id', filter=Q(fw_update_success=True)),
+        )
+        with transaction.atomic():
+            buckets.delete()
+            # Grouped by the spelling the devices reported, normalized here like record() does, SQL TRIM and LOWER differ
+            counts = {}
+            for row in rows:
+                key = (row['firmware_id'], hardware_revision_key(row['hardware_revision']) or '', row['started_bucket'])
+                attempts, successes = counts.get(key, (0, 0))
+                counts[key] = (attempts + row['total'], successes + row['succeeded'])
+            stats = [cls(firmware_id=firmware_id, hw_revision=hw_revision, bucket=bucket, attempts=attempts, successes=successes,
+                failures=attempts - successes) for (firmware_id, hw_revision, bucket), (attempts, successes) in counts.items()]
+            cls.objects.bulk_create(stats, batch_size=500)
+        return len(stats)
+
+
+class FleetCounter(models.Model):
+    """
+    Number of devices per firmware (kind 'firmware', key the firmware id) and per hardware
+    revision (kind 'hw_revision', key its normalized form, empty for devices without one),
+    maintained as devices are created, updated and deleted. Devices on an unknown firmware
+    only count for their hardware revision.
+
+    Writes that bypass Device.save() and the result ingestion, e.g. queryset updates, make the
+    counters drift, manage.py fleet_counters repair recounts them.
+    """
+    FIRMWARE = 'firmware'
+    HW_REVISION = 'hw_revision'
+    KIND_CHOICES = [(FIRMWARE, 'Firmware'), (HW_REVISION, 'HW revision')]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    key = models.CharField(max_length=100, blank=True)
+    # Not unsigned, a drifted counter may go below zero until it is repaired
+    devices = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ['kind', 'key']
+
+    def __str__(self):
+        return "{} {}: {}".format(self.kind, self.key, self.devices)
+
+    @classmethod
+    def keys(cls, fleet_key):
+        # The counters a device with the (firmware_id, hardware_revision_key) fleet key counts for
+        if fleet_key is None:
+            return []
+        firmware_id, hw_revision = fleet_key
+        keys = [(cls.HW_REVISION, hw_revision or '')]
+        if firmware_id is not None:
+            keys.append((cls.FIRMWARE, str(firmware_id)))
+        return keys
+
+    @classmethod
+    def move(cls, before, after):
+        """
+        Count a device as after instead of before, None for a device that's new or gone.
+        """
+        cls.move_many([(before, after)])
+
+    @classmethod
+    def move_many(cls, moves):
+        """
+        move() for a list of (before, after), with one UPDATE per counter that changes.
+        """
+        deltas = {}
+        for before, after in moves:
+            if before == after:
+                continue
+            for key in cls.keys(before):
+                deltas[key] = deltas.get(key, 0) - 1
+            for key in cls.keys(after):
+                deltas[key] = deltas.get(key, 0) + 1
+        cls.apply(deltas)
+
+    @classmethod
+    def apply(cls, deltas):
+        """
+        Add {(kind, key): delta} to the counters, with one UPDATE for all of them. Missing counters
+        are inserted, which takes a few more queries only for the first device on a key.
+        """
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        if not deltas or cls._add(deltas) == len(deltas):
+            return
+        existing = set(cls._filter(deltas).values_list('kind', 'key'))
+        # A counter can't go below zero by a device leaving it if it doesn't exist, repair recounts it
+        missing = {key: delta for key, delta in deltas.items() if key not in existing and delta > 0}
+        if not missing:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create([cls(kind=kind, key=key, devices=delta) for (kind, key), delta in sorted(missing.items())])
+        except IntegrityError:
+            # Another request created some of them meanwhile
+            for (kind, key), delta in sorted(missing.items()):
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(kind=kind, key=key, devices=delta)
+                except IntegrityError:
+                    cls._add({(kind, key): delta})
+
+    @classmethod
+    def _filter(cls, deltas):
+        condition = Q()
+        for kind, key in deltas:
+            condition |= Q(kind=kind, key=key)
+        return cls.objects.filter(condition)
+
+    @classmethod
+    def _add(cls, deltas):
+        # Returns the number of counters that exist
+        increment = Case(*[When(kind=kind, key=key, then=Value(delta)) for (kind, key), delta in deltas.items()],
+            default=Value(0), output_field=models.IntegerField())
+        return cls._filter(deltas).update(devices=F('devices') + increment)
+
+    @classmethod
+    def actual(cls):
+        """
+        {(kind, key): devices} counted from Device, with two GROUP BY queries.
+        """
+        counts = {}
+        devices = Device.objects.order_by()
+        for firmware_id, count in devices.exclude(firmware=None).values_list('firmware_id').annotate(Count('id')):
+            counts[cls.FIRMWARE, str(firmware_id)] = count
+        for hw_revision, count in devices.values_list('hardware_revision_key').annotate(Count('id')):
+            key = (cls.HW_REVISION, hw_revision or '')
+            counts[key] = counts.get(key, 0) + count
+        return counts
+
+    @classmethod
+    def differences(cls):
+        """
+        {(kind, key): (counted, actual)} of the counters that are wrong.
+        """
+        actual = cls.actual()
+        counted = {(kind, key): devices for kind, key, devices in cls.objects.values_list('kind', 'key', 'devices')}
+        return {key: (counted.get(key, 0), actual.get(key, 0)) for key in counted.keys() | actual.keys() if counted.get(key, 0) != actual.get(key, 0)}
+
+    @classmethod
+    def repair(cls):
+        """
+        Set the wrong counters to the actual number of devices, returns what was wrong.
+        """
+        with transaction.atomic():
+            differences = cls.differences()
+            for (kind, key), (counted, actual) in differences.items():
+                if actual:
+                    cls.objects.update_or_create(kind=kind, key=key, defaults={'devices': actual})
+                else:
+                    cls.objects.filter(kind=kind, key=key).delete()
+        return differences
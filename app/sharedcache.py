@@ -0,0 +1,162 @@
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from .models import normalize_hw_rev
+from .storage import get_storage
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+
+
+class SharedFirmwareCache:
+    """
+    Holds the latest firmware image of every hardware revision in a memory mapped file shared
+    by all worker processes on the host, e.g. under /dev/shm, so the host keeps one copy of
+    each hot image instead of one per worker. Responses still copy every chunk they send, the
+    saving is in resident memory, not in per-request copies.
+
+    For every hardware revision a small pointer file names the segment with the current image
+    and its generation number. Publishing a new image writes a new segment and then atomically
+    replaces the pointer, workers remap when they see a new generation. Old segments are
+    unlinked, workers still serving from them keep a valid mapping until they let go of it.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.hits = 0
+        self.misses = 0
+        self.publishes = 0
+        # hw key -> (generation, firmware id, sha256, mapped segment)
+        self._maps = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def hw_key(self, hw_rev):
+        # Hardware revisions are free text, keep file names safe
+        return hashlib.sha256(normalize_hw_rev(hw_rev).encode()).hexdigest()[:32]
+
+    def pointer_path(self, key):
+        return os.path.join(self.path, "{}.current".format(key))
+
+    def segment_path(self, key, generation):
+        return os.path.join(self.path, "{}-{}.seg".format(key, generation))
+
+    def read_pointer(self, key):
+        try:
+            with open(self.pointer_path(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def publish(self, firmware):
+        """
+        Make firmware the shared image of its hardware revision, replacing the previous one.
+        """
+        # POSIX only, imported here so the device API loads on any platform while the cache is off
+        import fcntl
+
+        key = self.hw_key(firmware.hw_compability)
+        with open(os.path.join(self.path, "{}.lock".format(key)), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            pointer = self.read_pointer(key)
+            if pointer is not None and pointer['firmware_id'] == firmware.pk and pointer['sha256'] == firmware.file_sha256:
+                # Another worker got here first
+                return pointer
+
+            data = get_storage(firmware.storage).read(firmware)
+            generation = pointer['generation'] + 1 if pointer is not None else 1
+            self._write_atomic(self.segment_path(key, generation), data)
+            new_pointer = {'generation': generation, 'firmware_id': firmware.pk, 'sha256': firmware.file_sha256, 'size': len(data)}
+            self._write_atomic(self.pointer_path(key), json.dumps(new_pointer).encode())
+            if pointer is not None:
+                try:
+                    os.remove(self.segment_path(key, pointer['generation']))
+                except FileNotFoundError:
+                    pass
+            self.publishes += 1
+            return new_pointer
+
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, firmware):
+        """
+        The shared image of firmware as a read only buffer, publishing it first if the segment
+        holds another image. Returns None for empty images, which can't be mapped.
+        """
+        if not firmware.file_size:
+            self.misses += 1
+            return None
+
+        key = self.hw_key(firmware.hw_compability)
+        pointer = self.read_pointer(key)
+        if pointer is None or pointer['firmware_id'] != firmware.pk or pointer['sha256'] != firmware.file_sha256:
+            self.misses += 1
+            pointer = self.publish(firmware)
+        else:
+            self.hits += 1
+
+        with self._lock:
+            current = self._maps.get(key)
+            if current is None or current[0] != pointer['generation']:
+                try:
+                    with open(self.segment_path(key, pointer['generation']), 'rb') as f:
+                        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except FileNotFoundError:
+                    # Replaced between reading the pointer and opening the segment
+                    return None
+                # The previous mapping is released once no response uses it anymore
+                current = (pointer['generation'], pointer['firmware_id'], pointer['sha256'], mapped)
+                self._maps[key] = current
+        return memoryview(current[3])
+
+    def iter_chunks(self, firmware, start, end, chunk_size):
+        data = self.get(firmware)
+        if data is None:
+            yield from firmware.iter_file_chunks(start, end, chunk_size)
+            return
+        for offset in range(start, min(end, len(data)), chunk_size):
+            # Only the chunk being sent is copied, never the whole image
+            yield bytes(data[offset:min(offset + chunk_size, end)])
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'publishes': self.publishes,
+            'mapped_segments': len(self._maps),
+        }
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def get_shared_firmware_cache():
+    """
+    The host wide cache in FIRMWARE_SHARED_CACHE_PATH, or None when it is not configured.
+    """
+    global _shared_cache
+    path = getattr(settings, 'FIRMWARE_SHARED_CACHE_PATH', '')
+    if not path:
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = SharedFirmwareCache(path)
+        return _shared_cache
+
+
+@receiver(setting_changed)
+def reset_shared_cache(setting, **kwargs):
+    global _shared_cache
+    if setting == 'FIRMWARE_SHARED_CACHE_PATH':
+        _shared_cache = None
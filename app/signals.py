@@ -0,0 +1,78 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+from .blobcache import get_blob_cache
+from .models import Device, FleetCounter, Firmware, LatestFirmware, normalize_hw_rev
+from .storage import FILESYSTEM, get_storage
+
+
+# Sent with hw_revisions whose latest firmware may have changed, e.g. for caches of the latest version
+latest_firmware_changed = Signal()
+
+
+@receiver(post_save, sender=Firmware)
+def update_latest_firmware_on_save(sender, instance, **kwargs):
+    key = normalize_hw_rev(instance.hw_compability)
+    # The hw revision may have been edited, then the old revision needs a new latest firmware as well
+    stale = set(LatestFirmware.objects.filter(firmware=instance).exclude(hw_revision=key).values_list('hw_revision', flat=True))
+    for hw_rev in {key} | stale:
+        LatestFirmware.refresh(hw_rev)
+    latest_firmware_changed.send(sender=LatestFirmware, hw_revisions={key} | stale)
+
+
+@receiver(post_delete, sender=Firmware)
+def update_latest_firmware_on_delete(sender, instance, **kwargs):
+    LatestFirmware.refresh(instance.hw_compability)
+    latest_firmware_changed.send(sender=LatestFirmware, hw_revisions={normalize_hw_rev(instance.hw_compability)})
+
+
+def delete_unused_firmware_file(sha256):
+    """
+    Remove the content addressed file of an image once no firmware uses it anymore. Checked when the
+    transaction commits, so an image saved meanwhile by another firmware keeps its file.
+    """
+    def delete():
+        if not Firmware.objects.filter(storage=FILESYSTEM, file_sha256=sha256).exists():
+            get_storage(FILESYSTEM).delete_digest(sha256)
+    transaction.on_commit(delete)
+
+
+@receiver(post_delete, sender=Firmware)
+def delete_firmware_file(sender, instance, **kwargs):
+    if instance.storage == FILESYSTEM and instance.file_sha256:
+        delete_unused_firmware_file(instance.file_sha256)
+
+
+@receiver(post_save, sender=Firmware)
+def delete_replaced_firmware_file(sender, instance, **kwargs):
+    # A new image, or moving the image to another storage, may leave the previous file unused
+    storage, sha256 = getattr(instance, '_stored_image', (None, None))
+    if storage == FILESYSTEM and sha256 and (instance.storage, instance.file_sha256) != (storage, sha256):
+        delete_unused_firmware_file(sha256)
+
+
+@receiver(post_save, sender=Firmware)
+def invalidate_blob_cache_on_save(sender, instance, **kwargs):
+    # Only a replaced image needs invalidation, the image is deferred on metadata only saves.
+    # Cache keys include the digest, this frees the memory of the old image right away.
+    cache = get_blob_cache()
+    if cache is not None and 'file' not in instance.get_deferred_fields():
+        cache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=Firmware)
+def invalidate_blob_cache_on_delete(sender, instance, **kwargs):
+    cache = get_blob_cache()
+    if cache is not None:
+        cache.invalidate(instance.pk)
+
+
+@receiver(post_delete, sender=Device)
+def count_deleted_device(sender, instance, **kwargs):
+    FleetCounter.move(getattr(instance, '_counted_as', None) or instance.fleet_key(), None)
+
+
+@receiver(post_delete, sender=Firmware)
+def delete_firmware_counter(sender, instance, **kwargs):
+    # Its devices are set to no firmware without being saved, they only count for their hw revision now
+    FleetCounter.objects.filter(kind=FleetCounter.FIRMWARE, key=str(instance.pk)).delete()
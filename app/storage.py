@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.db import models
+from django.db.models import Value
+from django.db.models.functions import Substr
+from django.http import HttpResponse
+import os
+import tempfile
+
+DATABASE = 'db'
+FILESYSTEM = 'fs'
+STORAGE_CHOICES = [(DATABASE, 'Database'), (FILESYSTEM, 'File system')]
+
+
+class DatabaseFirmwareStorage:
+    """
+    Keeps the firmware image in the Firmware.file column.
+    """
+    name = DATABASE
+
+    def save(self, firmware, data):
+        firmware.file = data
+        firmware.storage = self.name
+
+    def delete(self, firmware):
+        pass
+
+    def rows(self, firmware):
+        # Every read of an image goes to the database the firmware was loaded from, so a download
+        # doesn't mix chunks from replicas at different lag
+        return type(firmware)._base_manager.using(firmware._state.db).filter(pk=firmware.pk)
+
+    def exists(self, firmware):
+        return self.rows(firmware).filter(file__isnull=False).exists()
+
+    def read(self, firmware):
+        data = self.rows(firmware).values_list('file', flat=True).get()
+        return bytes(data) if data is not None else b""
+
+    def iter_chunks(self, firmware, start, end, chunk_size):
+        # One round trip per chunk, SQL substring positions are 1-based
+        for offset in range(start, end, chunk_size):
+            length = min(chunk_size, end - offset)
+            chunk = self.rows(firmware).annotate(
+                chunk=Substr('file', Value(offset + 1), Value(length), output_field=models.BinaryField())
+            ).values_list('chunk', flat=True).get()
+            if not chunk:
+                return
+            yield bytes(chunk)
+
+    def open(self, firmware):
+        # Not a file, can't be handed to sendfile
+        return None
+
+    def offload_response(self, firmware):
+        return None
+
+
+class FileSystemFirmwareStorage:
+    """
+    Stores firmware images content addressed by their SHA-256 digest in a local directory,
+    so identical images are stored once and a file never changes after it has been written.
+    """
+    name = FILESYSTEM
+
+    def __init__(self, root=None):
+        self.root = str(root or settings.FIRMWARE_STORAGE_ROOT)
+
+    def relative_path(self, sha256):
+        return os.path.join(sha256[:2], sha256[2:4], sha256)
+
+    def digest_path(self, sha256):
+        return os.path.join(self.root, self.relative_path(sha256))
+
+    def path(self, firmware):
+        return self.digest_path(firmware.file_sha256)
+
+    def save(self, firmware, data):
+        path = self.path(firmware)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write to a temporary file first so readers never see a partial image
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        firmware.file = None
+        firmware.storage = self.name
+
+    def delete(self, firmware):
+        self.delete_digest(firmware.file_sha256)
+
+    def delete_digest(self, sha256):
+        try:
+            os.remove(self.digest_path(sha256))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, firmware):
+        return os.path.exists(self.path(firmware))
+
+    def read(self, firmware):
+        with open(self.path(firmware), 'rb') as f:
+            return f.read()
+
+    def iter_chunks(self, firmware, start, end, chunk_size):
+        with open(self.path(firmware), 'rb') as f:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    return
+                remaining -= len(chunk)
+                yield chunk
+
+    def open(self, firmware):
+        return open(self.path(firmware), 'rb')
+
+    def offload_response(self, firmware):
+        """
+        Empty response telling the front web server to send the file itself, or None when
+        FIRMWARE_SENDFILE is not configured.
+        """
+        mode = getattr(settings, 'FIRMWARE_SENDFILE', '')
+        if mode == 'x-sendfile':
+            response = HttpResponse()
+            response['X-Sendfile'] = self.path(firmware)
+        elif mode == 'x-accel-redirect':
+            response = HttpResponse()
+            prefix = getattr(settings, 'FIRMWARE_ACCEL_REDIRECT_PREFIX', '/protected/firmware/')
+            response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + self.relative_path(firmware.file_sha256).replace(os.sep, '/')
+        else:
+            return None
+        return response
+
+
+def get_storage(name=None):
+    """
+    Storage backend by name, or the one configured with FIRMWARE_STORAGE for new images.
+    """
+    if name is None:
+        name = getattr(settings, 'FIRMWARE_STORAGE', DATABASE)
+    if name == DATABASE:
+        return DatabaseFirmwareStorage()
+    if name == FILESYSTEM:
+        return FileSystemFirmwareStorage()
+    raise ValueError("Unknown firmware storage '{}'".format(name))
@@ -2,12 +2,17 @@ from django.test import TestCase
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
 from .admin import FirmwareAdmin
 from .forms import FirmwareFormAdmin
-from .models import Firmware
+from .models import Device, Firmware, History
 from io import BytesIO
+import hashlib
 
 class MockRequest(object):
     def __init__(self, user=None, form=None):
@@ -38,6 +43,8 @@ class FirmwareAdminTestCase(TestCase):
         self.assertEqual("v5", fw_obj.hw_compability)
         self.assertEqual(self.testfile.name, fw_obj.file_name)
         self.assertEqual(self.filelen, len(fw_obj.file))
+        self.assertEqual(self.filelen, fw_obj.file_size)
+        self.assertEqual(hashlib.sha256(self.testfile.getvalue()).hexdigest(), fw_obj.file_sha256)
         self.assertTrue((now - timedelta(minutes=2)) < fw_obj.date_added)
     
 
@@ -79,3 +86,32 @@ class FirmwareAdminTestCase(TestCase):
         self.assertFalse(form.is_valid())
         with self.assertRaises(Firmware.DoesNotExist):
             Firmware.objects.get(fw_version="0.1.0-beta")
+
+
+# Rendering admin pages needs a static files storage that works without collectstatic
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class ChangelistQueryTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.super_user = User.objects.create_superuser(username='super', email='super@email.org', password='pass')
+        now = timezone.now()
+        fw = Firmware.objects.create(fw_version="0.1.0", hw_compability="v5", date_added=now, file_name="fw_file_v0.1.0.cyacd2", file=bytes("file_0.1.0_data",'utf-8'))
+        dv = Device.objects.create(serial_number="12345", created=now, firmware=fw)
+        History.objects.create(device=dv, fw_update_started=now, fw_update_success=True, firmware=fw, device_firmware="0.0.1", reason="OK")
+
+    def test_changelists_do_not_select_file(self):
+        self.client.force_login(self.super_user)
+        file_column = "{}.{}".format(connection.ops.quote_name(Firmware._meta.db_table), connection.ops.quote_name('file'))
+        for model in ['firmware', 'device', 'history']:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('admin:app_{}_changelist'.format(model)))
+            self.assertEqual(response.status_code, 200)
+            for query in queries.captured_queries:
+                self.assertNotIn(file_column, query['sql'])
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:app_device_add'))
+        self.assertEqual(response.status_code, 200)
+        for query in queries.captured_queries:
+            self.assertNotIn(file_column, query['sql'])
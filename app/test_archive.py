@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta, timezone as dt_timezone
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from unittest import mock
+from .archive import HistoryArchive, get_history_archive
+from .models import Device, Firmware, History
+from io import StringIO
+import os
+import shutil
+import tempfile
+
+
+class HistoryArchiveTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.now = timezone.now()
+        self.fw = Firmware.objects.create(fw_version="1.0.0", hw_compability="v5", date_added=self.now, file_name="fw_file.cyacd2", file=b"data")
+        self.device = Device.objects.create(serial_number="12345", created=self.now, firmware=self.fw)
+        self.other = Device.objects.create(serial_number="54321", created=self.now, firmware=self.fw)
+        # Two old months and a recent result
+        for started, device in [(datetime(2024, 1, 10, tzinfo=dt_timezone.utc), self.device), (datetime(2024, 1, 20, tzinfo=dt_timezone.utc), self.other),
+                (datetime(2024, 2, 5, tzinfo=dt_timezone.utc), self.device), (self.now, self.device)]:
+            History.objects.create(device=device, fw_update_started=started, fw_update_success=True, firmware=self.fw, device_firmware="0.9.0", hardware_revision="v5")
+        self.archive = HistoryArchive(self.path)
+
+    def test_archive_moves_old_rows(self):
+        self.assertEqual(3, self.archive.archive(self.now - timedelta(days=30), batch_size=2))
+        self.assertEqual([self.now], list(History.objects.values_list('fw_update_started', flat=True)))
+        stats = self.archive.stats()
+        # Each batch is split by month: [Jan, Jan] and [Feb]
+        self.assertEqual(2, stats['segments'])
+        self.assertEqual(3, stats['rows'])
+        self.assertEqual('2024-01-10T00:00:00+00:00', stats['oldest'])
+        self.assertEqual(0, stats['uncommitted'])
+        self.assertTrue(os.path.exists(os.path.join(self.path, '2024-01')))
+        self.assertEqual([], self.archive.verify())
+
+        # Nothing left to do
+        self.assertEqual(0, self.archive.archive(self.now - timedelta(days=30)))
+
+    def test_query(self):
+        self.archive.archive(self.now - timedelta(days=30))
+        rows = list(self.archive.query())
+        self.assertEqual(3, len(rows))
+        self.assertEqual("12345", rows[0]['serial_number'])
+        self.assertEqual("1.0.0", rows[0]['fw_version'])
+        self.assertEqual(self.device.pk, rows[0]['device_id'])
+
+        january = list(self.archive.query(datetime(2024, 1, 1, tzinfo=dt_timezone.utc), datetime(2024, 2, 1, tzinfo=dt_timezone.utc)))
+        self.assertEqual(2, len(january))
+        self.assertEqual(["54321"], [row['serial_number'] for row in self.archive.query(device="54321")])
+
+        # Segments outside the range are not opened
+        with mock.patch.object(self.archive, 'read_segment', wraps=self.archive.read_segment) as read_segment:
+            list(self.archive.query(datetime(2024, 2, 1, tzinfo=dt_timezone.utc)))
+        self.assertEqual(1, read_segment.call_count)
+
+    def test_interrupted_archive_is_finished(self):
+        # The archiver dies after writing the first segment
+        with mock.patch('app.archive.HistoryArchive.commit_segment', side_effect=RuntimeError("killed")):
+            with self.assertRaises(RuntimeError):
+                self.archive.archive(self.now - timedelta(days=30))
+        self.assertEqual(1, self.archive.stats()['uncommitted'])
+        self.assertEqual(4, History.objects.count())
+
+        self.assertEqual(1, self.archive.archive(self.now - timedelta(days=30)))
+        self.assertEqual(1, History.objects.count())
+        stats = self.archive.stats()
+        self.assertEqual(3, stats['rows'])
+        self.assertEqual(0, stats['uncommitted'])
+        self.assertEqual(3, len(list(self.archive.query())))
+
+    def test_verify_detects_damage(self):
+        self.archive.archive(self.now - timedelta(days=30))
+        segment = self.archive.read_manifest()['segments'][0]
+        with open(os.path.join(self.path, segment['name']), 'ab') as f:
+            f.write(b"garbage")
+        self.assertEqual([segment['name']], self.archive.verify())
+
+    def test_command(self):
+        with override_settings(HISTORY_ARCHIVE_PATH=self.path, HISTORY_ARCHIVE_AFTER_DAYS=30):
+            out = StringIO()
+            call_command('archive_history', 'run', stdout=out)
+            self.assertIn("Archived 3 result(s)", out.getvalue())
+            out = StringIO()
+            call_command('archive_history', 'status', stdout=out)
+            self.assertIn("3 result(s)", out.getvalue())
+            out = StringIO()
+            call_command('archive_history', 'query', '--from', '2024-02-01', stdout=out)
+            lines = out.getvalue().splitlines()
+            self.assertEqual(2, len(lines))
+            self.assertTrue(lines[0].startswith("id,device_id,fw_update_started"))
+
+    def test_view(self):
+        self.archive.archive(self.now - timedelta(days=30))
+        user = User.objects.create_superuser(username='super', email='super@email.org', password='pass')
+        self.client.force_login(user)
+        with override_settings(HISTORY_ARCHIVE_PATH=self.path):
+            response = self.client.get(reverse('archived_history'), {'from': '2024-01-01', 'to': '2024-02-01', 'device': '12345'})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(["2024-01-10T00:00:00+00:00"], [row['fw_update_started'] for row in response.json()['results']])
+            self.assertEqual(400, self.client.get(reverse('archived_history'), {'from': 'yesterday'}).status_code)
+            self.assertEqual(400, self.client.get(reverse('archived_history'), {'limit': '-1'}).status_code)
+            self.assertEqual(400, self.client.get(reverse('archived_history'), {'firmware': 'x'}).status_code)
+            self.assertEqual(3, len(self.client.get(reverse('archived_history'), {'firmware': self.fw.pk}).json()['results']))
+            self.assertEqual([], self.client.get(reverse('archived_history'), {'firmware': self.fw.pk + 1}).json()['results'])
+            self.assertEqual(3, self.client.get(reverse('stats')).json()['history_archive']['rows'])
+        with override_settings(HISTORY_ARCHIVE_PATH=''):
+            self.assertIsNone(get_history_archive())
+            self.assertEqual(404, self.client.get(reverse('archived_history')).status_code)
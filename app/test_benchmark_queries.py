@@ -0,0 +1,27 @@
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from unittest import skipUnless
+from .management.commands.benchmark_queries import problems
+from .models import Device, History
+from io import StringIO
+
+
+class BenchmarkQueriesTestCase(TestCase):
+    def test_problems(self):
+        plan = "2 0 0 SCAN app_history\n3 0 0 SEARCH app_device USING INTEGER PRIMARY KEY (rowid=?)\n4 0 0 USE TEMP B-TREE FOR ORDER BY"
+        self.assertEqual(["2 0 0 SCAN app_history", "4 0 0 USE TEMP B-TREE FOR ORDER BY"], problems('sqlite', plan, {'app_history'}))
+        self.assertEqual([], problems('sqlite', "2 0 0 SCAN app_history USING INDEX history_started_idx", {'app_history'}, paged=True))
+        self.assertEqual(["2 0 0 SCAN app_history USING INDEX history_started_idx"],
+            problems('sqlite', "2 0 0 SCAN app_history USING INDEX history_started_idx", {'app_history'}))
+        self.assertEqual([], problems('sqlite', "2 0 0 SCAN TABLE app_firmware", {'app_history'}))
+        self.assertEqual([], problems('microsoft', plan, {'app_history'}))
+
+    @skipUnless(connection.vendor == 'sqlite', "Plans are only checked on SQLite")
+    def test_hot_queries_use_indexes(self):
+        out = StringIO()
+        call_command('benchmark_queries', devices=500, results_per_device=5, hw_revisions=3, releases=5, repeat=1, fail_on_scan=True, stdout=out)
+        self.assertIn("history changelist", out.getvalue())
+        # The seeded data is rolled back
+        self.assertFalse(Device.objects.exists())
+        self.assertFalse(History.objects.exists())
@@ -0,0 +1,116 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from .blobcache import DiskTier, FirmwareBlobCache, MemoryTier, get_blob_cache
+from .models import Firmware
+import shutil
+import tempfile
+
+
+class MemoryTierTestCase(TestCase):
+
+    def test_lru_eviction_by_bytes(self):
+        tier = MemoryTier(max_bytes=10)
+        tier.put((1, "a"), b"1234")
+        tier.put((2, "b"), b"5678")
+        # Touch 1 so 2 is the least recently used
+        self.assertEqual(b"1234", tier.get((1, "a")))
+        tier.put((3, "c"), b"90ab")
+        self.assertIsNone(tier.get((2, "b")))
+        self.assertEqual(b"1234", tier.get((1, "a")))
+        self.assertEqual(8, tier.size)
+        self.assertEqual(1, tier.evictions)
+
+        # Too big to ever fit
+        tier.put((4, "d"), b"0123456789ab")
+        self.assertIsNone(tier.get((4, "d")))
+
+    def test_invalidate(self):
+        tier = MemoryTier(max_bytes=10)
+        tier.put((1, "a"), b"1234")
+        tier.invalidate(1)
+        self.assertIsNone(tier.get((1, "a")))
+        self.assertEqual(0, tier.size)
+
+
+class DiskTierTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    def test_put_get_evict(self):
+        tier = DiskTier(self.path, max_bytes=10)
+        tier.put((1, "a"), b"1234")
+        self.assertEqual(b"1234", bytes(tier.get((1, "a"))))
+        tier.put((2, "b"), b"5678")
+        tier.put((3, "c"), b"90ab")
+        self.assertEqual(8, tier.size)
+        self.assertEqual(1, tier.evictions)
+
+        tier.invalidate(3)
+        self.assertIsNone(tier.get((3, "c")))
+
+
+class FirmwareBlobCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.data = b"some dummy bcode data: \x00\x01\x02"
+        self.fw = Firmware.objects.create(fw_version="1.0.0", hw_compability="v5", date_added=timezone.now(), file_name="fw_file.cyacd2", file=self.data)
+
+    def test_tiers(self):
+        cache = FirmwareBlobCache(memory_bytes=1024, disk_path=self.path, disk_bytes=1024)
+        self.assertEqual(self.data, bytes(cache.get(self.fw)))
+        self.assertEqual(1, cache.misses)
+
+        self.assertEqual(self.data, bytes(cache.get(self.fw)))
+        self.assertEqual(1, cache.memory_hits)
+
+        # Served from the memory mapped file once it is gone from memory
+        cache.memory.invalidate(self.fw.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.data, bytes(cache.get(self.fw)))
+        self.assertEqual(1, cache.disk_hits)
+
+        cache.invalidate(self.fw.pk)
+        self.assertEqual(self.data, bytes(cache.get(self.fw)))
+        self.assertEqual(2, cache.misses)
+
+    def test_iter_chunks(self):
+        cache = FirmwareBlobCache(memory_bytes=1024)
+        self.assertEqual([self.data[2:7], self.data[7:10]], list(cache.iter_chunks(self.fw, 2, 10, 5)))
+
+    def test_firmware_reads_through_configured_cache(self):
+        with self.settings(FIRMWARE_BLOB_CACHE={'MEMORY_BYTES': 1024}):
+            cache = get_blob_cache()
+            self.assertEqual(self.data, b"".join(self.fw.iter_file_chunks()))
+            with self.assertNumQueries(0):
+                self.assertEqual(self.data, b"".join(self.fw.iter_file_chunks()))
+            self.assertEqual(1, cache.misses)
+            self.assertEqual(1, cache.memory_hits)
+
+            # Replacing the image invalidates the cached one
+            fw = Firmware.objects.get(pk=self.fw.pk)
+            fw.set_file(fw.file_name, b"new data")
+            fw.save()
+            self.assertEqual(1, cache.invalidations)
+            self.assertEqual(b"new data", b"".join(fw.iter_file_chunks()))
+
+        self.assertIsNone(get_blob_cache())
+
+    def test_stats_view(self):
+        user = User.objects.create_superuser(username='super', email='super@email.org', password='pass')
+        self.client.force_login(user)
+        with self.settings(FIRMWARE_BLOB_CACHE={'MEMORY_BYTES': 1024}):
+            b"".join(self.fw.iter_file_chunks())
+            response = self.client.get(reverse('stats'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, response.json()['blob_cache']['misses'])
+        self.assertEqual(len(self.data), response.json()['blob_cache']['memory_bytes'])
+
+        self.client.logout()
+        response = self.client.get(reverse('stats'))
+        self.assertEqual(302, response.status_code)
@@ -0,0 +1,89 @@
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from .delta import DeltaError, apply_delta, make_delta
+from .models import Firmware, FirmwareDelta
+from io import StringIO
+
+
+def make_image(lines, changed=()):
+    # Image in the style of a .cyacd2 file, hex text lines
+    return b"".join(
+        (":{:08X}{}\n".format(i, "FF" if i in changed else "00") * 2).encode() for i in range(lines))
+
+
+class DeltaFormatTestCase(SimpleTestCase):
+
+    def test_round_trip(self):
+        source = make_image(2000)
+        target = make_image(2000, changed={3, 500, 1999}) + b":EXTRA\n"
+        delta = make_delta(source, target)
+        self.assertEqual(target, apply_delta(source, delta))
+        self.assertLess(len(delta), len(target) // 10)
+
+    def test_unrelated_images(self):
+        for source, target in [(b"", b"abc"), (b"abc", b""), (b"0123456789" * 10, b"abcdefghij" * 10), (b"", b"")]:
+            self.assertEqual(target, apply_delta(source, make_delta(source, target)))
+
+    def test_invalid_delta(self):
+        delta = make_delta(b"source data " * 10, b"target data " * 10)
+        with self.assertRaises(DeltaError):
+            apply_delta(b"other source", delta)
+        with self.assertRaises(DeltaError):
+            apply_delta(b"source data " * 10, b"XXXX" + delta[4:])
+        with self.assertRaises(DeltaError):
+            apply_delta(b"", b"")
+
+
+@override_settings(FIRMWARE_DELTA_MAX_SOURCES=5)
+class FirmwareDeltaTestCase(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.images = {}
+        self.fws = {}
+        for i, fw_version in enumerate(["1.0.0", "1.1.0", "1.2.0", "2.0.0"]):
+            self.images[fw_version] = make_image(500, changed={i * 100})
+            self.fws[fw_version] = Firmware.objects.create(fw_version=fw_version, hw_compability="v5", date_added=now, file_name="fw.cyacd2", file=self.images[fw_version])
+
+    def test_for_device_version(self):
+        target = self.fws["2.0.0"]
+        delta = FirmwareDelta.for_device_version(target, "1.2.0", build=True)
+        self.assertEqual(self.fws["1.2.0"], delta.source)
+        self.assertTrue(delta.is_useful())
+        self.assertEqual(self.images["2.0.0"], apply_delta(self.images["1.2.0"], bytes(delta.data)))
+
+        # Cached on the second request
+        with self.assertNumQueries(3):
+            self.assertEqual(delta.pk, FirmwareDelta.for_device_version(target, "1.2.0", build=True).pk)
+
+        self.assertIsNone(FirmwareDelta.for_device_version(target, "2.0.0"))
+        self.assertIsNone(FirmwareDelta.for_device_version(target, "0.0.1"))
+        self.assertIsNone(FirmwareDelta.for_device_version(target, None))
+        with self.settings(FIRMWARE_DELTA_MAX_SOURCES=2):
+            self.assertIsNone(FirmwareDelta.for_device_version(target, "1.0.0"))
+            self.assertIsNotNone(FirmwareDelta.for_device_version(target, "1.1.0", build=True))
+        with self.settings(FIRMWARE_DELTA_MAX_SOURCES=0):
+            self.assertIsNone(FirmwareDelta.for_device_version(target, "1.2.0", build=True))
+
+    def test_requests_only_get_stored_deltas(self):
+        target = self.fws["2.0.0"]
+        # Never built while a device waits
+        self.assertIsNone(FirmwareDelta.for_device_version(target, "1.2.0"))
+        self.assertFalse(FirmwareDelta.objects.exists())
+        FirmwareDelta.for_device_version(target, "1.2.0", build=True)
+        self.assertEqual(self.fws["1.2.0"], FirmwareDelta.for_device_version(target, "1.2.0").source)
+
+    def test_rebuilt_when_image_replaced(self):
+        target = self.fws["2.0.0"]
+        delta = FirmwareDelta.for_device_version(target, "1.2.0", build=True)
+        target.set_file("fw.cyacd2", make_image(500, changed={7}))
+        target.save()
+        new_delta = FirmwareDelta.for_device_version(target, "1.2.0", build=True)
+        self.assertEqual(delta.pk, new_delta.pk)
+        self.assertNotEqual(delta.sha256, new_delta.sha256)
+        self.assertEqual(make_image(500, changed={7}), apply_delta(self.images["1.2.0"], bytes(new_delta.data)))
+
+    def test_build_firmware_deltas_command(self):
+        call_command('build_firmware_deltas', stdout=StringIO())
+        self.assertEqual(3, FirmwareDelta.objects.filter(target=self.fws["2.0.0"]).count())
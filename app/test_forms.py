@@ -27,6 +27,20 @@ class FirmwareFormAdminTestCase(TestCase):
         file = form.files["file"].read()
         self.assertEqual(self.filelen, len(file))
 
+    def test_same_version_for_differently_spelled_hw_rev(self):
+        Firmware.objects.create(fw_version="0.1.0", hw_compability="v4", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        data = self.testfile.read()
+        form = FirmwareFormAdmin(data={"fw_version": "0.1.0", "hw_compability": " V4"}, files={"file": SimpleUploadedFile(self.testfile.name, data)})
+        self.assertFalse(form.is_valid())
+
+        form = FirmwareFormAdmin(data={"fw_version": "0.2.0", "hw_compability": " V4"}, files={"file": SimpleUploadedFile(self.testfile.name, data)})
+        self.assertTrue(form.is_valid())
+
+    def test_firmware_version_with_four_numbers(self):
+        form = FirmwareFormAdmin(data={"fw_version": "1.0.0.1", "hw_compability": "v4"}, files={"file": SimpleUploadedFile(self.testfile.name, self.testfile.read())})
+        self.assertFalse(form.is_valid())
+        self.assertIn("fw_version", form.errors)
+
     def test_invalid_form(self):
         form = FirmwareFormAdmin(data={"fw_version": "0.1.0-beta", "hw_compability": "v4"})
         self.assertFalse(form.is_valid())
@@ -1,8 +1,22 @@
 from django.test import TestCase
 from datetime import timedelta
 from django.utils import timezone
-from .models import Firmware, Device, History
+from .archive import get_history_archive
+from .models import Firmware, FirmwareEncoding, Device, FleetCounter, History, LatestFirmware, RolloutStats, version_sort_key
 from django.core.exceptions import MultipleObjectsReturned
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.urls import reverse
+from datetime import datetime, timezone as dt_timezone
+from io import StringIO
+import shutil
+import tempfile
+from unittest import mock
+import gzip
+import hashlib
+import lzma
 
 class FirmwareTestCase(TestCase):
     def setUp(self):
@@ -22,6 +36,25 @@ class FirmwareTestCase(TestCase):
         self.assertEqual(str(fw_1_0_0), fw_1_0_0.fw_version)
         self.assertEqual(str(fw_2_0_0), fw_2_0_0.fw_version)
 
+    def test_hw_revision_key(self):
+        fw = Firmware.objects.get(fw_version="1.0.0")
+        self.assertEqual("v4", fw.hw_revision_key)
+        fw.hw_compability = " HW-V4b "
+        fw.save(update_fields=['hw_compability'])
+        self.assertEqual("hw-v4b", Firmware.objects.get(pk=fw.pk).hw_revision_key)
+
+    def test_equal_version_keys_newest_upload_first(self):
+        Firmware.objects.create(fw_version="9.0", hw_compability="v9", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        newest = Firmware.objects.create(fw_version="9.0.0", hw_compability="v9", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        self.assertEqual(newest, Firmware.get_latest_fw_object(Firmware, "v9"))
+
+    def test_version_unique_per_normalized_hw_revision(self):
+        fw = Firmware.objects.get(fw_version="1.0.0")
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Firmware.objects.create(fw_version="1.0.0", hw_compability=" V4", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        Firmware.objects.create(fw_version="1.0.0", hw_compability="v4b", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        self.assertEqual(fw, Firmware.get_latest_fw_object(Firmware, "V4 "))
+
     def test_get_latest_fw_object(self):
         expected_object = Firmware.objects.get(fw_version="0.1.0")
         test_objectet = Firmware.get_latest_fw_object(Firmware, "v3")
@@ -50,6 +83,175 @@ class FirmwareTestCase(TestCase):
         test_objectet = Firmware.get_latest_fw_object(Firmware, "v4")
         self.assertEqual(expected_object, test_objectet)
 
+    def test_get_latest_fw_object_case_insensitive(self):
+        expected_object = Firmware.objects.get(fw_version="2.0.0")
+        self.assertEqual(expected_object, Firmware.get_latest_fw_object(Firmware, "V5"))
+        self.assertIsNone(Firmware.get_latest_fw_object(Firmware, None))
+        self.assertIsNone(Firmware.get_latest_fw_object(Firmware, "v20"))
+
+    def test_file_deferred_by_default(self):
+        fw = Firmware.objects.get(fw_version="2.0.0")
+        self.assertIn('file', fw.get_deferred_fields())
+        fw = Firmware.objects.with_file().get(fw_version="2.0.0")
+        self.assertNotIn('file', fw.get_deferred_fields())
+        self.assertEqual(bytes("file_2.0.0_data",'utf-8'), bytes(fw.file))
+        self.assertIn('file', Firmware.get_latest_fw_object(Firmware, "v5").get_deferred_fields())
+
+    def test_file_digest_set_on_create(self):
+        fw = Firmware.objects.get(fw_version="2.0.0")
+        data = bytes("file_2.0.0_data",'utf-8')
+        self.assertEqual(len(data), fw.file_size)
+        self.assertEqual(hashlib.sha256(data).hexdigest(), fw.file_sha256)
+        self.assertEqual('"{}"'.format(fw.file_sha256), fw.etag)
+
+    def test_file_digest_updated_on_replace(self):
+        fw = Firmware.objects.with_file().get(fw_version="2.0.0")
+        # Saving other fields keeps the digest
+        fw.file_name = "renamed.cyacd2"
+        fw.save()
+        self.assertEqual(hashlib.sha256(b"file_2.0.0_data").hexdigest(), Firmware.objects.get(pk=fw.pk).file_sha256)
+
+        fw.file = b"new image data"
+        fw.save()
+        fw = Firmware.objects.get(pk=fw.pk)
+        self.assertEqual(hashlib.sha256(b"new image data").hexdigest(), fw.file_sha256)
+        self.assertEqual(len(b"new image data"), fw.file_size)
+
+        fw = Firmware.objects.with_file().get(pk=fw.pk)
+        fw.file = b"newer image"
+        fw.save(update_fields=['file'])
+        self.assertEqual(hashlib.sha256(b"newer image").hexdigest(), Firmware.objects.get(pk=fw.pk).file_sha256)
+
+    def test_file_not_redigested_when_loaded_lazily(self):
+        fw = Firmware.objects.get(fw_version="2.0.0")
+        self.assertEqual(b"file_2.0.0_data", bytes(fw.file))
+        fw.file_name = "renamed.cyacd2"
+        with mock.patch.object(Firmware, 'set_file') as set_file:
+            fw.save()
+        set_file.assert_not_called()
+
+    def test_replaced_file_keeps_storage(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        fw = Firmware.objects.get(fw_version="2.0.0")
+        with self.settings(FIRMWARE_STORAGE='fs', FIRMWARE_STORAGE_ROOT=root):
+            fw.file = b"new image data"
+            fw.save()
+        fw = Firmware.objects.with_file().get(pk=fw.pk)
+        self.assertEqual('db', fw.storage)
+        self.assertEqual(b"new image data", bytes(fw.file))
+
+    def test_iter_file_chunks(self):
+        fw = Firmware.objects.get(fw_version="2.0.0")
+        data = bytes("file_2.0.0_data",'utf-8')
+        self.assertEqual(len(data), fw.get_file_size())
+        self.assertEqual([data[0:4], data[4:8], data[8:12], data[12:]], list(fw.iter_file_chunks(chunk_size=4)))
+        self.assertEqual([data[5:9], data[9:10]], list(fw.iter_file_chunks(5, 10, chunk_size=4)))
+
+    def test_compressed_encodings(self):
+        fw = Firmware.objects.get(fw_version="2.0.0")
+        # Too small to shrink
+        self.assertEqual({}, FirmwareEncoding.available_for(fw))
+
+        data = b"0123456789abcdef" * 256
+        fw.set_file(fw.file_name, data)
+        fw.save()
+        encodings = FirmwareEncoding.available_for(fw)
+        self.assertEqual({FirmwareEncoding.GZIP, FirmwareEncoding.XZ}, set(encodings))
+        self.assertEqual(data, gzip.decompress(FirmwareEncoding.objects.get(pk=encodings['gzip'].pk).data))
+        self.assertEqual(data, lzma.decompress(FirmwareEncoding.objects.get(pk=encodings['xz'].pk).data))
+
+        # Stale variants are replaced with the image
+        fw.set_file(fw.file_name, data[::-1])
+        fw.save()
+        self.assertEqual(data[::-1], gzip.decompress(FirmwareEncoding.objects.get(firmware=fw, encoding='gzip').data))
+        self.assertEqual(2, FirmwareEncoding.objects.filter(firmware=fw).count())
+
+    def test_get_latest_fw_object_single_query(self):
+        with self.assertNumQueries(1):
+            Firmware.get_latest_fw_object(Firmware, "v5")
+
+
+class LatestFirmwareTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        self.fw1 = Firmware.objects.create(fw_version="9.0.0", hw_compability="v5", date_added=(now - timedelta(days=10)), file_name="fw_file_v9.0.0.cyacd2", file=bytes("file_9.0.0_data",'utf-8'))
+        self.fw2 = Firmware.objects.create(fw_version="10.0.0", hw_compability="v5", date_added=(now - timedelta(days=8)), file_name="fw_file_v10.0.0.cyacd2", file=bytes("file_10.0.0_data",'utf-8'))
+
+    def test_index_updated_on_save(self):
+        self.assertEqual(1, LatestFirmware.objects.count())
+        self.assertEqual(self.fw2, LatestFirmware.objects.get(hw_revision="v5").firmware)
+        self.assertEqual("10.0.0", LatestFirmware.objects.get(hw_revision="v5").fw_version)
+
+        fw3 = Firmware.objects.create(fw_version="10.1.0", hw_compability="V5", date_added=timezone.now(), file_name="fw_file_v10.1.0.cyacd2", file=bytes("file_10.1.0_data",'utf-8'))
+        self.assertEqual(1, LatestFirmware.objects.count())
+        self.assertEqual(fw3, LatestFirmware.objects.get(hw_revision="v5").firmware)
+
+    def test_index_updated_on_delete(self):
+        self.fw2.delete()
+        self.assertEqual(self.fw1, LatestFirmware.objects.get(hw_revision="v5").firmware)
+
+        self.fw1.delete()
+        self.assertFalse(LatestFirmware.objects.exists())
+
+    def test_index_updated_on_hw_rev_change(self):
+        self.fw2.hw_compability = "v6"
+        self.fw2.save()
+        self.assertEqual(self.fw1, LatestFirmware.objects.get(hw_revision="v5").firmware)
+        self.assertEqual(self.fw2, LatestFirmware.objects.get(hw_revision="v6").firmware)
+
+    def test_index_uses_semantic_version_order(self):
+        fw3 = Firmware.objects.create(fw_version="10.0.0-rc1", hw_compability="v5", date_added=timezone.now(), file_name="fw_file_v10.0.0rc1.cyacd2", file=bytes("file_10.0.0rc1_data",'utf-8'))
+        self.assertEqual(self.fw2, LatestFirmware.objects.get(hw_revision="v5").firmware)
+        fw4 = Firmware.objects.create(fw_version="10.0.0.post1", hw_compability="v5", date_added=timezone.now(), file_name="fw_file_v10.0.0post1.cyacd2", file=bytes("file_10.0.0post1_data",'utf-8'))
+        self.assertEqual(fw4, LatestFirmware.objects.get(hw_revision="v5").firmware)
+
+    def test_rebuild(self):
+        LatestFirmware.objects.all().delete()
+        LatestFirmware.rebuild()
+        self.assertEqual(self.fw2, LatestFirmware.objects.get(hw_revision="v5").firmware)
+
+    def test_refresh_is_an_exact_lookup(self):
+        with CaptureQueriesContext(connection) as queries:
+            LatestFirmware.refresh(" V5")
+        select = queries.captured_queries[0]['sql']
+        self.assertIn(connection.ops.quote_name('hw_revision_key'), select)
+        self.assertNotIn('LIKE', select.upper())
+        self.assertNotIn('UPPER(', select.upper())
+
+
+class VersionSortKeyTestCase(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for fw_version in ["9.0.0", "10.0.0", "10.0.0-beta", "10.0.0-rc2", "2.10.1", "2.9.3", "not-a-version"]:
+            Firmware.objects.create(fw_version=fw_version, hw_compability="v5", date_added=now, file_name="fw_file.cyacd2", file=bytes("data",'utf-8'))
+
+    def test_sort_key_matches_packaging(self):
+        from pkg_resources import packaging
+        versions = ["0.1.0", "1.0.0.dev1", "1.0.0a1", "1.0.0b2", "1.0.0rc1", "1.0.0", "1.0.0.post1", "1.0.1", "1.2", "10.0.0"]
+        self.assertEqual(versions, sorted(versions, key=version_sort_key))
+        self.assertEqual(sorted(versions, key=packaging.version.parse), sorted(versions, key=version_sort_key))
+        self.assertEqual((0, 0, 0, 0, 0), version_sort_key("not-a-version"))
+
+    def test_ordering_is_semantic(self):
+        versions = list(Firmware.objects.values_list('fw_version', flat=True))
+        self.assertEqual(["10.0.0", "10.0.0-rc2", "10.0.0-beta", "9.0.0", "2.10.1", "2.9.3", "not-a-version"], versions)
+
+    def test_newer_than(self):
+        newer = set(Firmware.objects.newer_than("9.0.0").values_list('fw_version', flat=True))
+        self.assertEqual({"10.0.0", "10.0.0-rc2", "10.0.0-beta"}, newer)
+        newer = set(Firmware.objects.newer_than("10.0.0-rc1").values_list('fw_version', flat=True))
+        self.assertEqual({"10.0.0", "10.0.0-rc2"}, newer)
+        self.assertFalse(Firmware.objects.newer_than("10.0.0").exists())
+
+    def test_key_updated_on_save(self):
+        fw = Firmware.objects.get(fw_version="9.0.0")
+        fw.fw_version = "11.0.0"
+        fw.save(update_fields=['fw_version'])
+        fw = Firmware.objects.get(pk=fw.pk)
+        self.assertEqual(11, fw.version_major)
+        self.assertEqual(fw, Firmware.objects.first())
+
 
 class DeviceTestCase(TestCase):
     @classmethod
@@ -66,6 +268,15 @@ class DeviceTestCase(TestCase):
         Device.objects.create(serial_number="56789", created=(now - timedelta(days=7)), firmware=fw3, last_update=(now - timedelta(days=5)),
         manufacturer_name="ManufacturerName", model_number="ModelNumber", hardware_revision="HWRev", software_revision="SWRev")
 
+    def test_hardware_revision_key(self):
+        self.assertEqual("hwrev", Device.objects.get(serial_number="56789").hardware_revision_key)
+        self.assertIsNone(Device.objects.get(serial_number="12345").hardware_revision_key)
+
+        device = Device.objects.get(serial_number="12345")
+        device.hardware_revision = " V7 "
+        device.save(update_fields=['hardware_revision'])
+        self.assertEqual("v7", Device.objects.get(serial_number="12345").hardware_revision_key)
+
     def test_str_is_equal_to_serial_number(self):
         device1 = Device.objects.get(serial_number="12345")
         device2 = Device.objects.get(serial_number="54321")
@@ -101,3 +312,145 @@ class HistoryTestCase(TestCase):
         self.assertEqual(2, len(histories))
         self.assertTrue(histories[0].fw_update_success == True) # Sorted by latest timestamp first
         self.assertTrue(histories[1].fw_update_success == False)
+
+
+class RolloutStatsTestCase(TestCase):
+    def setUp(self):
+        self.fw = Firmware.objects.create(fw_version="2.0.0", hw_compability="v5", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        self.device = Device.objects.create(serial_number="12345", created=timezone.now())
+        self.hour = datetime(2026, 3, 1, 10, tzinfo=dt_timezone.utc)
+
+    def result(self, success=True, started=None, hw_rev="v5", firmware=True):
+        return History.objects.create(device=self.device, fw_update_started=started or self.hour + timedelta(minutes=5), fw_update_success=success,
+            firmware=self.fw if firmware else None, hardware_revision=hw_rev)
+
+    def test_record(self):
+        RolloutStats.record([self.result(), self.result(False, hw_rev=" V5"), self.result(started=self.hour + timedelta(hours=1)), self.result(firmware=False)])
+        RolloutStats.record([self.result()])
+        stats = list(RolloutStats.objects.order_by('bucket').values_list('hw_revision', 'bucket', 'attempts', 'successes', 'failures'))
+        self.assertEqual([("v5", self.hour, 3, 2, 1), ("v5", self.hour + timedelta(hours=1), 1, 1, 0)], stats)
+
+    def test_record_daily_buckets(self):
+        with self.settings(ROLLOUT_STATS_BUCKET='day'):
+            RolloutStats.record([self.result(), self.result(started=self.hour + timedelta(hours=5))])
+        self.assertEqual([(self.hour.replace(hour=0), 2)], list(RolloutStats.objects.values_list('bucket', 'attempts')))
+
+    def test_rebuild_matches_record(self):
+        results = [self.result(), self.result(False, hw_rev="V5 "), self.result(hw_rev=None), self.result(started=self.hour - timedelta(hours=3)), self.result(firmware=False)]
+        RolloutStats.record(results)
+        recorded = set(RolloutStats.objects.values_list('hw_revision', 'bucket', 'attempts', 'successes', 'failures'))
+        RolloutStats.objects.update(attempts=0)
+        self.assertEqual(3, RolloutStats.rebuild())
+        self.assertEqual(recorded, set(RolloutStats.objects.values_list('hw_revision', 'bucket', 'attempts', 'successes', 'failures')))
+
+        # Older buckets are kept
+        RolloutStats.objects.update(attempts=0)
+        RolloutStats.rebuild(self.hour)
+        self.assertEqual([0, 1, 2], list(RolloutStats.objects.order_by('bucket', 'hw_revision').values_list('attempts', flat=True)))
+
+    def test_rebuild_normalizes_like_record(self):
+        # SQL TRIM only strips spaces, normalize_hw_rev all whitespace
+        RolloutStats.record([self.result(hw_rev="\tV5\n"), self.result(hw_rev="v5")])
+        recorded = list(RolloutStats.objects.values_list('hw_revision', 'attempts'))
+        self.assertEqual([("v5", 2)], recorded)
+        RolloutStats.rebuild()
+        self.assertEqual(recorded, list(RolloutStats.objects.values_list('hw_revision', 'attempts')))
+
+    def test_rebuild_command_keeps_archived_buckets(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        RolloutStats.record([self.result(started=self.hour - timedelta(hours=3)), self.result()])
+        with self.settings(HISTORY_ARCHIVE_PATH=path):
+            get_history_archive().archive(self.hour - timedelta(hours=1))
+            self.assertEqual(1, History.objects.count())
+            # The archived result is still counted, the stored results are recounted
+            History.objects.update(fw_update_success=False)
+            call_command('rebuild_rollout_stats', stdout=StringIO())
+        self.assertEqual([(1, 1), (1, 0)], list(RolloutStats.objects.order_by('bucket').values_list('attempts', 'successes')))
+
+    def test_view(self):
+        RolloutStats.record([self.result(), self.result(False)])
+        user = User.objects.create_superuser(username='super', email='super@email.org', password='pass')
+        self.client.force_login(user)
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('rollout_stats'), {'since': '2026-03-01', 'hw_rev': 'V5', 'buckets': '1'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{
+            'firmware': self.fw.pk, 'fw_version': "2.0.0", 'hw_revision': "v5", 'attempts': 2, 'successes': 1, 'failures': 1, 'success_rate': 0.5,
+            'buckets': [{'bucket': "2026-03-01T10:00:00Z", 'attempts': 2, 'successes': 1, 'failures': 1}],
+        }], response.json()['rollouts'])
+        self.assertEqual([], self.client.get(reverse('rollout_stats'), {'since': '2026-03-02'}).json()['rollouts'])
+        self.assertEqual(400, self.client.get(reverse('rollout_stats'), {'firmware': 'x'}).status_code)
+
+
+class FleetCounterTestCase(TestCase):
+    def setUp(self):
+        self.fw1 = Firmware.objects.create(fw_version="1.0.0", hw_compability="v5", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+        self.fw2 = Firmware.objects.create(fw_version="2.0.0", hw_compability="v5", date_added=timezone.now(), file_name="fw.cyacd2", file=b"data")
+
+    def counts(self):
+        return {(kind, key): devices for kind, key, devices in FleetCounter.objects.exclude(devices=0).values_list('kind', 'key', 'devices')}
+
+    def test_device_lifecycle(self):
+        device = Device.objects.create(serial_number="1", created=timezone.now(), firmware=self.fw1, hardware_revision=" V5")
+        Device.objects.create(serial_number="2", created=timezone.now())
+        self.assertEqual({('firmware', str(self.fw1.pk)): 1, ('hw_revision', 'v5'): 1, ('hw_revision', ''): 1}, self.counts())
+
+        device = Device.objects.get(pk=device.pk)
+        device.firmware = self.fw2
+        device.save()
+        # Only the saved fields move the device
+        device.hardware_revision = "v6"
+        device.save(update_fields=['last_update'])
+        self.assertEqual({('firmware', str(self.fw2.pk)): 1, ('hw_revision', 'v5'): 1, ('hw_revision', ''): 1}, self.counts())
+        device.save(update_fields=['hardware_revision'])
+        self.assertEqual({('firmware', str(self.fw2.pk)): 1, ('hw_revision', 'v6'): 1, ('hw_revision', ''): 1}, self.counts())
+
+        Device.objects.get(pk=device.pk).delete()
+        self.assertEqual({('hw_revision', ''): 1}, self.counts())
+        self.assertEqual({}, FleetCounter.differences())
+
+    def test_apply(self):
+        FleetCounter.objects.create(kind='hw_revision', key='v5', devices=3)
+        with self.assertNumQueries(1):
+            FleetCounter.apply({('hw_revision', 'v5'): -1, ('hw_revision', 'v6'): 0})
+        # Missing counters are created, not with a negative count
+        FleetCounter.apply({('hw_revision', 'v5'): 2, ('hw_revision', 'v6'): 1, ('hw_revision', 'v7'): -1})
+        self.assertEqual({('hw_revision', 'v5'): 4, ('hw_revision', 'v6'): 1}, self.counts())
+
+    def test_firmware_deleted(self):
+        Device.objects.create(serial_number="1", created=timezone.now(), firmware=self.fw1, hardware_revision="v5")
+        self.fw1.delete()
+        self.assertEqual({('hw_revision', 'v5'): 1}, self.counts())
+        self.assertEqual({}, FleetCounter.differences())
+
+    def test_check_and_repair(self):
+        Device.objects.create(serial_number="1", created=timezone.now(), firmware=self.fw1, hardware_revision="v5")
+        Device.objects.create(serial_number="2", created=timezone.now(), firmware=self.fw1, hardware_revision="v5")
+        call_command('fleet_counters', 'check', stdout=StringIO())
+
+        # Queryset updates are not counted
+        Device.objects.filter(serial_number="2").update(firmware=self.fw2)
+        with self.assertRaises(CommandError):
+            call_command('fleet_counters', 'check', stdout=StringIO())
+        out = StringIO()
+        call_command('fleet_counters', 'repair', stdout=out)
+        self.assertIn("Repaired 2 counter(s)", out.getvalue())
+        self.assertEqual({('firmware', str(self.fw1.pk)): 1, ('firmware', str(self.fw2.pk)): 1, ('hw_revision', 'v5'): 2}, self.counts())
+        call_command('fleet_counters', 'check', stdout=StringIO())
+
+    def test_view(self):
+        Device.objects.create(serial_number="1", created=timezone.now(), firmware=self.fw1, hardware_revision="v5")
+        Device.objects.create(serial_number="2", created=timezone.now(), firmware=self.fw1, hardware_revision="v5")
+        Device.objects.create(serial_number="3", created=timezone.now(), hardware_revision="v6")
+        user = User.objects.create_superuser(username='super', email='super@email.org', password='pass')
+        self.client.force_login(user)
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('fleet_stats'))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual({
+            'devices': 3,
+            'unknown_firmware': 1,
+            'firmwares': [{'firmware': self.fw1.pk, 'fw_version': "1.0.0", 'hw_revision': "v5", 'devices': 2}],
+            'hw_revisions': [{'hw_revision': "v5", 'devices': 2}, {'hw_revision': "v6", 'devices': 1}],
+        }, response.json())
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.test import TestCase
+from django.utils import timezone
+from .models import Firmware
+from .sharedcache import SharedFirmwareCache, get_shared_firmware_cache
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+class SharedFirmwareCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.fw1 = Firmware.objects.create(fw_version="1.0.0", hw_compability="v5", date_added=timezone.now(), file_name="fw_file.cyacd2", file=b"file_1.0.0_data")
+        self.fw2 = Firmware.objects.create(fw_version="2.0.0", hw_compability="v5", date_added=timezone.now(), file_name="fw_file.cyacd2", file=b"file_2.0.0_data")
+
+    def test_publish_and_share_between_instances(self):
+        cache = SharedFirmwareCache(self.path)
+        self.assertEqual(b"file_1.0.0_data", bytes(cache.get(self.fw1)))
+        self.assertEqual(1, cache.publishes)
+        self.assertEqual(1, cache.read_pointer(cache.hw_key("v5"))['generation'])
+
+        # A second worker maps the published segment without reading storage
+        other_worker = SharedFirmwareCache(self.path)
+        with self.assertNumQueries(0):
+            self.assertEqual(b"file_1.0.0_data", bytes(other_worker.get(self.fw1)))
+        self.assertEqual(1, other_worker.hits)
+        self.assertEqual(0, other_worker.publishes)
+
+    def test_new_firmware_replaces_segment(self):
+        cache = SharedFirmwareCache(self.path)
+        old_data = cache.get(self.fw1)
+        self.assertEqual(b"file_2.0.0_data", bytes(cache.get(self.fw2)))
+        key = cache.hw_key("V5 ")
+        self.assertEqual(2, cache.read_pointer(key)['generation'])
+        self.assertEqual(self.fw2.pk, cache.read_pointer(key)['firmware_id'])
+        self.assertFalse(os.path.exists(cache.segment_path(key, 1)))
+        # Mappings handed out before the switch stay valid
+        self.assertEqual(b"file_1.0.0_data", bytes(old_data))
+
+    def test_iter_chunks(self):
+        cache = SharedFirmwareCache(self.path)
+        self.assertEqual([b"e_1.0", b".0_da"], [bytes(chunk) for chunk in cache.iter_chunks(self.fw1, 3, 13, 5)])
+
+    def test_configured_cache(self):
+        self.assertIsNone(get_shared_firmware_cache())
+        with self.settings(FIRMWARE_SHARED_CACHE_PATH=self.path):
+            self.assertEqual(self.path, get_shared_firmware_cache().path)
+
+    def test_modules_import_without_fcntl(self):
+        # E.g. on Windows, where neither the shared cache nor the history archive can be used
+        code = "import sys; sys.modules['fcntl'] = None; import django; django.setup(); import api.views, app.archive"
+        subprocess.run([sys.executable, '-c', code], cwd=str(settings.BASE_DIR), check=True)
@@ -0,0 +1,136 @@
+from django.core.management import call_command
+from django.db import transaction
+from django.db.utils import ConnectionDoesNotExist
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from .models import Firmware
+from .storage import DATABASE, FILESYSTEM, FileSystemFirmwareStorage, get_storage
+from io import StringIO
+import hashlib
+import os
+import shutil
+import tempfile
+
+
+class FirmwareStorageTestCase(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.data = b"some dummy bcode data: \x00\x01\x02"
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def create_firmware(self, fw_version, hw_rev="v5"):
+        fw = Firmware(fw_version=fw_version, hw_compability=hw_rev, date_added=timezone.now())
+        fw.set_file("fw_file.cyacd2", self.data)
+        fw.save()
+        return fw
+
+    def test_database_storage(self):
+        fw = self.create_firmware("1.0.0")
+        self.assertEqual(DATABASE, fw.storage)
+        self.assertEqual(self.data, get_storage(DATABASE).read(fw))
+        self.assertEqual(self.data, b"".join(fw.iter_file_chunks(chunk_size=5)))
+        self.assertIsNone(get_storage(DATABASE).open(fw))
+
+    def test_database_storage_reads_from_firmware_database(self):
+        fw = self.create_firmware("1.0.0")
+        fw._state.db = 'replica1'
+        # Every chunk comes from the database the firmware was loaded from
+        with self.assertRaises(ConnectionDoesNotExist):
+            next(get_storage(DATABASE).iter_chunks(fw, 0, 10, 5))
+
+    def test_filesystem_storage_is_content_addressed(self):
+        with self.settings(FIRMWARE_STORAGE=FILESYSTEM, FIRMWARE_STORAGE_ROOT=self.root):
+            fw1 = self.create_firmware("1.0.0")
+            fw2 = self.create_firmware("1.0.0", hw_rev="v6")
+            storage = get_storage(FILESYSTEM)
+            path = os.path.join(self.root, self.sha256[:2], self.sha256[2:4], self.sha256)
+            self.assertEqual(path, storage.path(fw1))
+            self.assertEqual(path, storage.path(fw2))
+            self.assertEqual(FILESYSTEM, Firmware.objects.get(pk=fw1.pk).storage)
+            self.assertIsNone(Firmware.objects.with_file().get(pk=fw1.pk).file)
+            self.assertEqual(self.data, b"".join(fw1.iter_file_chunks(chunk_size=5)))
+            self.assertEqual(self.data[3:8], b"".join(fw1.iter_file_chunks(3, 8, chunk_size=2)))
+
+    def test_offload_response(self):
+        with self.settings(FIRMWARE_STORAGE=FILESYSTEM, FIRMWARE_STORAGE_ROOT=self.root):
+            fw = self.create_firmware("1.0.0")
+            storage = FileSystemFirmwareStorage()
+            self.assertIsNone(storage.offload_response(fw))
+            with self.settings(FIRMWARE_SENDFILE='x-sendfile'):
+                self.assertEqual(storage.path(fw), storage.offload_response(fw)['X-Sendfile'])
+            with self.settings(FIRMWARE_SENDFILE='x-accel-redirect', FIRMWARE_ACCEL_REDIRECT_PREFIX='/internal/fw/'):
+                self.assertEqual("/internal/fw/{}/{}/{}".format(self.sha256[:2], self.sha256[2:4], self.sha256), storage.offload_response(fw)['X-Accel-Redirect'])
+
+    def test_migrate_firmware_storage_command(self):
+        fw = self.create_firmware("1.0.0")
+        with self.settings(FIRMWARE_STORAGE_ROOT=self.root):
+            call_command('migrate_firmware_storage', stdout=StringIO())
+            fw = Firmware.objects.with_file().get(pk=fw.pk)
+            self.assertEqual(FILESYSTEM, fw.storage)
+            self.assertIsNone(fw.file)
+            self.assertEqual(self.data, get_storage(FILESYSTEM).read(fw))
+
+            call_command('migrate_firmware_storage', '--to', DATABASE, stdout=StringIO())
+            fw = Firmware.objects.with_file().get(pk=fw.pk)
+            self.assertEqual(DATABASE, fw.storage)
+            self.assertEqual(self.data, bytes(fw.file))
+
+
+class FirmwareFileDeletionTestCase(TransactionTestCase):
+    # Files are removed on commit, so this needs real transactions
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_filesystem_file_deleted_with_last_firmware(self):
+        with self.settings(FIRMWARE_STORAGE=FILESYSTEM, FIRMWARE_STORAGE_ROOT=self.root):
+            fws = []
+            for hw_rev in ["v5", "v6"]:
+                fw = Firmware(fw_version="1.0.0", hw_compability=hw_rev, date_added=timezone.now())
+                fw.set_file("fw_file.cyacd2", b"some dummy bcode data")
+                fw.save()
+                fws.append(fw)
+            storage = get_storage(FILESYSTEM)
+
+            fws[0].delete()
+            self.assertTrue(storage.exists(fws[1]))
+            fws[1].delete()
+            self.assertFalse(storage.exists(fws[1]))
+
+    def create_firmware(self, hw_rev, data):
+        fw = Firmware(fw_version="1.0.0", hw_compability=hw_rev, date_added=timezone.now())
+        fw.set_file("fw_file.cyacd2", data)
+        fw.save()
+        return fw
+
+    def test_file_kept_when_image_stored_again_before_commit(self):
+        with self.settings(FIRMWARE_STORAGE=FILESYSTEM, FIRMWARE_STORAGE_ROOT=self.root):
+            fw = self.create_firmware("v5", b"some dummy bcode data")
+            with transaction.atomic():
+                fw.delete()
+                other = self.create_firmware("v6", b"some dummy bcode data")
+            self.assertTrue(get_storage(FILESYSTEM).exists(other))
+
+    def test_replaced_file_deleted(self):
+        with self.settings(FIRMWARE_STORAGE=FILESYSTEM, FIRMWARE_STORAGE_ROOT=self.root):
+            storage = get_storage(FILESYSTEM)
+            fw = self.create_firmware("v5", b"old image")
+            shared = self.create_firmware("v6", b"shared image")
+            old_path = storage.path(fw)
+
+            fw = Firmware.objects.get(pk=fw.pk)
+            fw.set_file("fw_file.cyacd2", b"shared image")
+            fw.save()
+            self.assertFalse(os.path.exists(old_path))
+
+            # Still used by the other firmware
+            fw.set_file("fw_file.cyacd2", b"new image")
+            fw.save()
+            self.assertTrue(storage.exists(shared))
+
+            call_command('migrate_firmware_storage', '--to', DATABASE, stdout=StringIO())
+            self.assertFalse(storage.exists(shared))
+            self.assertFalse(storage.exists(Firmware.objects.get(pk=fw.pk)))
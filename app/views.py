@@ -0,0 +1,113 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Sum
+from django.http import JsonResponse
+from django.utils import timezone
+from api.authentication import get_token_cache
+from api.responsecache import get_latest_version_cache
+from api.resultqueue import get_result_queue
+from iz_fota.db.backends import get_pool_stats
+from iz_fota.db.routers import get_replica_selector
+from .archive import get_history_archive, parse_time
+from .blobcache import get_blob_cache
+from .models import Firmware, FleetCounter, RolloutStats, normalize_hw_rev
+from .sharedcache import get_shared_firmware_cache
+from datetime import timedelta
+import itertools
+
+
+@staff_member_required
+def stats(request):
+    """
+    Counters of the caches and database pools in this worker process and of the result queue, for staff users.
+    """
+    cache = get_blob_cache()
+    shared_cache = get_shared_firmware_cache()
+    result_queue = get_result_queue()
+    token_cache = get_token_cache()
+    replicas = get_replica_selector()
+    version_cache = get_latest_version_cache()
+    archive = get_history_archive()
+    return JsonResponse({
+        'blob_cache': cache.stats() if cache is not None else None,
+        'shared_cache': shared_cache.stats() if shared_cache is not None else None,
+        'results_queue': result_queue.stats() if result_queue is not None else None,
+        'token_cache': token_cache.stats() if token_cache is not None else None,
+        'latest_version_cache': version_cache.stats() if version_cache is not None else None,
+        'db_pools': get_pool_stats(),
+        'db_replicas': replicas.stats() if replicas is not None else None,
+        'history_archive': archive.stats() if archive is not None else None,
+    })
+
+
+@staff_member_required
+def archived_history(request):
+    """
+    Archived results between the from and to ISO dates or datetimes, optionally of one device (serial number)
+    or firmware (id), at most limit of them.
+    """
+    archive = get_history_archive()
+    if archive is None:
+        return JsonResponse({'detail': "The History archive is not configured."}, status=404)
+    try:
+        start = parse_time(request.GET['from']) if 'from' in request.GET else None
+        end = parse_time(request.GET['to']) if 'to' in request.GET else None
+        firmware_id = int(request.GET['firmware']) if 'firmware' in request.GET else None
+        limit = int(request.GET.get('limit', 1000))
+        if limit < 0:
+            raise ValueError("limit must not be negative")
+    except ValueError as e:
+        return JsonResponse({'detail': str(e)}, status=400)
+    rows = archive.query(start, end, request.GET.get('device'), firmware_id)
+    return JsonResponse({'results': list(itertools.islice(rows, limit))})
+
+
+@staff_member_required
+def rollout_stats(request):
+    """
+    Attempts, successes and failures per firmware and hardware revision since the since ISO date or datetime,
+    30 days by default, optionally of one firmware or hw_rev. With buckets=1 the counts of every bucket as well.
+    """
+    try:
+        since = parse_time(request.GET['since']) if 'since' in request.GET else timezone.now() - timedelta(days=30)
+        stats = RolloutStats.objects.filter(bucket__gte=RolloutStats.bucket_start(since))
+        if 'firmware' in request.GET:
+            stats = stats.filter(firmware_id=int(request.GET['firmware']))
+    except ValueError as e:
+        return JsonResponse({'detail': str(e)}, status=400)
+    if 'hw_rev' in request.GET:
+        stats = stats.filter(hw_revision=normalize_hw_rev(request.GET['hw_rev']))
+
+    totals = stats.order_by('firmware_id', 'hw_revision').values('firmware_id', 'firmware__fw_version', 'hw_revision').annotate(
+        attempts=Sum('attempts'), successes=Sum('successes'), failures=Sum('failures'))
+    rollouts = {}
+    for row in totals:
+        rollouts[row['firmware_id'], row['hw_revision']] = {
+            'firmware': row['firmware_id'], 'fw_version': row['firmware__fw_version'], 'hw_revision': row['hw_revision'],
+            'attempts': row['attempts'], 'successes': row['successes'], 'failures': row['failures'],
+            'success_rate': row['successes'] / row['attempts'] if row['attempts'] else None,
+        }
+    if request.GET.get('buckets') == '1':
+        for row in stats.order_by('bucket').values('firmware_id', 'hw_revision', 'bucket', 'attempts', 'successes', 'failures'):
+            rollouts[row['firmware_id'], row['hw_revision']].setdefault('buckets', []).append(
+                {'bucket': row['bucket'], 'attempts': row['attempts'], 'successes': row['successes'], 'failures': row['failures']})
+    return JsonResponse({'since': RolloutStats.bucket_start(since), 'rollouts': list(rollouts.values())})
+
+
+@staff_member_required
+def fleet_stats(request):
+    """
+    Number of devices per firmware and per hardware revision, read from the fleet counters instead of
+    grouping all devices. Devices on an unknown firmware are only in the hw revision counts.
+    """
+    counters = FleetCounter.objects.exclude(devices=0)
+    by_firmware = dict(counters.filter(kind=FleetCounter.FIRMWARE).values_list('key', 'devices'))
+    firmwares = Firmware.objects.filter(pk__in=[int(key) for key in by_firmware]).values_list('pk', 'fw_version', 'hw_compability')
+    hw_revisions = counters.filter(kind=FleetCounter.HW_REVISION).order_by('-devices', 'key').values_list('key', 'devices')
+    total = sum(devices for _, devices in hw_revisions)
+    return JsonResponse({
+        'devices': total,
+        'unknown_firmware': total - sum(by_firmware.values()),
+        'firmwares': sorted(({'firmware': pk, 'fw_version': fw_version, 'hw_revision': hw_revision, 'devices': by_firmware[str(pk)]}
+            for pk, fw_version, hw_revision in firmwares), key=lambda row: (-row['devices'], row['firmware'])),
+        'hw_revisions': [{'hw_revision': key, 'devices': devices} for key, devices in hw_revisions],
+    })
@@ -14,3 +14,10 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iz_fota.settings')
 
 application = get_asgi_application()
+
+from django.conf import settings
+from api.asgi import DeviceAPIApplication
+
+# Device endpoints are served natively async, without the admin middleware
+if settings.DEVICE_API_PREFIX:
+    application = DeviceAPIApplication(application, settings.DEVICE_API_PREFIX)
@@ -0,0 +1,162 @@
+"""
+Django cache backend for servers speaking the Redis protocol (RESP), e.g. Redis, Valkey or KeyDB.
+
+Django 3.1 has no such backend and only get, set, delete and a handful of other commands are
+needed, so this talks the protocol directly instead of depending on a client library. Every
+thread keeps one connection open, it is opened again when the server dropped it.
+"""
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+import pickle
+import socket
+import threading
+
+
+class RESPError(Exception):
+    pass
+
+
+class RESPConnection:
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def send(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self.sock.sendall(b''.join(parts))
+
+    def read_reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by the cache server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RESPError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = self.reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by the cache server")
+            return data[:-2]
+        if kind == b'*':
+            length = int(rest)
+            return None if length < 0 else [self.read_reply() for _ in range(length)]
+        raise RESPError("Unexpected reply from the cache server: {!r}".format(line))
+
+
+class RESPCache(BaseCache):
+    """
+    LOCATION is 'host:port', OPTIONS may set DB, PASSWORD and SOCKET_TIMEOUT in seconds.
+    """
+
+    def __init__(self, server, params):
+        super().__init__(params)
+        if isinstance(server, (list, tuple)):
+            server = server[0]
+        host, _, port = (server or '127.0.0.1:6379').rpartition(':')
+        self.host = host or '127.0.0.1'
+        self.port = int(port)
+        options = params.get('OPTIONS', {})
+        self.db = int(options.get('DB', 0))
+        self.password = options.get('PASSWORD')
+        self.socket_timeout = options.get('SOCKET_TIMEOUT', 5)
+        self._local = threading.local()
+
+    def _connect(self):
+        connection = RESPConnection(self.host, self.port, self.socket_timeout)
+        try:
+            if self.password:
+                connection.send('AUTH', self.password)
+                connection.read_reply()
+            if self.db:
+                connection.send('SELECT', self.db)
+                connection.read_reply()
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def execute(self, *args):
+        # A kept connection may have been closed by the server meanwhile, that's retried once on a new one
+        for retry in (True, False):
+            connection = getattr(self._local, 'connection', None)
+            fresh = connection is None
+            if fresh:
+                connection = self._local.connection = self._connect()
+            try:
+                connection.send(*args)
+                return connection.read_reply()
+            except (OSError, ConnectionError):
+                self._local.connection = None
+                connection.close()
+                if fresh or not retry:
+                    raise
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def _expiry(self, timeout):
+        # Milliseconds until the entry expires, None for entries without expiry
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else int(timeout * 1000)
+
+    def _set(self, key, value, timeout, *flags):
+        expiry = self._expiry(timeout)
+        if expiry is not None and expiry <= 0:
+            # Like the other backends, a timeout of 0 expires the entry right away
+            if flags:
+                return False
+            self.execute('DEL', key)
+            return True
+        args = ['SET', key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), *flags]
+        if expiry is not None:
+            args += ['PX', expiry]
+        return self.execute(*args) == 'OK'
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        return self._set(self._key(key, version), value, timeout, 'NX')
+
+    def get(self, key, default=None, version=None):
+        value = self.execute('GET', self._key(key, version))
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._set(self._key(key, version), value, timeout)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        expiry = self._expiry(timeout)
+        if expiry is None:
+            return self.execute('PERSIST', key) == 1 or self.execute('EXISTS', key) == 1
+        return self.execute('PEXPIRE', key, max(expiry, 1)) == 1
+
+    def delete(self, key, version=None):
+        return self.execute('DEL', self._key(key, version)) == 1
+
+    def has_key(self, key, version=None):
+        return self.execute('EXISTS', self._key(key, version)) == 1
+
+    def clear(self):
+        self.execute('FLUSHDB')
+
+    def close(self, **kwargs):
+        # Called at the end of every request, the connection is kept for the next one
+        pass
@@ -0,0 +1,89 @@
+from .pool import ConnectionPool
+import threading
+
+# (alias, database name) -> pool, shared by the per thread connection wrappers
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {"{}:{}".format(*key): pool.stats() for key, pool in pools.items()}
+
+
+class PersistentConnectionMixin:
+    """
+    Database wrapper additions for a backend:
+
+    CONN_HEALTH_CHECKS: check a persistent connection (CONN_MAX_AGE) once before it is used
+    by a new request, so a connection the server dropped is replaced instead of failing.
+
+    POOL: {'SIZE': ..., 'TIMEOUT': ..., 'CHECK_AFTER': ...} share up to SIZE connections between
+    the threads of the process. A thread checks a connection out when it first needs one and
+    returns it where Django would close it, e.g. at the end of a request with CONN_MAX_AGE 0.
+    """
+    health_check_done = False
+
+    def get_pool(self):
+        config = self.settings_dict.get('POOL') or {}
+        if not config.get('SIZE'):
+            return None
+        key = (self.alias, self.settings_dict['NAME'])
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(config['SIZE'], timeout=config.get('TIMEOUT', 10), check_after=config.get('CHECK_AFTER', 30))
+            return pool
+
+    def get_new_connection(self, conn_params):
+        pool = self.get_pool()
+        parent = super()
+        if pool is None:
+            return parent.get_new_connection(conn_params)
+        return pool.acquire(lambda: parent.get_new_connection(conn_params), self.check_raw_connection)
+
+    def check_raw_connection(self, raw):
+        try:
+            cursor = raw.cursor()
+            try:
+                cursor.execute("SELECT 1")
+            finally:
+                cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def _close(self):
+        pool = self.get_pool()
+        if pool is None or self.connection is None:
+            return super()._close()
+        raw = self.connection
+        if self.errors_occurred and not self.is_usable():
+            pool.discard(raw)
+            return
+        try:
+            if not self.autocommit:
+                # Don't hand an open transaction to the next thread
+                raw.rollback()
+        except Exception:
+            pool.discard(raw)
+            return
+        pool.release(raw)
+
+    def connect(self):
+        super().connect()
+        # A new connection needs no check
+        self.health_check_done = True
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Called at the start and end of requests, check a kept connection before the next use
+        self.health_check_done = False
+
+    def ensure_connection(self):
+        if self.connection is not None and not self.health_check_done and self.settings_dict.get('CONN_HEALTH_CHECKS'):
+            self.health_check_done = True
+            if not self.is_usable():
+                self.close()
+        super().ensure_connection()
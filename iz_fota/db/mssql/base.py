@@ -0,0 +1,10 @@
+"""
+The mssql backend with persistent connection health checks and optional pooling,
+see iz_fota.db.backends.PersistentConnectionMixin.
+"""
+from mssql.base import DatabaseWrapper as MSSQLDatabaseWrapper
+from iz_fota.db.backends import PersistentConnectionMixin
+
+
+class DatabaseWrapper(PersistentConnectionMixin, MSSQLDatabaseWrapper):
+    pass
@@ -0,0 +1,125 @@
+from django.db.utils import OperationalError
+import threading
+import time
+
+
+class PoolTimeout(OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Bounded pool of raw database connections shared by the threads of a worker process.
+
+    At most size connections exist at a time. A thread that finds them all checked out waits up
+    to timeout seconds for one to be released. Connections that have been idle for more than
+    check_after seconds are checked before they are handed out again.
+    """
+
+    def __init__(self, size, timeout=10, check_after=30):
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.discarded = 0
+        # (raw connection, release time), the most recently released is reused first
+        self._idle = []
+        self._cond = threading.Condition()
+
+    def acquire(self, connect, check=None):
+        """
+        A connection from the pool, or a new one made with connect() while the pool is not full.
+        check(raw) tells whether a connection that has been idle for long still works.
+        """
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            waited = False
+            while True:
+                if self._idle:
+                    raw, released = self._idle.pop()
+                    break
+                if self.in_use < self.size:
+                    raw = released = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("No database connection available within {}s, pool of {} is exhausted".format(self.timeout, self.size))
+                waited = True
+                self._cond.wait(remaining)
+            self.in_use += 1
+            self.checkouts += 1
+            if waited:
+                waited_for = time.monotonic() - started
+                self.waits += 1
+                self.wait_seconds += waited_for
+                self.max_wait_seconds = max(self.max_wait_seconds, waited_for)
+
+        try:
+            if raw is not None and check is not None and time.monotonic() - released > self.check_after and not check(raw):
+                self._close(raw)
+                raw = None
+            if raw is None:
+                raw = connect()
+                with self._cond:
+                    self.created += 1
+        except BaseException:
+            with self._cond:
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+        return raw
+
+    def release(self, raw):
+        with self._cond:
+            self.in_use -= 1
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def discard(self, raw):
+        """
+        Close a broken connection instead of returning it, making room for a new one.
+        """
+        self._close(raw)
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    def _close(self, raw):
+        with self._cond:
+            self.discarded += 1
+        try:
+            raw.close()
+        except Exception:
+            pass
+
+    def close_idle(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for raw, _ in idle:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'idle': len(self._idle),
+                'checkouts': self.checkouts,
+                'created': self.created,
+                'discarded': self.discarded,
+                'waits': self.waits,
+                'wait_seconds': self.wait_seconds,
+                'max_wait_seconds': self.max_wait_seconds,
+                'timeouts': self.timeouts,
+            }
@@ -0,0 +1,202 @@
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+from django.dispatch import receiver
+import contextvars
+import threading
+import time
+
+class _Pinning:
+    # Whether the reads of one request, or task, go to the primary, see use_primary
+    def __init__(self, pinned):
+        self.pinned = pinned
+
+_pinning = contextvars.ContextVar('replica_pinning', default=None)
+
+
+@contextmanager
+def use_primary(pinned=True):
+    """
+    Send all reads in the block to the primary database, or with pinned=False let them go to
+    the replicas again, e.g. at the start of a request. Reads in the block go to the primary
+    once it has written something, so it reads its own writes.
+    """
+    token = _pinning.set(_Pinning(pinned))
+    try:
+        yield
+    finally:
+        _pinning.reset(token)
+
+
+def is_pinned():
+    pinning = _pinning.get()
+    return pinning is not None and pinning.pinned
+
+
+def pin_to_primary():
+    """
+    Send the remaining reads of the enclosing use_primary() block to the primary. Does nothing
+    outside such a block, so long running threads don't stop using the replicas.
+    """
+    pinning = _pinning.get()
+    if pinning is not None:
+        pinning.pinned = True
+
+
+class ReplicaSelector:
+    """
+    Picks the replica for a read. 'round-robin' takes turns, 'lag-aware' takes turns among the
+    replicas that are reachable and at most max_lag seconds behind the primary, measured every
+    check_interval seconds with lag_query. Without such a replica reads go to the primary.
+    """
+
+    def __init__(self, aliases, mode='round-robin', max_lag=5, check_interval=10, lag_query=''):
+        if mode not in ('round-robin', 'lag-aware'):
+            raise ValueError("Unknown replica selection '{}'".format(mode))
+        self.aliases = list(aliases)
+        self.mode = mode
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.lag_query = lag_query
+        self.lags = {alias: 0.0 for alias in self.aliases}
+        self.reads = {alias: 0 for alias in self.aliases}
+        self.primary_reads = 0
+        self._next = 0
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def measure_lag(self, alias):
+        """
+        Seconds alias is behind the primary, None when it can't be reached.
+        """
+        try:
+            connection = connections[alias]
+            if not self.lag_query:
+                connection.ensure_connection()
+                return 0.0
+            with connection.cursor() as cursor:
+                cursor.execute(self.lag_query)
+                row = cursor.fetchone()
+        except DatabaseError:
+            return None
+        return float(row[0]) if row is not None and row[0] is not None else 0.0
+
+    def refresh_lags(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._checked is not None and now - self._checked < self.check_interval:
+                return
+            # Other threads keep using the previous measurements meanwhile
+            self._checked = now
+        lags = {alias: self.measure_lag(alias) for alias in self.aliases}
+        with self._lock:
+            self.lags = lags
+
+    def choose(self):
+        if self.mode == 'lag-aware':
+            self.refresh_lags()
+            candidates = [alias for alias in self.aliases if self.lags.get(alias) is not None and self.lags[alias] <= self.max_lag]
+        else:
+            candidates = self.aliases
+        with self._lock:
+            if not candidates:
+                self.primary_reads += 1
+                return DEFAULT_DB_ALIAS
+            alias = candidates[self._next % len(candidates)]
+            self._next += 1
+            self.reads[alias] += 1
+            return alias
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'lags': dict(self.lags),
+            'reads': dict(self.reads),
+            'primary_reads': self.primary_reads,
+        }
+
+
+_selector = None
+_selector_lock = threading.Lock()
+
+def get_replica_selector():
+    """
+    The selector for DATABASE_REPLICAS, or None when there are no replicas.
+    """
+    global _selector
+    replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+    if not replicas:
+        return None
+    with _selector_lock:
+        if _selector is None:
+            _selector = ReplicaSelector(replicas, getattr(settings, 'DATABASE_REPLICA_SELECTION', 'round-robin'),
+                max_lag=getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 5),
+                check_interval=getattr(settings, 'DATABASE_REPLICA_LAG_CHECK_INTERVAL', 10),
+                lag_query=getattr(settings, 'DATABASE_REPLICA_LAG_QUERY', ''))
+        return _selector
+
+
+@receiver(setting_changed)
+def reset_replica_selector(setting, **kwargs):
+    global _selector
+    if setting.startswith('DATABASE_REPLICA'):
+        _selector = None
+
+
+class ReplicaRouter:
+    """
+    Sends reads of the models in DATABASE_REPLICA_MODELS, the firmware tables devices poll,
+    to the read replicas and everything else to the primary. Reads go to the primary inside
+    transactions and after the current request has written anything, so it reads its own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        if is_pinned() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        # Related objects, and the chunks of an image, come from the database the instance was read from
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        if model._meta.label_lower not in getattr(settings, 'DATABASE_REPLICA_MODELS', []):
+            return DEFAULT_DB_ALIAS
+        selector = get_replica_selector()
+        if selector is None:
+            return DEFAULT_DB_ALIAS
+        return selector.choose()
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *getattr(settings, 'DATABASE_REPLICAS', [])}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get the schema from the primary
+        if db in getattr(settings, 'DATABASE_REPLICAS', []):
+            return False
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """
+    Starts every request reading from the replicas. A request that changes data, e.g. an admin
+    saving a firmware, pins the browser session to the primary for DATABASE_REPLICA_PIN_SECONDS
+    so the following pages show the change even if the replicas are behind.
+    """
+    cookie_name = 'primary_db'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with use_primary(self.cookie_name in request.COOKIES):
+            response = self.get_response(request)
+        # Only browser sessions, devices don't keep cookies
+        if request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE') and hasattr(request, 'session') and getattr(settings, 'DATABASE_REPLICAS', []):
+            response.set_cookie(self.cookie_name, '1', max_age=getattr(settings, 'DATABASE_REPLICA_PIN_SECONDS', 10), httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,10 @@
+"""
+The sqlite3 backend with persistent connection health checks and optional pooling,
+see iz_fota.db.backends.PersistentConnectionMixin. Lets the development setup run the same code.
+"""
+from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+from iz_fota.db.backends import PersistentConnectionMixin
+
+
+class DatabaseWrapper(PersistentConnectionMixin, SQLiteDatabaseWrapper):
+    pass
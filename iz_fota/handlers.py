@@ -0,0 +1,79 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.core.handlers.exception import convert_exception_to_response
+from django.core.handlers.wsgi import WSGIHandler
+from django.utils.module_loading import import_string
+
+
+class MiddlewareProfileWSGIHandler(WSGIHandler):
+    """
+    WSGIHandler running its own list of middleware instead of settings.MIDDLEWARE.
+    """
+
+    def __init__(self, middleware):
+        self.middleware = list(middleware)
+        super().__init__()
+
+    def load_middleware(self, is_async=False):
+        # Copy of BaseHandler.load_middleware of the Django release pinned in requirements.txt, building
+        # the chain from self.middleware for a synchronous handler. test_handlers.py fails when Django's
+        # version changes, update this copy together with Django.
+        self._view_middleware = []
+        self._template_response_middleware = []
+        self._exception_middleware = []
+
+        handler = convert_exception_to_response(self._get_response)
+        handler_is_async = False
+        for middleware_path in reversed(self.middleware):
+            middleware = import_string(middleware_path)
+            middleware_is_async = not getattr(middleware, 'sync_capable', True)
+            if middleware_is_async and not getattr(middleware, 'async_capable', False):
+                raise ImproperlyConfigured("Middleware {} is neither sync nor async capable.".format(middleware_path))
+            try:
+                adapted_handler = self.adapt_method_mode(middleware_is_async, handler, handler_is_async,
+                    debug=settings.DEBUG, name='middleware {}'.format(middleware_path))
+                mw_instance = middleware(adapted_handler)
+            except MiddlewareNotUsed:
+                continue
+            if mw_instance is None:
+                raise ImproperlyConfigured("Middleware factory {} returned None.".format(middleware_path))
+
+            if hasattr(mw_instance, 'process_view'):
+                self._view_middleware.insert(0, self.adapt_method_mode(False, mw_instance.process_view))
+            if hasattr(mw_instance, 'process_template_response'):
+                self._template_response_middleware.append(self.adapt_method_mode(False, mw_instance.process_template_response))
+            if hasattr(mw_instance, 'process_exception'):
+                self._exception_middleware.append(self.adapt_method_mode(False, mw_instance.process_exception))
+
+            handler = convert_exception_to_response(mw_instance)
+            handler_is_async = middleware_is_async
+        self._middleware_chain = self.adapt_method_mode(False, handler, handler_is_async)
+
+
+class DeviceAPIDispatcher:
+    """
+    WSGI application sending requests under the device API prefix to a handler with the
+    lean DEVICE_API_MIDDLEWARE stack, and everything else, like the admin site, to the
+    handler with the full MIDDLEWARE stack. Device calls are stateless JWT calls and don't
+    need sessions, CSRF, messages or static files.
+    """
+
+    def __init__(self, default, device_api, prefix):
+        self.default = default
+        self.device_api = device_api
+        self.prefix = prefix
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO', '').startswith(self.prefix):
+            return self.device_api(environ, start_response)
+        return self.default(environ, start_response)
+
+
+def get_device_api_application(default):
+    """
+    Wrap the default WSGI application with the device API fast path, unless DEVICE_API_PREFIX is empty.
+    """
+    prefix = getattr(settings, 'DEVICE_API_PREFIX', '/api/')
+    if not prefix:
+        return default
+    return DeviceAPIDispatcher(default, MiddlewareProfileWSGIHandler(settings.DEVICE_API_MIDDLEWARE), prefix)
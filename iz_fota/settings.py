@@ -45,6 +45,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'app',
+    'api',
     'rest_framework',
 ]
 
@@ -57,6 +58,17 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'iz_fota.db.routers.ReplicaPinningMiddleware',
+]
+
+# Requests under DEVICE_API_PREFIX only run this middleware when served by iz_fota.wsgi,
+# the stateless JWT endpoints don't need sessions, CSRF, messages or static files.
+# An empty prefix runs MIDDLEWARE for all requests.
+DEVICE_API_PREFIX = os.environ.get('DEVICE_API_PREFIX', '/api/')
+DEVICE_API_MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'iz_fota.db.routers.ReplicaPinningMiddleware',
 ]
 
 ROOT_URLCONF = 'iz_fota.urls'
@@ -87,7 +99,7 @@ if 'DJANGO_DATABASE_PASSWORD' in os.environ.keys():
     # Staging or production database
     DATABASES = {
         'default': {
-            'ENGINE': 'mssql',
+            'ENGINE': 'iz_fota.db.mssql',
             'NAME': os.environ['DJANGO_DATABASE_NAME'],
             'USER': os.environ['DJANGO_DATABASE_USER'],
             'PASSWORD': os.environ['DJANGO_DATABASE_PASSWORD'],
@@ -104,11 +116,70 @@ else:
     # development database
     DATABASES = {
         'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
+            'ENGINE': 'iz_fota.db.sqlite3',
             'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
         }
     }
 
+# Seconds a connection is kept for later requests instead of being opened per request, 'none' for unlimited.
+# With a pool 0 is best, connections then go back to the pool at the end of every request.
+DATABASES['default']['CONN_MAX_AGE'] = None if os.environ.get('DJANGO_DB_CONN_MAX_AGE', '0').lower() == 'none' else int(os.environ.get('DJANGO_DB_CONN_MAX_AGE', 0))
+# Check a kept connection before a request uses it
+DATABASES['default']['CONN_HEALTH_CHECKS'] = os.environ.get('DJANGO_DB_CONN_HEALTH_CHECKS', 'true').lower() in ('1', 'true', 'yes')
+# Connections shared by the threads of a worker process, 0 disables the pool. Threads wait up to
+# TIMEOUT seconds for a free connection, connections idle for CHECK_AFTER seconds are checked first.
+DATABASES['default']['POOL'] = {
+    'SIZE': int(os.environ.get('DJANGO_DB_POOL_SIZE', 0)),
+    'TIMEOUT': float(os.environ.get('DJANGO_DB_POOL_TIMEOUT', 10)),
+    'CHECK_AFTER': float(os.environ.get('DJANGO_DB_POOL_CHECK_AFTER', 30)),
+}
+
+# Read replicas with the credentials of the primary, by server name or, with Azure SQL read scale-out,
+# the read-only replica of the primary server
+DATABASE_REPLICAS = []
+for i, server in enumerate(filter(None, os.environ.get('DJANGO_DATABASE_REPLICA_SERVERS', '').split(','))):
+    DATABASES['replica{}'.format(i + 1)] = dict(DATABASES['default'], HOST=server.strip(), TEST={'MIRROR': 'default'})
+    DATABASE_REPLICAS.append('replica{}'.format(i + 1))
+if os.environ.get('DJANGO_DATABASE_READ_SCALE_OUT', '').lower() in ('1', 'true', 'yes'):
+    DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'},
+        OPTIONS=dict(DATABASES['default'].get('OPTIONS', {}), extra_params='ApplicationIntent=ReadOnly'))
+    DATABASE_REPLICAS.append('replica')
+
+DATABASE_ROUTERS = ['iz_fota.db.routers.ReplicaRouter']
+# Models whose reads go to the replicas, the firmware tables devices poll
+DATABASE_REPLICA_MODELS = ['app.firmware', 'app.latestfirmware', 'app.firmwareencoding', 'app.firmwaredelta']
+# 'round-robin' or 'lag-aware', which skips replicas more than DATABASE_REPLICA_MAX_LAG seconds behind
+DATABASE_REPLICA_SELECTION = os.environ.get('DJANGO_DATABASE_REPLICA_SELECTION', 'round-robin')
+DATABASE_REPLICA_MAX_LAG = float(os.environ.get('DJANGO_DATABASE_REPLICA_MAX_LAG', 5))
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get('DJANGO_DATABASE_REPLICA_LAG_CHECK_INTERVAL', 10))
+# Returns the replication lag in seconds when run on a replica, an empty query only checks that it's reachable
+DATABASE_REPLICA_LAG_QUERY = os.environ.get('DJANGO_DATABASE_REPLICA_LAG_QUERY',
+    "SELECT DATEDIFF(SECOND, last_commit_time, SYSUTCDATETIME()) FROM sys.dm_hadr_database_replica_states WHERE is_local = 1"
+    if DATABASES['default']['ENGINE'] == 'iz_fota.db.mssql' else '')
+# Seconds an admin session reads from the primary after changing something
+DATABASE_REPLICA_PIN_SECONDS = int(os.environ.get('DJANGO_DATABASE_REPLICA_PIN_SECONDS', 10))
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# 'locmem' is per worker process, 'file' is shared by the workers of a host through DJANGO_CACHE_LOCATION,
+# 'resp' by all hosts through a Redis compatible server at DJANGO_CACHE_LOCATION (host:port)
+
+CACHE_BACKENDS = {
+    'locmem': ('django.core.cache.backends.locmem.LocMemCache', 'iz_fota'),
+    'file': ('django.core.cache.backends.filebased.FileBasedCache', os.path.join(BASE_DIR, 'django_cache')),
+    'resp': ('iz_fota.cache.resp.RESPCache', '127.0.0.1:6379'),
+}
+_cache_backend, _cache_location = CACHE_BACKENDS[os.environ.get('DJANGO_CACHE_BACKEND', 'locmem')]
+CACHES = {
+    'default': {
+        'BACKEND': _cache_backend,
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', _cache_location),
+        'KEY_PREFIX': os.environ.get('DJANGO_CACHE_KEY_PREFIX', 'iz_fota'),
+        'OPTIONS': {'PASSWORD': os.environ['DJANGO_CACHE_PASSWORD']} if 'DJANGO_CACHE_PASSWORD' in os.environ else {},
+    }
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -160,7 +231,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework_simplejwt.authentication.JWTTokenUserAuthentication',
+        'api.authentication.CachedJWTTokenUserAuthentication',
     ],
 
     'DATETIME_FORMAT': "%Y-%m-%d %H:%M:%S.%f%z"
@@ -181,4 +252,70 @@ SIMPLE_JWT = {
     'TOKEN_TYPE_CLAIM': 'token_type',
 
     'JTI_CLAIM': 'jti',
-}
\ No newline at end of file
+}
+
+# Verified device tokens kept per worker process so repeated polls skip the verification, 0 disables it
+JWT_TOKEN_CACHE_SIZE = int(os.environ.get('JWT_TOKEN_CACHE_SIZE', 10000))
+
+# Seconds a cached latest_fw_version response is used, 0 disables the cache. For LATEST_FW_CACHE_STALE
+# seconds more it is still answered while the cache entry is rebuilt in the background.
+# Changed firmware invalidates the cache, with 'locmem' only that of the worker that saved it, the other workers
+# would answer the old release until the entry expires. So it's off by default unless the cache is shared.
+LATEST_FW_CACHE_ALIAS = 'default'
+LATEST_FW_CACHE_TIMEOUT = int(os.environ.get('LATEST_FW_CACHE_TIMEOUT', 0 if _cache_backend == CACHE_BACKENDS['locmem'][0] else 30))
+LATEST_FW_CACHE_STALE = int(os.environ.get('LATEST_FW_CACHE_STALE', 300))
+
+# Firmware images are streamed to devices in chunks of this many bytes
+FIRMWARE_CHUNK_SIZE = int(os.environ.get('FIRMWARE_CHUNK_SIZE', 256 * 1024))
+
+# Storage for new firmware images: 'db' keeps them in the Firmware table, 'fs' in a content addressed
+# directory. Existing images are moved with the migrate_firmware_storage command.
+FIRMWARE_STORAGE = os.environ.get('FIRMWARE_STORAGE', 'db')
+FIRMWARE_STORAGE_ROOT = os.environ.get('FIRMWARE_STORAGE_ROOT', os.path.join(BASE_DIR, 'firmware'))
+# Let the front web server send images stored on the file system: '' (serve from Django), 'x-sendfile' or 'x-accel-redirect'
+FIRMWARE_SENDFILE = os.environ.get('FIRMWARE_SENDFILE', '')
+# Internal location mapped to FIRMWARE_STORAGE_ROOT in the front web server, for X-Accel-Redirect
+FIRMWARE_ACCEL_REDIRECT_PREFIX = os.environ.get('FIRMWARE_ACCEL_REDIRECT_PREFIX', '/protected/firmware/')
+
+# Per process cache of firmware images in front of the storage: an in-memory LRU tier of MEMORY_BYTES
+# and an optional memory mapped on-disk tier of DISK_BYTES in DISK_PATH. Disabled when both sizes are 0.
+FIRMWARE_BLOB_CACHE = {
+    'MEMORY_BYTES': int(os.environ.get('FIRMWARE_BLOB_CACHE_MEMORY_BYTES', 0)),
+    'DISK_PATH': os.environ.get('FIRMWARE_BLOB_CACHE_DISK_PATH', os.path.join(BASE_DIR, 'firmware_cache')),
+    'DISK_BYTES': int(os.environ.get('FIRMWARE_BLOB_CACHE_DISK_BYTES', 0)),
+}
+
+# Directory for the host wide cache of the latest image per hardware revision, shared by all workers
+# through memory mapped files. Use a tmpfs like /dev/shm/iz_fota, empty to disable.
+FIRMWARE_SHARED_CACHE_PATH = os.environ.get('FIRMWARE_SHARED_CACHE_PATH', '')
+
+# Serve the compressed copies of the images to clients whose Accept-Encoding allows it. Off by default: almost
+# every HTTP client accepts gzip, and compressed copies are read from the database into memory, bypassing the
+# streaming, caches and sendfile offload of the full image.
+FIRMWARE_SERVE_ENCODINGS = os.environ.get('FIRMWARE_SERVE_ENCODINGS', 'False') == 'True'
+
+# Devices on one of this many releases before the latest get a binary delta instead of the full image, 0 disables deltas.
+# Off by default, devices only get deltas built ahead with manage.py build_firmware_deltas.
+FIRMWARE_DELTA_MAX_SOURCES = int(os.environ.get('FIRMWARE_DELTA_MAX_SOURCES', 0))
+# A delta is only sent when it is smaller than this fraction of the full image
+FIRMWARE_DELTA_MAX_RATIO = float(os.environ.get('FIRMWARE_DELTA_MAX_RATIO', 0.5))
+
+# Time buckets of the rollout stats, 'hour' or 'day'. Recount them with manage.py rebuild_rollout_stats after changing it.
+ROLLOUT_STATS_BUCKET = os.environ.get('ROLLOUT_STATS_BUCKET', 'hour')
+
+# Directory of the History archive, see manage.py archive_history. Results older than
+# HISTORY_ARCHIVE_AFTER_DAYS are moved there in batches of HISTORY_ARCHIVE_BATCH_SIZE rows, empty disables it.
+HISTORY_ARCHIVE_PATH = os.environ.get('HISTORY_ARCHIVE_PATH', os.path.join(BASE_DIR, 'history_archive'))
+HISTORY_ARCHIVE_AFTER_DAYS = int(os.environ.get('HISTORY_ARCHIVE_AFTER_DAYS', 180))
+HISTORY_ARCHIVE_BATCH_SIZE = int(os.environ.get('HISTORY_ARCHIVE_BATCH_SIZE', 5000))
+
+# Most results accepted in one post_results/batch request
+POST_RESULTS_BATCH_MAX = int(os.environ.get('POST_RESULTS_BATCH_MAX', 500))
+
+# SQLite file of the write-behind queue for post_results, results are stored synchronously when empty.
+# Drain it with manage.py results_queue drain --follow
+POST_RESULTS_QUEUE_PATH = os.environ.get('POST_RESULTS_QUEUE_PATH', '')
+# Results pending in the queue before post_results answers 503
+POST_RESULTS_QUEUE_MAX = int(os.environ.get('POST_RESULTS_QUEUE_MAX', 100000))
+# Seconds clients are asked to wait when the queue is full
+POST_RESULTS_QUEUE_RETRY_AFTER = int(os.environ.get('POST_RESULTS_QUEUE_RETRY_AFTER', 30))
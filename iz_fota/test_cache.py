@@ -0,0 +1,142 @@
+from django.test import SimpleTestCase
+from .cache.resp import RESPCache, RESPError
+import socketserver
+import threading
+import time
+
+
+class RESPStandIn(socketserver.ThreadingTCPServer):
+    """
+    In-process stand-in for a Redis server, with just the commands the cache backend uses.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), RESPStandInHandler)
+        self.data = {}
+        self.expires = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+
+    @property
+    def location(self):
+        return '{}:{}'.format(*self.server_address)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def live(self, key):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.data
+
+    def command(self, name, *args):
+        with self.lock:
+            if name in (b'PING', b'AUTH', b'SELECT'):
+                return b'+OK\r\n'
+            if name == b'GET':
+                if not self.live(args[0]):
+                    return b'$-1\r\n'
+                return b'$%d\r\n%s\r\n' % (len(self.data[args[0]]), self.data[args[0]])
+            if name == b'SET':
+                key, value, flags = args[0], args[1], [flag.upper() for flag in args[2:]]
+                if b'NX' in flags and self.live(key):
+                    return b'$-1\r\n'
+                self.data[key] = value
+                self.expires.pop(key, None)
+                if b'PX' in flags:
+                    self.expires[key] = time.monotonic() + int(flags[flags.index(b'PX') + 1]) / 1000
+                return b'+OK\r\n'
+            if name == b'DEL':
+                removed = sum(1 for key in args if self.live(key))
+                for key in args:
+                    self.data.pop(key, None)
+                    self.expires.pop(key, None)
+                return b':%d\r\n' % removed
+            if name == b'EXISTS':
+                return b':%d\r\n' % sum(1 for key in args if self.live(key))
+            if name == b'PEXPIRE':
+                if not self.live(args[0]):
+                    return b':0\r\n'
+                self.expires[args[0]] = time.monotonic() + int(args[1]) / 1000
+                return b':1\r\n'
+            if name == b'PERSIST':
+                return b':%d\r\n' % (self.live(args[0]) and self.expires.pop(args[0], None) is not None)
+            if name == b'FLUSHDB':
+                self.data.clear()
+                self.expires.clear()
+                return b'+OK\r\n'
+            return b"-ERR unknown command '%s'\r\n" % name
+
+
+class RESPStandInHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:-2])):
+                length = int(self.rfile.readline()[1:-2])
+                args.append(self.rfile.read(length + 2)[:-2])
+            self.wfile.write(self.server.command(args[0].upper(), *args[1:]))
+
+
+class RESPCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.server = RESPStandIn()
+        self.addCleanup(self.server.stop)
+        self.cache = RESPCache(self.server.location, {'KEY_PREFIX': 'test'})
+
+    def test_get_set_delete(self):
+        self.assertIsNone(self.cache.get('missing'))
+        self.assertEqual('default', self.cache.get('missing', 'default'))
+        self.cache.set('entry', {'body': b'{"fw_version":"1.0.0"}', 'etag': '"abc"'})
+        self.assertEqual({'body': b'{"fw_version":"1.0.0"}', 'etag': '"abc"'}, self.cache.get('entry'))
+        self.assertTrue(self.cache.has_key('entry'))
+        self.assertTrue(self.cache.delete('entry'))
+        self.assertFalse(self.cache.delete('entry'))
+        self.assertIsNone(self.cache.get('entry'))
+
+    def test_keys_are_prefixed(self):
+        self.cache.set('entry', 1)
+        self.assertEqual([b'test:1:entry'], list(self.server.data))
+
+    def test_add_only_sets_missing_keys(self):
+        self.assertTrue(self.cache.add('lock', 1))
+        self.assertFalse(self.cache.add('lock', 2))
+        self.assertEqual(1, self.cache.get('lock'))
+
+    def test_timeouts(self):
+        self.cache.set('short', 1, 0.05)
+        self.cache.set('forever', 1, None)
+        self.cache.set('gone', 1, 0)
+        self.assertEqual(1, self.cache.get('short'))
+        self.assertIsNone(self.cache.get('gone'))
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('short'))
+        self.assertEqual(1, self.cache.get('forever'))
+        self.assertTrue(self.cache.touch('forever', 0.05))
+        time.sleep(0.1)
+        self.assertFalse(self.cache.has_key('forever'))
+
+    def test_clear(self):
+        self.cache.set('entry', 1)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('entry'))
+
+    def test_reconnects_after_the_connection_was_dropped(self):
+        self.cache.set('entry', 1)
+        self.cache._local.connection.sock.close()
+        self.assertEqual(1, self.cache.get('entry'))
+
+    def test_server_errors_are_raised(self):
+        with self.assertRaises(RESPError):
+            self.cache.execute('NOSUCHCOMMAND')
+        # The connection is still usable afterwards
+        self.cache.set('entry', 1)
+        self.assertEqual(1, self.cache.get('entry'))
@@ -0,0 +1,114 @@
+from django.db.utils import load_backend
+from django.test import SimpleTestCase
+from unittest import mock
+from .db.backends import get_pool_stats
+from .db.pool import ConnectionPool, PoolTimeout
+import os
+import shutil
+import tempfile
+import threading
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    def test_reuse_and_bound(self):
+        pool = ConnectionPool(2, timeout=0.05)
+        first = pool.acquire(FakeConnection)
+        second = pool.acquire(FakeConnection)
+        with self.assertRaises(PoolTimeout):
+            pool.acquire(FakeConnection)
+        pool.release(first)
+        self.assertIs(first, pool.acquire(FakeConnection))
+        stats = pool.stats()
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(3, stats['checkouts'])
+        self.assertEqual(1, stats['timeouts'])
+        self.assertEqual(2, stats['in_use'])
+
+    def test_waits_for_release(self):
+        pool = ConnectionPool(1, timeout=5)
+        raw = pool.acquire(FakeConnection)
+        timer = threading.Timer(0.05, pool.release, [raw])
+        timer.start()
+        self.assertIs(raw, pool.acquire(FakeConnection))
+        timer.join()
+        self.assertEqual(1, pool.stats()['waits'])
+        self.assertGreater(pool.stats()['max_wait_seconds'], 0)
+
+    def test_idle_connections_checked(self):
+        pool = ConnectionPool(1, check_after=0)
+        raw = pool.acquire(FakeConnection)
+        pool.release(raw)
+        new = pool.acquire(FakeConnection, check=lambda raw: False)
+        self.assertIsNot(raw, new)
+        self.assertTrue(raw.closed)
+        self.assertEqual(1, pool.stats()['discarded'])
+
+    def test_discard_makes_room(self):
+        pool = ConnectionPool(1, timeout=0)
+        raw = pool.acquire(FakeConnection)
+        pool.discard(raw)
+        self.assertTrue(raw.closed)
+        self.assertIsNot(raw, pool.acquire(FakeConnection))
+
+    def test_failed_connect_frees_slot(self):
+        pool = ConnectionPool(1, timeout=0)
+        def fail():
+            raise OSError("server unreachable")
+        with self.assertRaises(OSError):
+            pool.acquire(fail)
+        self.assertEqual(0, pool.stats()['in_use'])
+        pool.acquire(FakeConnection)
+
+
+class PooledBackendTestCase(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.settings_dict = {
+            'ENGINE': 'iz_fota.db.sqlite3', 'NAME': os.path.join(tmp, 'pool.sqlite3'),
+            'ATOMIC_REQUESTS': False, 'AUTOCOMMIT': True, 'CONN_MAX_AGE': 0, 'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {}, 'TIME_ZONE': None, 'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': '', 'TEST': {},
+            'POOL': {'SIZE': 1, 'TIMEOUT': 0.05},
+        }
+
+    def wrapper(self):
+        return load_backend('iz_fota.db.sqlite3').DatabaseWrapper(self.settings_dict, alias='pool_test')
+
+    def test_connections_shared_between_wrappers(self):
+        first = self.wrapper()
+        with first.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        raw = first.connection
+        second = self.wrapper()
+        # The only pooled connection is checked out
+        with self.assertRaises(PoolTimeout):
+            second.ensure_connection()
+        first.close()
+        second.ensure_connection()
+        self.assertIs(raw, second.connection)
+        second.close()
+        stats = get_pool_stats()['pool_test:{}'.format(self.settings_dict['NAME'])]
+        self.assertEqual(1, stats['created'])
+        self.assertEqual(1, stats['idle'])
+
+    def test_health_check(self):
+        self.settings_dict['POOL'] = {}
+        self.settings_dict['CONN_MAX_AGE'] = None
+        connection = self.wrapper()
+        connection.ensure_connection()
+        raw = connection.connection
+        connection.close_if_unusable_or_obsolete()
+        self.assertIs(raw, connection.connection)
+        # The server went away between two requests
+        with mock.patch.object(connection, 'is_usable', return_value=False):
+            connection.ensure_connection()
+        self.assertIsNot(raw, connection.connection)
+        connection.close()
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.signals import request_finished, request_started
+from django.db import close_old_connections
+from django.middleware.security import SecurityMiddleware
+from django.test import RequestFactory, SimpleTestCase
+from .handlers import DeviceAPIDispatcher, MiddlewareProfileWSGIHandler, get_device_api_application
+import django
+import hashlib
+import inspect
+
+# Digest of the source of BaseHandler.load_middleware in Django 3.1.8
+DJANGO_LOAD_MIDDLEWARE_SHA256 = '5e1525440ca4742ff508be94988914bf4b8e6aaad0d1ff7bbb3af8ec938c859a'
+
+
+class DeviceAPIDispatcherTestCase(SimpleTestCase):
+    def setUp(self):
+        # Like the test client, keep the handlers from closing the test database connection
+        request_started.disconnect(close_old_connections)
+        request_finished.disconnect(close_old_connections)
+        self.addCleanup(request_started.connect, close_old_connections)
+        self.addCleanup(request_finished.connect, close_old_connections)
+        self.application = get_device_api_application(WSGIHandler())
+
+    def call(self, path):
+        statuses = []
+        def start_response(status, headers, exc_info=None):
+            statuses.append((status, dict(headers)))
+        environ = RequestFactory(HTTP_HOST=settings.ALLOWED_HOSTS[0]).get(path).environ
+        response = self.application(environ, start_response)
+        b"".join(response)
+        response.close()
+        return statuses[0]
+
+    def test_device_api_skips_admin_middleware(self):
+        self.assertIsInstance(self.application, DeviceAPIDispatcher)
+        status, headers = self.call('/api/latest_fw_version/')
+        self.assertEqual('401 Unauthorized', status)
+        # No clickjacking protection, it's for the admin pages
+        self.assertNotIn('X-Frame-Options', headers)
+        # Security middleware still runs
+        self.assertEqual('nosniff', headers.get('X-Content-Type-Options'))
+
+        status, headers = self.call('/login/')
+        self.assertIn('X-Frame-Options', headers)
+
+    def test_middleware_profile_ignores_settings(self):
+        # Neither reads nor swaps settings.MIDDLEWARE
+        with self.settings(MIDDLEWARE=['no.such.Middleware']):
+            handler = MiddlewareProfileWSGIHandler(['django.middleware.security.SecurityMiddleware'])
+            self.assertEqual(['no.such.Middleware'], settings.MIDDLEWARE)
+        self.assertIsInstance(handler._middleware_chain.__wrapped__, SecurityMiddleware)
+
+    def test_load_middleware_copy_matches_django(self):
+        # MiddlewareProfileWSGIHandler.load_middleware copies this exact Django code
+        source = inspect.getsource(BaseHandler.load_middleware)
+        self.assertEqual(DJANGO_LOAD_MIDDLEWARE_SHA256, hashlib.sha256(source.encode()).hexdigest(),
+            "BaseHandler.load_middleware changed with Django {}, update MiddlewareProfileWSGIHandler".format(django.get_version()))
+
+        # Same chain as Django builds from the same middleware
+        default = WSGIHandler()
+        handler = MiddlewareProfileWSGIHandler(settings.MIDDLEWARE)
+        for attribute in ['_view_middleware', '_template_response_middleware', '_exception_middleware']:
+            self.assertEqual([type(method.__self__) for method in getattr(default, attribute)],
+                [type(method.__self__) for method in getattr(handler, attribute)])
+        self.assertIs(type(default._middleware_chain.__wrapped__), type(handler._middleware_chain.__wrapped__))
+
+    def test_disabled(self):
+        default = WSGIHandler()
+        with self.settings(DEVICE_API_PREFIX=''):
+            self.assertIs(default, get_device_api_application(default))
@@ -0,0 +1,98 @@
+from django.db import connections
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from unittest import mock
+from app.models import Device, Firmware, History
+from .db.routers import ReplicaPinningMiddleware, ReplicaRouter, ReplicaSelector, get_replica_selector, is_pinned, use_primary
+
+
+@override_settings(DATABASE_REPLICAS=['replica1', 'replica2'])
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    def test_firmware_reads_go_to_replicas(self):
+        with use_primary(False):
+            self.assertEqual(['replica1', 'replica2', 'replica1'], [self.router.db_for_read(Firmware) for _ in range(3)])
+            self.assertEqual('default', self.router.db_for_read(Device))
+            self.assertEqual('default', self.router.db_for_read(History))
+
+    def test_reads_own_writes(self):
+        with use_primary(False):
+            self.assertEqual('default', self.router.db_for_write(Firmware))
+            self.assertTrue(is_pinned())
+            self.assertEqual('default', self.router.db_for_read(Firmware))
+        with use_primary(False):
+            self.assertNotEqual('default', self.router.db_for_read(Firmware))
+
+    def test_writes_outside_request_dont_pin(self):
+        # E.g. management commands and worker threads keep reading from the replicas
+        self.assertEqual('default', self.router.db_for_write(Firmware))
+        self.assertFalse(is_pinned())
+        self.assertNotEqual('default', self.router.db_for_read(Firmware))
+
+    def test_reads_follow_instance(self):
+        firmware = Firmware(pk=1)
+        firmware._state.db = 'replica2'
+        with use_primary(False):
+            self.assertEqual(['replica2', 'replica2'], [self.router.db_for_read(Firmware, instance=firmware) for _ in range(2)])
+            self.assertEqual('replica2', self.router.db_for_read(Device, instance=firmware))
+
+    def test_transactions_read_from_primary(self):
+        with use_primary(False), mock.patch.object(connections['default'], 'in_atomic_block', True):
+            self.assertEqual('default', self.router.db_for_read(Firmware))
+
+    def test_no_migrations_on_replicas(self):
+        self.assertFalse(self.router.allow_migrate('replica1', 'app'))
+        self.assertIsNone(self.router.allow_migrate('default', 'app'))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertIsNone(get_replica_selector())
+        with use_primary(False):
+            self.assertEqual('default', self.router.db_for_read(Firmware))
+
+
+class ReplicaSelectorTestCase(SimpleTestCase):
+    def test_lag_aware(self):
+        selector = ReplicaSelector(['replica1', 'replica2'], 'lag-aware', max_lag=5, check_interval=60)
+        lags = {'replica1': 30.0, 'replica2': 1.0}
+        with mock.patch.object(selector, 'measure_lag', side_effect=lags.get):
+            self.assertEqual(['replica2', 'replica2'], [selector.choose() for _ in range(2)])
+        # Measured once per interval
+        self.assertEqual({'replica1': 30.0, 'replica2': 1.0}, selector.stats()['lags'])
+
+        selector = ReplicaSelector(['replica1'], 'lag-aware')
+        with mock.patch.object(selector, 'measure_lag', return_value=None):
+            # Unreachable replica, read from the primary
+            self.assertEqual('default', selector.choose())
+        self.assertEqual(1, selector.stats()['primary_reads'])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            ReplicaSelector(['replica1'], 'random')
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'], DATABASE_REPLICA_PIN_SECONDS=7)
+class ReplicaPinningMiddlewareTestCase(SimpleTestCase):
+    def test_admin_writes_pin_session(self):
+        seen = []
+        def view(request):
+            seen.append(is_pinned())
+            return HttpResponse()
+        middleware = ReplicaPinningMiddleware(view)
+
+        request = RequestFactory().post('/app/firmware/add/')
+        request.session = {}
+        response = middleware(request)
+        self.assertEqual(7, response.cookies['primary_db']['max-age'])
+
+        request = RequestFactory().get('/app/firmware/', HTTP_COOKIE='primary_db=1')
+        middleware(request)
+        request = RequestFactory().get('/app/firmware/')
+        middleware(request)
+        self.assertEqual([False, True, False], seen)
+
+    def test_no_cookie_for_devices(self):
+        response = ReplicaPinningMiddleware(lambda request: HttpResponse())(RequestFactory().post('/api/post_results/'))
+        self.assertNotIn('primary_db', response.cookies)
@@ -17,6 +17,7 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework import routers
 from api import views
+from app import views as app_views
 
 # Customize site titles/header of admin site
 admin.site.site_header = "Dose Admin"
@@ -29,6 +30,10 @@ router.register(r'dl_latest_fw', views.DownloadLatestFirmwareViewSet, basename='
 router.register(r'post_results', views.PostResultsViewSet, basename='post_results')
 
 urlpatterns = [
+    path('stats/', app_views.stats, name='stats'),
+    path('stats/archived_history/', app_views.archived_history, name='archived_history'),
+    path('stats/rollout/', app_views.rollout_stats, name='rollout_stats'),
+    path('stats/fleet/', app_views.fleet_stats, name='fleet_stats'),
     path('', admin.site.urls),
     path('api/', include(router.urls)),
 ]
\ No newline at end of file
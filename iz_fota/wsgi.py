@@ -13,4 +13,7 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'iz_fota.settings')
 
-application = get_wsgi_application()
+from iz_fota.handlers import get_device_api_application
+
+# Device API requests skip the middleware only the admin site needs
+application = get_device_api_application(get_wsgi_application())